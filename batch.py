@@ -0,0 +1,219 @@
+from typing import Any
+from collections.abc import Iterator
+import argparse
+import json
+import os
+import sys
+import time
+
+import asyncio
+import httpx
+
+from modules.core import constants
+from modules import settings
+from modules import lm_backend
+
+
+# Runs a JSONL file of requests through the configured server(s) without the UI, with the
+# sampler settings from data/settings.json. Each line is an object with either "messages"
+# (sent to /v1/chat/completions) or "prompt" (sent to /completion), and optionally an "id"
+# (the line number otherwise). Any other fields are sent as they are and win over the settings.
+#
+#   python batch.py prompts.jsonl results.jsonl --concurrency 8
+#
+# Results are appended to the output as they complete, in completion order. Running the
+# same command again skips the requests that already have a result (failed ones are retried).
+
+REPORT_INTERVAL: float = 10.0
+
+
+class BatchStats:
+    def __init__(self) -> None:
+        self.start_time: float = time.perf_counter()
+        self.completed_count: int = 0
+        self.failed_count: int = 0
+        self.prompt_token_count: int = 0
+        self.predicted_token_count: int = 0
+
+    def get_report(self) -> str:
+        duration: float = max(time.perf_counter() - self.start_time, 1e-9)
+        return (
+            f"{self.completed_count} done, {self.failed_count} failed in {duration:.1f} s: "
+            f"{self.predicted_token_count} tokens generated ({self.predicted_token_count / duration:.1f} tokens/s), "
+            f"{self.prompt_token_count} prompt tokens processed ({self.prompt_token_count / duration:.1f} tokens/s)"
+        )
+
+
+def read_requests(input_path: str) -> list[tuple[Any, dict[str, Any]]]:
+    requests: list[tuple[Any, dict[str, Any]]] = []
+    request_ids: set[str] = set()
+    with open(input_path, "rt", encoding="utf-8") as file:
+        for line_number, line in enumerate(file, 1):
+            if line.strip() == "":
+                continue
+            try:
+                body: Any = json.loads(line)
+            except json.JSONDecodeError as exception:
+                raise ValueError(f"Line {line_number} is not valid JSON: {exception}")
+            if not isinstance(body, dict) or ("messages" in body) == ("prompt" in body):
+                raise ValueError(f"Line {line_number} must be an object with either \"messages\" or \"prompt\".")
+
+            request_id: Any = body.pop("id", line_number)
+            key: str = json.dumps(request_id)
+            if key in request_ids:
+                raise ValueError(f"Line {line_number} has the same ID as an earlier line: {key}")
+            request_ids.add(key)
+            requests.append((request_id, body))
+    return requests
+
+
+# IDs (as JSON, so 1 and "1" stay apart) of the requests the output already has a result for.
+def read_completed_ids(output_path: str) -> set[str]:
+    completed_ids: set[str] = set()
+    if not os.path.exists(output_path):
+        return completed_ids
+
+    with open(output_path, "rt", encoding="utf-8") as file:
+        for line in file:
+            try:
+                result: Any = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # Cut off by an interruption.
+            if isinstance(result, dict) and "id" in result and "error" not in result:
+                completed_ids.add(json.dumps(result["id"]))
+    return completed_ids
+
+
+def create_request_payload(body: dict[str, Any]) -> dict[str, Any]:
+    payload: dict[str, Any] = lm_backend.create_payload({})
+    if "prompt" in body:
+        payload["n_predict"] = settings.get_key("writer/max_tokens", constants.DEFAULT_SETTINGS["writer"]["max_tokens"])
+    payload.update(body)
+    # Results are written whole, so there's nothing to gain from streaming.
+    payload["stream"] = False
+    payload["cache_prompt"] = True
+    return payload
+
+
+# `session_hash` is what the slot queue takes turns between, like the UI's sessions.
+async def run_request(request_id: Any, body: dict[str, Any], stats: BatchStats, session_hash: str) -> dict[str, Any]:
+    payload: dict[str, Any] = create_request_payload(body)
+    slot_waiter: asyncio.Future[tuple[str, int]] | None = await lm_backend.queue_generation(lm_backend.get_configured_port(), session_hash)
+    if slot_waiter is None:
+        raise ConnectionError("Could not connect to any language model server.")
+    slot: tuple[str, int] | None = await lm_backend.wait_for_slot(slot_waiter, session_hash)
+    if slot is None:
+        return {"id": request_id, "error": "No server slot was granted."}
+    base_url: str = slot[0]
+    payload["id_slot"] = slot[1]
+
+    try:
+        endpoint: str = "/v1/chat/completions" if "messages" in payload else "/completion"
+        response: httpx.Response = await lm_backend.get_client().request("POST", f"{base_url}{endpoint}", json=payload, timeout=None)
+        response_data: dict[str, Any] = response.json()
+    except httpx.TransportError as exception:
+        lm_backend.mark_backend_unhealthy(base_url)
+        return {"id": request_id, "error": f"Could not connect to language model server at {base_url}: {exception!r}"}
+    except (httpx.HTTPError, ValueError) as exception:
+        return {"id": request_id, "error": repr(exception)}
+    finally:
+        lm_backend.release_slot(slot)
+
+    # A response of an unexpected shape fails only this request.
+    try:
+        if "error" in response_data:
+            return {"id": request_id, "error": response_data["error"].get("message", "")}
+
+        result: dict[str, Any] = {"id": request_id}
+        if "choices" in response_data:
+            choice: dict[str, Any] = response_data["choices"][0]
+            result["text"] = choice["message"]["content"] or ""
+            result["finish_reason"] = choice["finish_reason"]
+        else:
+            result["text"] = response_data["content"]
+            result["finish_reason"] = "length" if response_data.get("stop_type") == "limit" else "stop"
+        timings: dict[str, Any] = response_data.get("timings", {})
+        result["timings"] = timings
+        if "usage" in response_data:
+            result["usage"] = response_data["usage"]
+
+        prompt_token_count: int = timings.get("prompt_n", 0)
+        predicted_token_count: int = timings.get("predicted_n", response_data.get("usage", {}).get("completion_tokens", 0))
+    except (KeyError, TypeError, IndexError, AttributeError) as exception:
+        return {"id": request_id, "error": f"Unexpected response: {exception!r}"}
+
+    stats.prompt_token_count += prompt_token_count
+    stats.predicted_token_count += predicted_token_count
+    return result
+
+
+async def run_batch(pending_requests: list[tuple[Any, dict[str, Any]]], output_path: str, concurrency: int) -> BatchStats:
+    stats: BatchStats = BatchStats()
+    request_iterator: Iterator[tuple[Any, dict[str, Any]]] = iter(pending_requests)
+
+    # Appending after a line cut off by an interruption would corrupt the next one.
+    if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+        with open(output_path, "rb") as file:
+            file.seek(-1, os.SEEK_END)
+            needs_newline: bool = file.read(1) != b"\n"
+    else:
+        needs_newline = False
+
+    with open(output_path, "at", encoding="utf-8") as output_file:
+        if needs_newline:
+            output_file.write("\n")
+
+        # Each worker runs one request at a time under its own session, so the slot queue takes
+        # turns between the workers and any UI users just as it does between UI users.
+        async def run_worker(worker_index: int) -> None:
+            for request_id, body in request_iterator:
+                result: dict[str, Any] = await run_request(request_id, body, stats, f"batch-{worker_index}")
+                if "error" in result:
+                    stats.failed_count += 1
+                else:
+                    stats.completed_count += 1
+                output_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+                output_file.flush()
+
+        async def run_reporter() -> None:
+            while True:
+                await asyncio.sleep(REPORT_INTERVAL)
+                print(f"{stats.get_report()}, {len(pending_requests) - stats.completed_count - stats.failed_count} left", file=sys.stderr)
+
+        async with lm_backend.lifespan(None):
+            reporter_task: asyncio.Task[None] = asyncio.create_task(run_reporter())
+            try:
+                async with asyncio.TaskGroup() as task_group:
+                    for worker_index in range(concurrency):
+                        task_group.create_task(run_worker(worker_index))
+            except* ConnectionError as exception_group:
+                raise exception_group.exceptions[0]
+            finally:
+                reporter_task.cancel()
+                print(stats.get_report(), file=sys.stderr)
+    return stats
+
+
+if __name__ == "__main__":
+    argument_parser: argparse.ArgumentParser = argparse.ArgumentParser(description="Run a JSONL file of chat or completion requests with the UI's sampler settings.")
+    argument_parser.add_argument("input", help="JSONL file with one request per line.")
+    argument_parser.add_argument("output", help="JSONL file the results are appended to. Requests with a result in it are skipped.")
+    argument_parser.add_argument("--concurrency", type=int, default=4, help="Requests in flight at most (the servers' free slots also limit it).")
+    arguments: argparse.Namespace = argument_parser.parse_args()
+
+    settings.load()
+
+    try:
+        requests: list[tuple[Any, dict[str, Any]]] = read_requests(arguments.input)
+    except (OSError, ValueError) as exception:
+        sys.exit(f"Could not read {arguments.input}: {exception}")
+    completed_ids: set[str] = read_completed_ids(arguments.output)
+    pending_requests: list[tuple[Any, dict[str, Any]]] = [(request_id, body) for request_id, body in requests if json.dumps(request_id) not in completed_ids]
+    print(f"{len(pending_requests)} requests to run, {len(requests) - len(pending_requests)} already done.", file=sys.stderr)
+
+    try:
+        asyncio.run(run_batch(pending_requests, arguments.output, max(1, arguments.concurrency)))
+    except KeyboardInterrupt:
+        sys.exit("Interrupted. Run the same command again to resume.")
+    except ConnectionError as exception:
+        sys.exit(str(exception))
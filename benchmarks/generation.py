@@ -0,0 +1,205 @@
+from typing import Any
+from collections.abc import AsyncIterator
+from collections.abc import Callable
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import gradio as gr
+import asyncio
+import httpx
+
+from modules.core import constants
+from modules import settings
+from modules import lm_backend
+from modules import sessions
+from modules.ui import tab_chat
+from modules.ui import tab_writer
+
+
+# Drives the chat and writer handlers directly (no browser, no Gradio server) against
+# benchmarks/mock_server.py, which runs in its own process so its work isn't counted.
+#
+#   python -m benchmarks.generation --output before.json
+#
+# TTFT is measured to the first UI update that shows generated text, so it includes
+# stream coalescing. CPU time is this process only, i.e., the app's own overhead.
+
+HISTORY_MESSAGE_COUNT: int = 200
+WRITER_DOCUMENT_WORDS: int = 4000
+
+
+class RunResult:
+    def __init__(self) -> None:
+        self.time_to_first_token: float | None = None
+        self.duration: float = 0.0
+        self.cpu_time: float = 0.0
+        self.yield_count: int = 0
+        self.token_count: int = 0
+
+
+async def measure_run(generator: AsyncIterator[Any], has_generated_text: Callable[[Any], bool], session: sessions.Session) -> RunResult:
+    result: RunResult = RunResult()
+    start_time: float = time.perf_counter()
+    start_cpu_time: float = time.process_time()
+    async for output in generator:
+        result.yield_count += 1
+        if result.time_to_first_token is None and has_generated_text(output):
+            result.time_to_first_token = time.perf_counter() - start_time
+    result.duration = time.perf_counter() - start_time
+    result.cpu_time = time.process_time() - start_cpu_time
+    if session.last_timings is not None:
+        result.token_count = session.last_timings.get("predicted_n", 0)
+    return result
+
+
+async def run_chat(session_hash: str, history_message_count: int) -> RunResult:
+    request: gr.Request = gr.Request(session_hash=session_hash)
+    session: sessions.Session = sessions.get(request)
+    for index in range(history_message_count):
+        session.chat_conversation.append(gr.ChatMessage(f"Earlier message number {index} with a few words of filler text.", "user" if index % 2 == 0 else "assistant"))
+    tab_chat.create_user_message({"text": "Tell me a story about a fox.", "files": []}, "You are a helpful assistant.", False, request)
+
+    def has_generated_text(rendered_history: list[gr.MessageDict]) -> bool:
+        return len(rendered_history) > 0 and rendered_history[-1]["role"] == "assistant" and rendered_history[-1]["content"] != ""
+
+    result: RunResult = await measure_run(tab_chat.create_assistant_message(request), has_generated_text, session)
+    sessions.remove(request)
+    return result
+
+
+async def run_writer(session_hash: str, document_word_count: int) -> RunResult:
+    request: gr.Request = gr.Request(session_hash=session_hash)
+    session: sessions.Session = sessions.get(request)
+    document: str = " ".join(f"word{index % 97}" for index in range(document_word_count))
+
+    result: RunResult = await measure_run(tab_writer.generate_text(document, request), lambda text: len(text) > len(document), session)
+    sessions.remove(request)
+    return result
+
+
+def summarize(results: list[RunResult], peak_memory: int) -> dict[str, Any]:
+    time_to_first_tokens: list[float] = [result.time_to_first_token * 1000.0 for result in results if result.time_to_first_token is not None]
+    token_count: int = sum(result.token_count for result in results)
+    return {
+        "runs": len(results),
+        "tokens": token_count,
+        "ttft_ms_median": statistics.median(time_to_first_tokens) if len(time_to_first_tokens) > 0 else None,
+        "ttft_ms_max": max(time_to_first_tokens) if len(time_to_first_tokens) > 0 else None,
+        "cpu_us_per_token": sum(result.cpu_time for result in results) * 1e6 / token_count if token_count > 0 else None,
+        "yields_per_second": sum(result.yield_count for result in results) / sum(result.duration for result in results),
+        "peak_memory_kb": peak_memory // 1024,
+    }
+
+
+async def run_scenario(run: Callable[[str], Any], run_count: int) -> dict[str, Any]:
+    await run("warmup")
+    results: list[RunResult] = [await run(f"run-{index}") for index in range(run_count)]
+
+    # Traced separately since tracemalloc slows everything down.
+    tracemalloc.start()
+    await run("memory")
+    peak_memory: int = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return summarize(results, peak_memory)
+
+
+async def run_benchmarks(arguments: argparse.Namespace) -> dict[str, Any]:
+    scenarios: dict[str, Callable[[str], Any]] = {
+        "chat_stream": lambda session_hash: run_chat(session_hash, 0),
+        "chat_stream_long_history": lambda session_hash: run_chat(session_hash, HISTORY_MESSAGE_COUNT),
+        "writer_stream": lambda session_hash: run_writer(session_hash, WRITER_DOCUMENT_WORDS),
+    }
+    results: dict[str, Any] = {}
+
+    async with lm_backend.lifespan(None):
+        for stream_responses in (True, False):
+            settings.set_key("language_model/stream_responses", stream_responses)
+            for name, run in scenarios.items():
+                if not stream_responses:
+                    name = name.replace("_stream", "_no_stream")
+                print(f"Running {name}...", file=sys.stderr)
+                results[name] = await run_scenario(run, arguments.runs)
+
+    return results
+
+
+def start_mock_server(arguments: argparse.Namespace) -> subprocess.Popen[bytes]:
+    mock_server: subprocess.Popen[bytes] = subprocess.Popen([
+        sys.executable, "-m", "benchmarks.mock_server",
+        "--port", str(arguments.port),
+        "--tokens-per-second", str(arguments.tokens_per_second),
+        "--prompt-tokens-per-second", str(arguments.prompt_tokens_per_second),
+        "--first-token-ms", str(arguments.first_token_ms),
+        "--default-max-tokens", str(arguments.tokens),
+        "--context-size", "65536",
+    ])
+
+    for _ in range(100):
+        try:
+            if httpx.get(f"http://127.0.0.1:{arguments.port}/health").status_code == 200:
+                return mock_server
+        except httpx.TransportError:
+            pass
+        time.sleep(0.1)
+    mock_server.terminate()
+    raise RuntimeError("The mock server did not start.")
+
+
+def get_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    argument_parser: argparse.ArgumentParser = argparse.ArgumentParser(description="End-to-end generation benchmark against a mock llama.cpp server.")
+    argument_parser.add_argument("--runs", type=int, default=5)
+    argument_parser.add_argument("--tokens", type=int, default=256, help="Tokens generated per run.")
+    argument_parser.add_argument("--tokens-per-second", type=float, default=500.0)
+    argument_parser.add_argument("--prompt-tokens-per-second", type=float, default=5000.0)
+    argument_parser.add_argument("--first-token-ms", type=float, default=20.0)
+    argument_parser.add_argument("--port", type=int, default=8199)
+    argument_parser.add_argument("--output", help="Also write the results to this JSON file.")
+    arguments: argparse.Namespace = argument_parser.parse_args()
+
+    # Keep the user's settings and conversations out of it.
+    constants.DATA_DIR_PATH = f"{tempfile.mkdtemp(prefix="blas-chat-benchmark-")}{os.sep}"
+    settings.load()
+    settings.set_key("language_model/host", "http://127.0.0.1")
+    settings.set_key("language_model/port", arguments.port)
+    settings.set_key("language_model/extra_backends", "")
+    settings.set_key("writer/max_tokens", arguments.tokens)
+
+    mock_server: subprocess.Popen[bytes] = start_mock_server(arguments)
+    try:
+        report: dict[str, Any] = {
+            "commit": get_commit(),
+            "python": platform.python_version(),
+            "config": {
+                "runs": arguments.runs,
+                "tokens": arguments.tokens,
+                "tokens_per_second": arguments.tokens_per_second,
+                "prompt_tokens_per_second": arguments.prompt_tokens_per_second,
+                "first_token_ms": arguments.first_token_ms,
+            },
+            "results": asyncio.run(run_benchmarks(arguments)),
+        }
+    finally:
+        mock_server.terminate()
+        mock_server.wait()
+
+    serialized_report: str = json.dumps(report, indent=4)
+    print(serialized_report)
+    if arguments.output is not None:
+        with open(arguments.output, "wt") as file:
+            file.write(serialized_report)
@@ -0,0 +1,278 @@
+from typing import Any
+from collections.abc import AsyncIterator
+import argparse
+import json
+import re
+import time
+
+import asyncio
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.responses import Response
+from starlette.responses import StreamingResponse
+from starlette.routing import Route
+
+from modules.core import constants
+
+
+# A stand-in for llama.cpp's llama-server with just enough of its API (and the same SSE
+# framing and error messages) to drive BLAS-CHAT without a model. Speeds are simulated.
+
+WORDS: list[str] = "the quick brown fox jumps over the lazy dog while a small bird sings in the tall green tree".split()
+BOS_TOKEN_ID: int = 1
+MEDIA_TOKEN_COUNT: int = 256
+TOKEN_PATTERN: re.Pattern[str] = re.compile(r" ?[^\s]+|\s+")
+
+
+class Config:
+    def __init__(self, arguments: argparse.Namespace) -> None:
+        self.total_slots: int = arguments.slots
+        self.context_size: int = arguments.context_size
+        self.tokens_per_second: float = arguments.tokens_per_second
+        self.prompt_tokens_per_second: float = arguments.prompt_tokens_per_second
+        self.first_token_ms: float = arguments.first_token_ms
+        self.default_max_tokens: int = arguments.default_max_tokens
+        self.has_vision: bool = arguments.vision
+        self.has_audio: bool = arguments.audio
+
+
+class Slot:
+    def __init__(self) -> None:
+        self.lock: asyncio.Lock = asyncio.Lock()
+        self.cached_tokens: list[int] = []
+
+
+config: Config
+__slots: list[Slot] = []
+__piece_ids: dict[str, int] = {}
+__pieces: list[str] = ["", "<s>"]
+
+
+def tokenize(text: str) -> list[int]:
+    tokens: list[int] = []
+    for piece in TOKEN_PATTERN.findall(text):
+        token_id: int | None = __piece_ids.get(piece)
+        if token_id is None:
+            token_id = len(__pieces)
+            __piece_ids[piece] = token_id
+            __pieces.append(piece)
+        tokens.append(token_id)
+    return tokens
+
+
+def detokenize(tokens: list[int]) -> str:
+    return "".join(__pieces[token] if token != BOS_TOKEN_ID and 0 <= token < len(__pieces) else "" for token in tokens)
+
+
+def create_error_response(status_code: int, message: str) -> JSONResponse:
+    return JSONResponse(
+        {
+            "error": {
+                "code": status_code,
+                "message": message,
+                "type": "invalid_request_error",
+            },
+        },
+        status_code=status_code,
+    )
+
+
+def format_event(data: dict[str, Any]) -> bytes:
+    return f"data: {json.dumps(data, separators=(",", ":"))}\n\n".encode()
+
+
+async def health(request: Request) -> Response:
+    return JSONResponse({"status": "ok"})
+
+
+async def props(request: Request) -> Response:
+    return JSONResponse({
+        "default_generation_settings": {
+            "n_ctx": config.context_size,
+        },
+        "total_slots": config.total_slots,
+        "modalities": {
+            "vision": config.has_vision,
+            "audio": config.has_audio,
+        },
+    })
+
+
+async def tokenize_route(request: Request) -> Response:
+    body: dict[str, Any] = await request.json()
+    tokens: list[int] = ([BOS_TOKEN_ID] if body.get("add_special", False) else []) + tokenize(body.get("content", ""))
+    if body.get("with_pieces", False):
+        return JSONResponse({"tokens": [{"id": token, "piece": __pieces[token]} for token in tokens]})
+    return JSONResponse({"tokens": tokens})
+
+
+async def detokenize_route(request: Request) -> Response:
+    body: dict[str, Any] = await request.json()
+    return JSONResponse({"content": detokenize(body.get("tokens", []))})
+
+
+async def completion(request: Request) -> Response:
+    body: dict[str, Any] = await request.json()
+    prompt: str | list[int] = body.get("prompt", "")
+    prompt_tokens: list[int] = prompt if isinstance(prompt, list) else [BOS_TOKEN_ID] + tokenize(prompt)
+    return await __generate(body, prompt_tokens, False)
+
+
+async def chat_completions(request: Request) -> Response:
+    body: dict[str, Any] = await request.json()
+    prompt_tokens: list[int] = [BOS_TOKEN_ID]
+    for message in body.get("messages", []):
+        prompt_tokens += tokenize(f"<|{message["role"]}|>\n")
+        content: str | list[dict[str, Any]] = message["content"]
+        if isinstance(content, str):
+            prompt_tokens += tokenize(content)
+            continue
+        for part in content:
+            match part.get("type"):
+                case "text":
+                    prompt_tokens += tokenize(part["text"])
+                case "image_url":
+                    if not config.has_vision:
+                        return create_error_response(500, constants.SERVER_ERROR_IMAGE_INPUT_UNSUPPORTED)
+                    prompt_tokens += [0] * MEDIA_TOKEN_COUNT
+                case "input_audio":
+                    if not config.has_audio:
+                        return create_error_response(500, constants.SERVER_ERROR_AUDIO_INPUT_UNSUPPORTED)
+                    prompt_tokens += [0] * MEDIA_TOKEN_COUNT
+                case _:
+                    pass
+    return await __generate(body, prompt_tokens, True)
+
+
+async def __generate(body: dict[str, Any], prompt_tokens: list[int], is_chat: bool) -> Response:
+    if len(prompt_tokens) >= config.context_size:
+        return create_error_response(400, constants.SERVER_ERROR_NO_CONTEXT_SHIFT)
+
+    # Without a limit, generation "ends" as if the model had stopped by itself.
+    max_tokens: int = body.get("n_predict", body.get("max_tokens", -1))
+    finish_reason: str = "length"
+    if max_tokens < 0:
+        max_tokens = config.default_max_tokens
+        finish_reason = "stop"
+    if max_tokens > config.context_size - len(prompt_tokens):
+        max_tokens = config.context_size - len(prompt_tokens)
+        finish_reason = "length"
+    slot_id: int = body.get("id_slot", -1)
+    if not 0 <= slot_id < len(__slots):
+        slot_id = 0
+    slot: Slot = __slots[slot_id]
+    timings: dict[str, Any] = {}
+
+    async def generate() -> AsyncIterator[tuple[str, int]]:
+        async with slot.lock:
+            cached_token_count: int = 0
+            if body.get("cache_prompt", True):
+                for cached_token, prompt_token in zip(slot.cached_tokens, prompt_tokens):
+                    if cached_token != prompt_token:
+                        break
+                    cached_token_count += 1
+            prompt_start_time: float = time.perf_counter()
+            await asyncio.sleep((len(prompt_tokens) - cached_token_count) / config.prompt_tokens_per_second + config.first_token_ms / 1000.0)
+            timings["cache_n"] = cached_token_count
+            timings["prompt_n"] = len(prompt_tokens) - cached_token_count
+            timings["prompt_ms"] = (time.perf_counter() - prompt_start_time) * 1000.0
+
+            slot.cached_tokens = list(prompt_tokens)
+            predicted_start_time: float = time.perf_counter()
+            for index in range(max_tokens):
+                await asyncio.sleep(1.0 / config.tokens_per_second)
+                piece: str = f" {WORDS[index % len(WORDS)]}"
+                token_id: int = tokenize(piece)[0]
+                slot.cached_tokens.append(token_id)
+                yield piece, token_id
+            timings["predicted_n"] = max_tokens
+            timings["predicted_ms"] = (time.perf_counter() - predicted_start_time) * 1000.0
+
+    if not body.get("stream", False):
+        pieces: list[str] = []
+        tokens: list[int] = []
+        async for piece, token_id in generate():
+            pieces.append(piece)
+            tokens.append(token_id)
+        if is_chat:
+            return JSONResponse({
+                "choices": [
+                    {
+                        "finish_reason": finish_reason,
+                        "index": 0,
+                        "message": {
+                            "role": "assistant",
+                            "content": "".join(pieces),
+                        },
+                    },
+                ],
+                "object": "chat.completion",
+                "usage": __get_usage(timings),
+                "timings": timings,
+            })
+        return JSONResponse({
+            "content": "".join(pieces),
+            "tokens": tokens if body.get("return_tokens", False) else [],
+            "stop": True,
+            "stop_type": "limit" if finish_reason == "length" else "eos",
+            "tokens_predicted": max_tokens,
+            "timings": timings,
+        })
+
+    async def stream() -> AsyncIterator[bytes]:
+        if is_chat:
+            async for piece, _ in generate():
+                yield format_event({"choices": [{"finish_reason": None, "index": 0, "delta": {"content": piece}}], "object": "chat.completion.chunk"})
+            yield format_event({"choices": [{"finish_reason": finish_reason, "index": 0, "delta": {}}], "object": "chat.completion.chunk", "usage": __get_usage(timings), "timings": timings})
+            yield b"data: [DONE]\n\n"
+        else:
+            async for piece, token_id in generate():
+                yield format_event({"content": piece, "tokens": [token_id] if body.get("return_tokens", False) else [], "stop": False})
+            yield format_event({"content": "", "tokens": [], "stop": True, "stop_type": "limit" if finish_reason == "length" else "eos", "tokens_predicted": max_tokens, "timings": timings})
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+def __get_usage(timings: dict[str, Any]) -> dict[str, int]:
+    prompt_tokens: int = timings.get("prompt_n", 0) + timings.get("cache_n", 0)
+    return {
+        "completion_tokens": timings.get("predicted_n", 0),
+        "prompt_tokens": prompt_tokens,
+        "total_tokens": prompt_tokens + timings.get("predicted_n", 0),
+    }
+
+
+def create_app() -> Starlette:
+    __slots.clear()
+    __slots.extend(Slot() for _ in range(config.total_slots))
+    return Starlette(routes=[
+        Route("/health", health),
+        Route("/props", props),
+        Route("/tokenize", tokenize_route, methods=["POST"]),
+        Route("/detokenize", detokenize_route, methods=["POST"]),
+        Route("/completion", completion, methods=["POST"]),
+        Route("/v1/chat/completions", chat_completions, methods=["POST"]),
+    ])
+
+
+def create_argument_parser() -> argparse.ArgumentParser:
+    argument_parser: argparse.ArgumentParser = argparse.ArgumentParser(description="Mock llama.cpp server for benchmarking BLAS-CHAT.")
+    argument_parser.add_argument("--host", default="127.0.0.1")
+    argument_parser.add_argument("--port", type=int, default=8099)
+    argument_parser.add_argument("--slots", type=int, default=4)
+    argument_parser.add_argument("--context-size", type=int, default=8192)
+    argument_parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    argument_parser.add_argument("--prompt-tokens-per-second", type=float, default=5000.0)
+    argument_parser.add_argument("--first-token-ms", type=float, default=0.0, help="Extra latency before the first token.")
+    argument_parser.add_argument("--default-max-tokens", type=int, default=128, help="Tokens generated when the request sets no limit.")
+    argument_parser.add_argument("--vision", action="store_true")
+    argument_parser.add_argument("--audio", action="store_true")
+    return argument_parser
+
+
+if __name__ == "__main__":
+    arguments: argparse.Namespace = create_argument_parser().parse_args()
+    config = Config(arguments)
+    uvicorn.run(create_app(), host=arguments.host, port=arguments.port, log_level="warning")
@@ -0,0 +1,86 @@
+from typing import Any
+from collections.abc import AsyncIterator
+import json
+import time
+
+import asyncio
+import httpx
+
+from modules import sse
+
+
+TOKEN_COUNT: int = 20000
+CHUNK_SIZE: int = 4096
+REPEAT_COUNT: int = 5
+
+
+def build_stream() -> bytes:
+    lines: list[str] = []
+    for index in range(TOKEN_COUNT):
+        chunk: dict[str, Any] = {
+            "choices": [
+                {
+                    "finish_reason": None,
+                    "index": 0,
+                    "delta": {
+                        "content": f" token{index}",
+                    },
+                },
+            ],
+            "created": 1700000000,
+            "id": "chatcmpl-benchmark",
+            "model": "benchmark",
+            "object": "chat.completion.chunk",
+        }
+        lines.append(f"data: {json.dumps(chunk)}\n\n")
+    lines.append("data: [DONE]\n\n")
+    return "".join(lines).encode()
+
+
+def split_chunks(stream: bytes) -> list[bytes]:
+    return [stream[index:index + CHUNK_SIZE] for index in range(0, len(stream), CHUNK_SIZE)]
+
+
+def create_response(chunks: list[bytes]) -> httpx.Response:
+    async def stream() -> AsyncIterator[bytes]:
+        for chunk in chunks:
+            yield chunk
+
+    return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=stream())
+
+
+# What the streaming loops did before: aiter_lines, string slicing and json.loads.
+async def parse_with_lines(chunks: list[bytes]) -> int:
+    token_count: int = 0
+    async for line in create_response(chunks).aiter_lines():
+        if line.startswith("data: ") and not line.endswith("[DONE]"):
+            json.loads(line[6:])["choices"][0]["delta"].get("content", "")
+            token_count += 1
+    return token_count
+
+
+async def parse_with_decoder(chunks: list[bytes]) -> int:
+    token_count: int = 0
+    async for event in sse.aiter_events(create_response(chunks)):
+        if event.is_done():
+            break
+        event.json()["choices"][0]["delta"].get("content", "")
+        token_count += 1
+    return token_count
+
+
+def measure(name: str, function: Any, chunks: list[bytes]) -> None:
+    best_time: float = float("inf")
+    token_count: int = 0
+    for _ in range(REPEAT_COUNT):
+        start_time: float = time.perf_counter()
+        token_count = asyncio.run(function(chunks))
+        best_time = min(best_time, time.perf_counter() - start_time)
+    print(f"{name:<24}{token_count:>8} tokens{best_time * 1e6 / token_count:>10.2f} us/token")
+
+
+if __name__ == "__main__":
+    chunks: list[bytes] = split_chunks(build_stream())
+    print(f"JSON backend: {"orjson" if sse.orjson is not None else "json"}")
+    measure("aiter_lines + json", parse_with_lines, chunks)
+    measure("sse.aiter_events", parse_with_decoder, chunks)
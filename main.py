@@ -1,12 +1,19 @@
 from typing import Any
+from collections.abc import AsyncIterator
+import contextlib
 
 import gradio as gr
 import gradio.themes
 
 from modules.core import constants
 from modules.core import shared
+from modules import startup_report
 from modules import settings
 from modules import lm_backend
+from modules import sessions
+from modules import conversation_store
+from modules import metrics
+from modules import profiler
 from modules.ui import setting_components
 from modules.ui import sidebar_left
 from modules.ui import sidebar_right
@@ -15,46 +22,70 @@ from modules.ui import tab_writer
 
 
 if __name__ == "__main__":
-    def on_demo_load_1():
-        outputs: list[Any] = []
-        for setting_component_value in shared.setting_component_values.values():
-            outputs.append(setting_component_value)
-        if len(outputs) == 1:
-            return outputs[0]
-        return outputs
+    def on_demo_load(request: gr.Request):
+        # The page already has the setting values from when it was built, so only the ones changed since are sent.
+        setting_component_updates: list[Any] = []
+        for setting_component, setting_component_value in zip(shared.setting_components, shared.setting_component_values.values()):
+            setting_component_updates.append(gr.skip() if setting_component_value == setting_component.value else setting_component_value)
 
-    def on_demo_load_2(mirostat_mode: str):
-        is_mirostat_enabled: bool = mirostat_mode != "Off"
-        textbox_left_buttons: list[str] = [
-            "upload",
-        ]
-        textbox_file_extensions: list[str] = constants.GENERIC_FILE_EXTENSIONS.copy()
+        # Likewise, the textbox is built for a model without vision or audio.
+        textbox_update: Any = gr.skip()
+        if shared.model_modalities["vision"] or shared.model_modalities["audio"]:
+            textbox_left_buttons: list[str] = [
+                "upload",
+            ]
+            textbox_file_extensions: list[str] = constants.GENERIC_FILE_EXTENSIONS.copy()
 
-        if shared.model_modalities["vision"]:
-            textbox_file_extensions += constants.IMAGE_FILE_EXTENSIONS.copy()
-        if shared.model_modalities["audio"]:
-            textbox_left_buttons.append("microphone")
-            textbox_file_extensions += constants.AUDIO_FILE_EXTENSIONS.copy()
+            if shared.model_modalities["vision"]:
+                textbox_file_extensions += constants.IMAGE_FILE_EXTENSIONS.copy()
+            if shared.model_modalities["audio"]:
+                textbox_left_buttons.append("microphone")
+                textbox_file_extensions += constants.AUDIO_FILE_EXTENSIONS.copy()
+            textbox_update = gr.update(sources=textbox_left_buttons, file_types=textbox_file_extensions)
 
         return (
+            *setting_component_updates,
             f"**Vision:** {shared.model_modalities["vision"]}",
             f"**Audio:** {shared.model_modalities["audio"]}",
-            gr.update(visible=is_mirostat_enabled),
-            gr.update(visible=is_mirostat_enabled),
-            gr.update(sources=textbox_left_buttons, file_types=textbox_file_extensions)
+            textbox_update,
+            sidebar_left.Element.update_conversation_dropdown(request),
         )
 
+    @contextlib.asynccontextmanager
+    async def lifespan(app: Any) -> AsyncIterator[None]:
+        metrics.mount(app)
+        startup_report.mark("Starting the server")
+        async with lm_backend.lifespan(app):
+            startup_report.mark("Connecting to the language model servers")
+            startup_report.print_report()
+            try:
+                yield
+            finally:
+                # Checkpoints the write-ahead log into the database file.
+                conversation_store.close()
+
+    startup_report.mark("Importing the app's modules")
     settings.load()
-    settings.save()
+    startup_report.mark("Loading settings")
 
     with gr.Blocks(theme=gradio.themes.Origin(), analytics_enabled=False, title="BLAS-CHAT", css_paths="main.css") as demo:
-        is_assistant_busy: gr.State = gr.State(False)
+        startup_report.mark("Creating the Gradio app")
+        is_chat_busy: gr.State = gr.State(False)
+        is_writer_busy: gr.State = gr.State(False)
 
         sidebar_l: sidebar_left.Element = sidebar_left.Element()
         sidebar_r: sidebar_right.Element = sidebar_right.Element()
+        startup_report.mark("Building the sidebars")
 
         with gr.Tabs():
-            with gr.Tab("💬 Chat") as tab_1:
+            with gr.Tab("💬 Chat"):
+                chat_load_older_button: gr.Button = gr.Button(
+                    value="Load Older Messages",
+                    variant="secondary",
+                    size="sm",
+                    visible=False,
+                    interactive=True,
+                )
                 chat_chatbot: gr.Chatbot = gr.Chatbot(
                     value=tab_chat.set_chatbot,
                     type="messages",
@@ -76,6 +107,7 @@ if __name__ == "__main__":
                     show_label=False,
                     interactive=True,
                 )
+                chat_context_status: gr.Markdown = gr.Markdown("**Context:** 0 tokens")
                 gr.Markdown("---")
                 chat_system_prompt_text_area: setting_components.TextArea = setting_components.TextArea(
                     key="chat/system_prompt",
@@ -84,9 +116,54 @@ if __name__ == "__main__":
                     label="System Prompt",
                     interactive=True,
                 )
-            with gr.Tab("📝 Writer") as tab_2:
+                with gr.Row():
+                    chat_context_trim_policy_dropdown: setting_components.Dropdown = setting_components.Dropdown(
+                        key="chat/context_trim_policy",
+                        default_value=constants.DEFAULT_SETTINGS["chat"]["context_trim_policy"],
+                        choices=(
+                            "Off",
+                            "Drop Oldest",
+                            "Truncate Oldest",
+                        ),
+                        label="When the Context Is Full",
+                        interactive=True,
+                    )
+                    chat_context_keep_turns_slider: setting_components.Slider = setting_components.Slider(
+                        key="chat/context_keep_turns",
+                        default_value=constants.DEFAULT_SETTINGS["chat"]["context_keep_turns"],
+                        minimum=1.0,
+                        maximum=16.0,
+                        step=1.0,
+                        label="Always Keep Last Turns",
+                        interactive=True,
+                    )
+                    chat_context_reserve_tokens_slider: setting_components.Slider = setting_components.Slider(
+                        key="chat/context_reserve_tokens",
+                        default_value=constants.DEFAULT_SETTINGS["chat"]["context_reserve_tokens"],
+                        minimum=0.0,
+                        maximum=4096.0,
+                        step=16.0,
+                        label="Tokens Reserved for the Response",
+                        interactive=True,
+                    )
+                    chat_prefill_while_typing_checkbox: setting_components.Checkbox = setting_components.Checkbox(
+                        key="chat/prefill_while_typing",
+                        default_value=constants.DEFAULT_SETTINGS["chat"]["prefill_while_typing"],
+                        label="Prefill While Typing",
+                        interactive=True,
+                    )
+                    chat_candidate_count_slider: setting_components.Slider = setting_components.Slider(
+                        key="chat/candidate_count",
+                        default_value=constants.DEFAULT_SETTINGS["chat"]["candidate_count"],
+                        minimum=1.0,
+                        maximum=8.0,
+                        step=1.0,
+                        label="Candidates on Idle Slots",
+                        interactive=True,
+                    )
+            with gr.Tab("📝 Writer"):
                 writer_text_area: gr.TextArea = gr.TextArea(
-                    value=lambda: shared.writer_text,
+                    value=tab_writer.set_text_area,
                     lines=20,
                     label="Your Text Document",
                     interactive=True,
@@ -112,6 +189,7 @@ if __name__ == "__main__":
                     label="Maximum Tokens Per Generation",
                     interactive=True,
                 )
+        startup_report.mark("Building the tabs")
 
         sidebar_l.refresh_model_info_button.click(
             fn=sidebar_l.on_refresh_model_info_button_click,
@@ -125,54 +203,110 @@ if __name__ == "__main__":
             show_progress="hidden",
         )
 
+        sidebar_l.new_chat_button.click(
+            fn=tab_chat.on_new_chat_button_click,
+            inputs=is_chat_busy,
+            outputs=chat_chatbot,
+            show_progress="hidden",
+        ).then(
+            fn=tab_chat.update_chat_status,
+            inputs=sidebar_l.port_number.instance,
+            outputs=(
+                chat_context_status,
+                chat_load_older_button,
+            ),
+            show_progress="hidden",
+        ).then(
+            fn=sidebar_l.update_conversation_dropdown,
+            outputs=sidebar_l.conversation_dropdown,
+            show_progress="hidden",
+        )
+        sidebar_l.conversation_dropdown.input(
+            fn=tab_chat.on_conversation_dropdown_input,
+            inputs=(
+                sidebar_l.conversation_dropdown,
+                is_chat_busy,
+            ),
+            outputs=chat_chatbot,
+            show_progress="hidden",
+        ).then(
+            fn=tab_chat.update_chat_status,
+            inputs=sidebar_l.port_number.instance,
+            outputs=(
+                chat_context_status,
+                chat_load_older_button,
+            ),
+            show_progress="hidden",
+        ).then(
+            fn=sidebar_l.update_conversation_dropdown,
+            outputs=sidebar_l.conversation_dropdown,
+            show_progress="hidden",
+        )
+
+        sidebar_l.delete_conversation_button.click(
+            fn=tab_chat.on_delete_conversation_button_click,
+            inputs=(
+                sidebar_l.conversation_dropdown,
+                is_chat_busy,
+            ),
+            outputs=chat_chatbot,
+            js="(conversation_id, is_chat_busy) => [conversation_id != null && confirm('Delete this conversation and its attachments? This cannot be undone.') ? conversation_id : null, is_chat_busy]",
+            show_progress="hidden",
+        ).then(
+            fn=tab_chat.update_chat_status,
+            inputs=sidebar_l.port_number.instance,
+            outputs=(
+                chat_context_status,
+                chat_load_older_button,
+            ),
+            show_progress="hidden",
+        ).then(
+            fn=sidebar_l.update_conversation_dropdown,
+            outputs=sidebar_l.conversation_dropdown,
+            show_progress="hidden",
+        )
+
+        sidebar_l.server_status_timer.tick(
+            fn=sidebar_l.on_server_status_timer_tick,
+            inputs=sidebar_l.port_number.instance,
+            outputs=(
+                sidebar_l.server_status,
+                sidebar_l.frames_saved_status,
+                sidebar_l.queue_status,
+                sidebar_l.prompt_status,
+                sidebar_l.generation_status,
+            ),
+            show_progress="hidden",
+        )
+
         chat_chatbot.retry(
             fn=tab_chat.on_chatbot_retry,
             outputs=chat_chatbot,
             show_progress="hidden",
         ).then(
-            fn=lm_backend.mark_assistant_as_busy,
+            fn=lm_backend.mark_chat_as_busy,
             outputs=(
-                tab_1,
-                tab_2,
                 chat_textbox,
-                writer_generate_button,
-                is_assistant_busy,
+                is_chat_busy,
             ),
             show_progress="hidden",
         ).then(
             fn=tab_chat.create_assistant_message,
-            inputs=(  # type: ignore
-                sidebar_l.port_number.instance,
-                sidebar_l.stream_responses_checkbox.instance,
-                sidebar_r.temperature_slider.instance,
-                sidebar_r.top_k_slider.instance,
-                sidebar_r.top_p_slider.instance,
-                sidebar_r.min_p_slider.instance,
-                sidebar_r.typical_p_slider.instance,
-                sidebar_r.repetition_penalty_slider.instance,
-                sidebar_r.repetition_penalty_range_slider.instance,
-                sidebar_r.presence_penalty_slider.instance,
-                sidebar_r.frequency_penalty_slider.instance,
-                sidebar_r.mirostat_mode_dropdown.instance,
-                sidebar_r.mirostat_tau_slider.instance,
-                sidebar_r.mirostat_eta_slider.instance,
-                sidebar_r.dry_base_slider.instance,
-                sidebar_r.dry_multiplier_slider.instance,
-                sidebar_r.dry_allowed_length_slider.instance,
-                sidebar_r.dry_penalty_range_slider.instance,
-                sidebar_r.xtc_threshold_slider.instance,
-                sidebar_r.xtc_probability_slider.instance,
-            ),
             outputs=chat_chatbot,
             show_progress="hidden",
         ).then(
-            fn=lm_backend.mark_assistant_as_idle,
+            fn=lm_backend.mark_chat_as_idle,
             outputs=(
-                tab_1,
-                tab_2,
                 chat_textbox,
-                writer_generate_button,
-                is_assistant_busy,
+                is_chat_busy,
+            ),
+            show_progress="hidden",
+        ).then(
+            fn=tab_chat.update_chat_status,
+            inputs=sidebar_l.port_number.instance,
+            outputs=(
+                chat_context_status,
+                chat_load_older_button,
             ),
             show_progress="hidden",
         )
@@ -183,6 +317,54 @@ if __name__ == "__main__":
                 chat_textbox,
             ),
             show_progress="hidden",
+        ).then(
+            fn=tab_chat.update_chat_status,
+            inputs=sidebar_l.port_number.instance,
+            outputs=(
+                chat_context_status,
+                chat_load_older_button,
+            ),
+            show_progress="hidden",
+        )
+        chat_chatbot.edit(
+            fn=tab_chat.on_chatbot_edit,
+            outputs=chat_chatbot,
+            show_progress="hidden",
+        ).then(
+            fn=tab_chat.update_chat_status,
+            inputs=sidebar_l.port_number.instance,
+            outputs=(
+                chat_context_status,
+                chat_load_older_button,
+            ),
+            show_progress="hidden",
+        )
+        chat_load_older_button.click(
+            fn=tab_chat.on_load_older_button_click,
+            outputs=chat_chatbot,
+            show_progress="hidden",
+        ).then(
+            fn=tab_chat.update_chat_status,
+            inputs=sidebar_l.port_number.instance,
+            outputs=(
+                chat_context_status,
+                chat_load_older_button,
+            ),
+            show_progress="hidden",
+        )
+        chat_chatbot.option_select(
+            fn=tab_chat.on_chatbot_option_select,
+            inputs=is_chat_busy,
+            outputs=chat_chatbot,
+            show_progress="hidden",
+        ).then(
+            fn=tab_chat.update_chat_status,
+            inputs=sidebar_l.port_number.instance,
+            outputs=(
+                chat_context_status,
+                chat_load_older_button,
+            ),
+            show_progress="hidden",
         )
         chat_chatbot.example_select(
             fn=tab_chat.on_chatbot_example_select,
@@ -191,88 +373,88 @@ if __name__ == "__main__":
         )
         chat_chatbot.clear(
             fn=tab_chat.on_chatbot_clear,
-            inputs=is_assistant_busy,
+            inputs=is_chat_busy,
             outputs=chat_chatbot,
             show_progress="hidden",
+        ).then(
+            fn=tab_chat.update_chat_status,
+            inputs=sidebar_l.port_number.instance,
+            outputs=(
+                chat_context_status,
+                chat_load_older_button,
+            ),
+            show_progress="hidden",
+        ).then(
+            fn=sidebar_l.update_conversation_dropdown,
+            outputs=sidebar_l.conversation_dropdown,
+            show_progress="hidden",
         )
         chat_textbox.submit(
             fn=tab_chat.create_user_message,
             inputs=(
                 chat_textbox,
                 chat_system_prompt_text_area.instance,  # type: ignore
-                is_assistant_busy,
+                is_chat_busy,
             ),
             outputs=(
                 chat_chatbot,
                 chat_textbox,
-                is_assistant_busy,
+                is_chat_busy,
             ),
             show_progress="hidden",
         ).success(
-            fn=lm_backend.mark_assistant_as_busy,
+            fn=lm_backend.mark_chat_as_busy,
             outputs=(
-                tab_1,
-                tab_2,
                 chat_textbox,
-                writer_generate_button,
-                is_assistant_busy,
+                is_chat_busy,
             ),
             show_progress="hidden",
         ).then(
             fn=tab_chat.create_assistant_message,
-            inputs=(  # type: ignore
-                sidebar_l.port_number.instance,
-                sidebar_l.stream_responses_checkbox.instance,
-                sidebar_r.temperature_slider.instance,
-                sidebar_r.top_k_slider.instance,
-                sidebar_r.top_p_slider.instance,
-                sidebar_r.min_p_slider.instance,
-                sidebar_r.typical_p_slider.instance,
-                sidebar_r.repetition_penalty_slider.instance,
-                sidebar_r.repetition_penalty_range_slider.instance,
-                sidebar_r.presence_penalty_slider.instance,
-                sidebar_r.frequency_penalty_slider.instance,
-                sidebar_r.mirostat_mode_dropdown.instance,
-                sidebar_r.mirostat_tau_slider.instance,
-                sidebar_r.mirostat_eta_slider.instance,
-                sidebar_r.dry_base_slider.instance,
-                sidebar_r.dry_multiplier_slider.instance,
-                sidebar_r.dry_allowed_length_slider.instance,
-                sidebar_r.dry_penalty_range_slider.instance,
-                sidebar_r.xtc_threshold_slider.instance,
-                sidebar_r.xtc_probability_slider.instance,
-            ),
             outputs=chat_chatbot,
             show_progress="hidden",
         ).then(
-            fn=lm_backend.mark_assistant_as_idle,
+            fn=lm_backend.mark_chat_as_idle,
             outputs=(
-                tab_1,
-                tab_2,
                 chat_textbox,
-                writer_generate_button,
-                is_assistant_busy,
+                is_chat_busy,
+            ),
+            show_progress="hidden",
+        ).then(
+            fn=tab_chat.update_chat_status,
+            inputs=sidebar_l.port_number.instance,
+            outputs=(
+                chat_context_status,
+                chat_load_older_button,
             ),
             show_progress="hidden",
+        ).then(
+            fn=sidebar_l.update_conversation_dropdown,
+            outputs=sidebar_l.conversation_dropdown,
+            show_progress="hidden",
+        )
+        # Not queued, since these fire on every keystroke and return right away.
+        gr.on(
+            triggers=[chat_textbox.focus, chat_textbox.input],
+            fn=tab_chat.on_chat_textbox_input,
+            queue=False,
+            show_progress="hidden",
         )
         chat_textbox.stop(
-            fn=lm_backend.stop_assistant_task,
-            inputs=is_assistant_busy,
-            outputs=is_assistant_busy,
+            fn=lm_backend.stop_chat_task,
+            inputs=is_chat_busy,
+            outputs=is_chat_busy,
         )
 
         writer_generate_event = writer_generate_button.click(
             fn=tab_writer.on_generate_button_click,
-            inputs=is_assistant_busy,
+            inputs=is_writer_busy,
         )
         writer_generate_event.success(
-            fn=lm_backend.mark_assistant_as_busy,
+            fn=lm_backend.mark_writer_as_busy,
             outputs=(
-                tab_1,
-                tab_2,
-                chat_textbox,
                 writer_generate_button,
-                is_assistant_busy,
+                is_writer_busy,
             ),
             show_progress="hidden",
         ).then(
@@ -281,30 +463,7 @@ if __name__ == "__main__":
             show_progress="hidden",
         ).then(
             fn=tab_writer.generate_text,
-            inputs=(  # type: ignore
-                writer_text_area,
-                sidebar_l.port_number.instance,
-                sidebar_l.stream_responses_checkbox.instance,
-                sidebar_r.temperature_slider.instance,
-                sidebar_r.top_k_slider.instance,
-                sidebar_r.top_p_slider.instance,
-                sidebar_r.min_p_slider.instance,
-                sidebar_r.typical_p_slider.instance,
-                sidebar_r.repetition_penalty_slider.instance,
-                sidebar_r.repetition_penalty_range_slider.instance,
-                sidebar_r.presence_penalty_slider.instance,
-                sidebar_r.frequency_penalty_slider.instance,
-                sidebar_r.mirostat_mode_dropdown.instance,
-                sidebar_r.mirostat_tau_slider.instance,
-                sidebar_r.mirostat_eta_slider.instance,
-                sidebar_r.dry_base_slider.instance,
-                sidebar_r.dry_multiplier_slider.instance,
-                sidebar_r.dry_allowed_length_slider.instance,
-                sidebar_r.dry_penalty_range_slider.instance,
-                sidebar_r.xtc_threshold_slider.instance,
-                sidebar_r.xtc_probability_slider.instance,
-                writer_max_tokens_slider.instance,
-            ),
+            inputs=writer_text_area,
             outputs=writer_text_area,
             show_progress="hidden",
         ).then(
@@ -312,43 +471,49 @@ if __name__ == "__main__":
             outputs=writer_text_area,
             show_progress="hidden",
         ).then(
-            fn=lm_backend.mark_assistant_as_idle,
+            fn=lm_backend.mark_writer_as_idle,
             outputs=(
-                tab_1,
-                tab_2,
-                chat_textbox,
                 writer_generate_button,
-                is_assistant_busy,
+                is_writer_busy,
             ),
             show_progress="hidden",
         )
         writer_generate_event.failure(
-            fn=lm_backend.stop_assistant_task,
-            inputs=is_assistant_busy,
-            outputs=is_assistant_busy,
+            fn=lm_backend.stop_writer_task,
+            inputs=is_writer_busy,
+            outputs=is_writer_busy,
         )
         writer_clear_button.click(
             fn=tab_writer.on_clear_button_click,
-            inputs=is_assistant_busy,
+            inputs=is_writer_busy,
             outputs=writer_text_area,
             show_progress="hidden",
         )
 
         demo.load(
-            fn=on_demo_load_1,
-            outputs=shared.setting_components,
-            show_progress="hidden",
-        ).then(
-            fn=on_demo_load_2,
-            inputs=sidebar_r.mirostat_mode_dropdown.instance,
+            fn=on_demo_load,
             outputs=(  # type: ignore
+                *shared.setting_components,
                 sidebar_l.vision_status,
                 sidebar_l.audio_status,
-                sidebar_r.mirostat_tau_slider.instance,
-                sidebar_r.mirostat_eta_slider.instance,
                 chat_textbox,
+                sidebar_l.conversation_dropdown,
+            ),
+            show_progress="hidden",
+        ).then(
+            fn=tab_chat.update_chat_status,
+            inputs=sidebar_l.port_number.instance,
+            outputs=(
+                chat_context_status,
+                chat_load_older_button,
             ),
             show_progress="hidden",
         )
 
-    demo.launch(inbrowser=True, server_port=6969)
+        demo.unload(sessions.remove)
+        startup_report.mark("Registering events")
+    startup_report.mark("Finishing the Gradio app")
+
+    profiler.install(demo)
+    demo.queue(default_concurrency_limit=settings.get_key("app/concurrency_limit", constants.DEFAULT_SETTINGS["app"]["concurrency_limit"]))
+    demo.launch(inbrowser=True, server_port=6969, allowed_paths=[constants.DATA_DIR_PATH], app_kwargs={"lifespan": lifespan})
@@ -0,0 +1,84 @@
+from typing import Any
+from collections import OrderedDict
+import os
+import base64
+
+from modules.core import constants
+from modules import settings
+
+
+# (path, modification time, size) -> (message content, approximate size in bytes)
+__entries: OrderedDict[tuple[str, int, int], tuple[str | list[dict[str, Any]], int]] = OrderedDict()
+__total_bytes: int = 0
+
+
+def is_supported(path: str) -> bool:
+    file_extension: str = os.path.splitext(path)[1]
+    return file_extension in constants.GENERIC_FILE_EXTENSIONS or file_extension in constants.IMAGE_FILE_EXTENSIONS or file_extension in constants.AUDIO_FILE_EXTENSIONS
+
+
+# Images and audio are counted as a fixed number of tokens, so they needn't be read for that.
+def is_media(path: str) -> bool:
+    file_extension: str = os.path.splitext(path)[1]
+    return file_extension in constants.IMAGE_FILE_EXTENSIONS or file_extension in constants.AUDIO_FILE_EXTENSIONS
+
+
+def get_message_content(path: str) -> str | list[dict[str, Any]] | None:
+    global __total_bytes
+
+    if not is_supported(path):
+        return None
+    file_extension: str = os.path.splitext(path)[1]
+
+    # Attachments of stored conversations may have been deleted since.
+    try:
+        stat: os.stat_result = os.stat(path)
+    except OSError:
+        return None
+    key: tuple[str, int, int] = (path, stat.st_mtime_ns, stat.st_size)
+
+    entry: tuple[str | list[dict[str, Any]], int] | None = __entries.get(key)
+    if entry is not None:
+        __entries.move_to_end(key)
+        return entry[0]
+
+    content: str | list[dict[str, Any]]
+    content_size: int
+    if file_extension in constants.GENERIC_FILE_EXTENSIONS:
+        with open(path, "rt", encoding="utf-8") as file:
+            content = f"`{os.path.basename(path)}`:\n\n```\n{file.read()}\n```"
+        content_size = len(content)
+    elif file_extension in constants.IMAGE_FILE_EXTENSIONS:
+        with open(path, "rb") as file:
+            encoded_data: str = base64.b64encode(file.read()).decode()
+        content = [
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:image/{file_extension[1:]};base64,{encoded_data}"
+                },
+            },
+        ]
+        content_size = len(encoded_data)
+    else:
+        with open(path, "rb") as file:
+            encoded_data = base64.b64encode(file.read()).decode()
+        content = [
+            {
+                "type": "input_audio",
+                "input_audio": {
+                    "data": encoded_data,
+                    "format": file_extension[1:],
+                }
+            },
+        ]
+        content_size = len(encoded_data)
+
+    max_bytes: int = settings.get_key("chat/attachment_cache_megabytes", constants.DEFAULT_SETTINGS["chat"]["attachment_cache_megabytes"]) * 1024 * 1024
+    if content_size <= max_bytes:
+        __entries[key] = (content, content_size)
+        __total_bytes += content_size
+        while __total_bytes > max_bytes:
+            _, (_, evicted_size) = __entries.popitem(last=False)
+            __total_bytes -= evicted_size
+    return content
@@ -0,0 +1,200 @@
+from typing import Any
+from collections.abc import Iterator
+from collections import OrderedDict
+import copy
+import os
+
+import asyncio
+import httpx
+
+from modules.core import constants
+from modules import settings
+from modules import lm_backend
+from modules import conversation
+from modules import attachment_cache
+
+
+# Rough per-message cost of the chat template (role markers, separators, etc).
+MESSAGE_TOKEN_OVERHEAD: int = 8
+# /tokenize can't count images or audio, so each one is assumed to cost this much.
+MEDIA_TOKEN_ESTIMATE: int = 1024
+TOKEN_COUNT_CACHE_SIZE: int = 4096
+# For when the server can't count (e.g., it's too busy). Rather too many than too few.
+BYTES_PER_TOKEN_ESTIMATE: int = 3
+
+# (Base URL, text) -> token count, least recently used first.
+__token_counts: OrderedDict[tuple[str, str], int] = OrderedDict()
+# Counting a whole loaded conversation at once would otherwise take every pooled connection.
+__tokenize_semaphore: asyncio.Semaphore | None = None
+
+
+async def count_tokens(base_url: str, text: str) -> int:
+    key: tuple[str, str] = (base_url, text)
+    token_count: int | None = __token_counts.get(key)
+    if token_count is not None:
+        __token_counts.move_to_end(key)
+        return token_count
+
+    async with __get_tokenize_semaphore():
+        response: httpx.Response = await lm_backend.get_client().request("POST", f"{base_url}/tokenize", json={"content": text})
+    token_count = len(response.json()["tokens"])
+    __token_counts[key] = token_count
+    while len(__token_counts) > TOKEN_COUNT_CACHE_SIZE:
+        __token_counts.popitem(last=False)
+    return token_count
+
+
+# Attachments may be left as {"role", "attachment_path"}. Images and audio are then counted without reading them.
+async def count_message_tokens(base_url: str, message: dict[str, Any]) -> int:
+    if "attachment_path" in message:
+        if attachment_cache.is_media(message["attachment_path"]):
+            return MESSAGE_TOKEN_OVERHEAD + MEDIA_TOKEN_ESTIMATE if os.path.exists(message["attachment_path"]) else 0
+        attachment_content: str | list[dict[str, Any]] | None = attachment_cache.get_message_content(message["attachment_path"])
+        if attachment_content is None:
+            return 0
+        message = {"role": message["role"], "content": attachment_content}
+
+    content: str | list[dict[str, Any]] = message["content"]
+    if isinstance(content, str):
+        return MESSAGE_TOKEN_OVERHEAD + await count_tokens(base_url, content)
+
+    token_count: int = MESSAGE_TOKEN_OVERHEAD
+    for part in content:
+        if part.get("type") == "text":
+            token_count += await count_tokens(base_url, part["text"])
+        else:
+            token_count += MEDIA_TOKEN_ESTIMATE
+    return token_count
+
+
+def estimate_message_tokens(message: dict[str, Any]) -> int:
+    content: str | list[dict[str, Any]] = message["content"]
+    if isinstance(content, str):
+        return MESSAGE_TOKEN_OVERHEAD + len(content.encode()) // BYTES_PER_TOKEN_ESTIMATE + 1
+
+    token_count: int = MESSAGE_TOKEN_OVERHEAD
+    for part in content:
+        if part.get("type") == "text":
+            token_count += len(part["text"].encode()) // BYTES_PER_TOKEN_ESTIMATE + 1
+        else:
+            token_count += MEDIA_TOKEN_ESTIMATE
+    return token_count
+
+
+# Only messages that are new or changed since the last call are counted. Those that fail
+# to be counted are left out of the total until a later call counts them.
+async def count_conversation_tokens(base_url: str, chat_conversation: conversation.Conversation) -> int:
+    uncounted_messages: list[tuple[int, Any, dict[str, Any]]] = chat_conversation.get_uncounted_request_messages(base_url)
+    if len(uncounted_messages) > 0:
+        token_counts: list[int | None] = await __try_count_messages(base_url, [message for _, _, message in uncounted_messages])
+        for (index, counted_value, _), token_count in zip(uncounted_messages, token_counts):
+            if token_count is not None:
+                chat_conversation.set_token_count(base_url, index, counted_value, token_count)
+    return chat_conversation.token_count
+
+
+# Returns the messages to send (possibly trimmed according to the chat settings), or None
+# if they can't fit into the context no matter what and so shouldn't be sent at all.
+# `token_counts` are counts already known on `base_url` (None where not), e.g., a conversation's.
+async def fit_messages(base_url: str, messages: list[dict[str, Any]], reserved_tokens: int | None = None, token_counts: list[int | None] | None = None) -> list[dict[str, Any]] | None:
+    context_size: int | None = lm_backend.get_context_size(base_url)
+    if context_size is None:
+        return messages
+
+    if reserved_tokens is None:
+        reserved_tokens = settings.get_key("chat/context_reserve_tokens", constants.DEFAULT_SETTINGS["chat"]["context_reserve_tokens"])
+    token_budget: int = context_size - reserved_tokens
+    known_token_counts: list[int | None] = token_counts if token_counts is not None and len(token_counts) == len(messages) else [None] * len(messages)
+    # Counts that fail are estimated, so trimming still works (roughly) when the server is busy.
+    uncounted_messages: list[dict[str, Any]] = [message for message, token_count in zip(messages, known_token_counts) if token_count is None]
+    counted_token_counts: Iterator[int | None] = iter(await __try_count_messages(base_url, uncounted_messages))
+    message_token_counts: list[int] = []
+    for message, token_count in zip(messages, known_token_counts):
+        if token_count is None:
+            token_count = next(counted_token_counts)
+        message_token_counts.append(token_count if token_count is not None else estimate_message_tokens(message))
+    if sum(message_token_counts) <= token_budget:
+        return messages
+
+    trim_policy: str = settings.get_key("chat/context_trim_policy", constants.DEFAULT_SETTINGS["chat"]["context_trim_policy"])
+    if trim_policy == "Off":
+        return None
+
+    # The system prompt and the last N turns (each starting at a user message) are never trimmed.
+    keep_turns: int = settings.get_key("chat/context_keep_turns", constants.DEFAULT_SETTINGS["chat"]["context_keep_turns"])
+    first_trimmable_index: int = 1 if len(messages) > 0 and messages[0]["role"] == "system" else 0
+    turn_start_indices: list[int] = [
+        index for index in range(first_trimmable_index, len(messages))
+        if messages[index]["role"] == "user" and (index == first_trimmable_index or messages[index - 1]["role"] != "user")
+    ]
+    protected_index: int = first_trimmable_index
+    if keep_turns <= 0:
+        protected_index = len(messages)
+    elif len(turn_start_indices) > keep_turns:
+        protected_index = turn_start_indices[-keep_turns]
+
+    # Whole turns are dropped (a user message up to the next one), oldest first, so the
+    # messages after the system prompt still start with a user message and alternate, which
+    # many chat templates require. Anything before the first turn always goes.
+    trimmed_messages: list[dict[str, Any]] = messages[:first_trimmable_index]
+    excess_tokens: int = sum(message_token_counts) - token_budget
+    first_turn_index: int = turn_start_indices[0] if len(turn_start_indices) > 0 else protected_index
+    excess_tokens -= sum(message_token_counts[first_trimmable_index:min(first_turn_index, protected_index)])
+    trimmable_turn_starts: list[int] = [index for index in turn_start_indices if index < protected_index]
+    for turn_start_index, turn_end_index in zip(trimmable_turn_starts, trimmable_turn_starts[1:] + [protected_index]):
+        if excess_tokens <= 0:
+            trimmed_messages += messages[turn_start_index:turn_end_index]
+            continue
+
+        # Only the user message the kept messages now start with is truncated. If that fails, the turn is dropped instead.
+        truncated_text: str | None = None
+        if trim_policy == "Truncate Oldest" and isinstance(messages[turn_start_index]["content"], str) and message_token_counts[turn_start_index] - MESSAGE_TOKEN_OVERHEAD > excess_tokens:
+            truncated_text = await __keep_last_tokens(base_url, messages[turn_start_index]["content"], message_token_counts[turn_start_index] - MESSAGE_TOKEN_OVERHEAD - excess_tokens)
+        if truncated_text is not None:
+            truncated_message: dict[str, Any] = copy.copy(messages[turn_start_index])
+            truncated_message["content"] = truncated_text
+            trimmed_messages.append(truncated_message)
+            trimmed_messages += messages[turn_start_index + 1:turn_end_index]
+            excess_tokens = 0
+        else:
+            excess_tokens -= sum(message_token_counts[turn_start_index:turn_end_index])
+    if excess_tokens > 0:
+        return None
+    trimmed_messages += messages[protected_index:]
+
+    return trimmed_messages
+
+
+# None for each message that couldn't be counted.
+async def __try_count_messages(base_url: str, messages: list[dict[str, Any]]) -> list[int | None]:
+    results: list[int | BaseException] = await asyncio.gather(*(count_message_tokens(base_url, message) for message in messages), return_exceptions=True)
+    token_counts: list[int | None] = []
+    for result in results:
+        if isinstance(result, (httpx.HTTPError, httpx.InvalidURL, ValueError, KeyError)):
+            token_counts.append(None)
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            token_counts.append(result)
+    return token_counts
+
+
+def __get_tokenize_semaphore() -> asyncio.Semaphore:
+    global __tokenize_semaphore
+
+    if __tokenize_semaphore is None:
+        max_connections: int = settings.get_key("network/max_connections", constants.DEFAULT_SETTINGS["network"]["max_connections"])
+        __tokenize_semaphore = asyncio.Semaphore(max(1, max_connections // 2))
+    return __tokenize_semaphore
+
+
+async def __keep_last_tokens(base_url: str, text: str, token_count: int) -> str | None:
+    client: httpx.AsyncClient = lm_backend.get_client()
+    try:
+        async with __get_tokenize_semaphore():
+            response: httpx.Response = await client.request("POST", f"{base_url}/tokenize", json={"content": text})
+            tokens: list[int] = response.json()["tokens"]
+            response = await client.request("POST", f"{base_url}/detokenize", json={"tokens": tokens[len(tokens) - token_count:]})
+        return response.json()["content"]
+    except (httpx.HTTPError, httpx.InvalidURL, ValueError, KeyError):
+        return None
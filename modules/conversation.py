@@ -0,0 +1,276 @@
+from typing import Any
+import os
+
+import gradio as gr
+
+from modules.core import constants
+from modules import settings
+from modules import attachment_cache
+from modules import conversation_store
+
+
+TITLE_LENGTH: int = 48
+
+
+class Conversation:
+    def __init__(self, conversation_id: int | None = None) -> None:
+        # Row ID in the conversation store, or None until the conversation is first saved.
+        self.id: int | None = conversation_id
+        self.history: list[gr.ChatMessage] = []
+        # Mirrors `history` one-to-one with the OpenAI-format message sent for each
+        # entry, or None if that entry is not sent (empty system prompt, unsupported file).
+        # Attachments are only kept as {"role", "attachment_path"} and their content is
+        # looked up in the attachment cache when sent, so it stays within the cache's budget.
+        self._request_messages: list[dict[str, Any] | None] = []
+        # Token count of each request message, or None until counted (and again once it changes).
+        self._token_counts: list[int | None] = []
+        self.token_count: int = 0
+        # The server the token counts came from. Another one may tokenize differently.
+        self._token_count_base_url: str | None = None
+        # The (base URL, slot ID) that last processed this conversation and so holds its prompt cache.
+        self.slot: tuple[str, int] | None = None
+        # Bumped on every change to the messages.
+        self.version: int = 0
+        # The (version, system prompt) last prefilled into the cache of `slot` while the user was typing.
+        self.prefilled_state: tuple[int, str] | None = None
+        # Messages before this index are already in the conversation store as they are.
+        self._first_unsaved_index: int = 0
+        self._saved_length: int = 0
+        # What the chatbot is sent for each entry, built on first render and dropped when the entry changes.
+        self._rendered_messages: list[gr.MessageDict | None] = []
+        # How many of the most recent messages the chatbot shows.
+        self.render_window: int = get_render_window_step()
+
+    def __len__(self) -> int:
+        return len(self.history)
+
+    def append(self, message: gr.ChatMessage) -> None:
+        self.history.append(message)
+        self._request_messages.append(self.__to_request_message(message))
+        self._token_counts.append(None)
+        self._rendered_messages.append(None)
+        self.__mark_unsaved(len(self.history) - 1)
+        self.version += 1
+
+    def pop(self) -> gr.ChatMessage:
+        self.__invalidate_token_count(len(self.history) - 1)
+        self._token_counts.pop()
+        self._rendered_messages.pop()
+        self._request_messages.pop()
+        self.__mark_unsaved(len(self.history) - 1)
+        self.version += 1
+        return self.history.pop()
+
+    def set_system_prompt(self, system_prompt: str) -> None:
+        if len(self.history) == 0:
+            self.append(gr.ChatMessage(system_prompt, "system"))
+        elif self.history[0].content != system_prompt:
+            self.set_content(0, system_prompt)
+
+    def set_content(self, index: int, content: str) -> None:
+        self.history[index].content = content
+        self._request_messages[index] = self.__to_request_message(self.history[index])
+        self._rendered_messages[index] = None
+        self.__invalidate_token_count(index)
+        self.__mark_unsaved(index)
+        self.version += 1
+
+    def set_last_content(self, content: str) -> None:
+        self.set_content(len(self.history) - 1, content)
+
+    # Options are shown under the last assistant message only, and aren't saved.
+    def set_options(self, index: int, options: list[dict[str, str]]) -> None:
+        self.history[index].options = options
+        self._rendered_messages[index] = None
+
+    def extend_last_content(self, content: str) -> None:
+        self.__invalidate_token_count(len(self.history) - 1)
+        self.__mark_unsaved(len(self.history) - 1)
+        self.version += 1
+        self.history[-1].content += content  # type: ignore
+        request_message: dict[str, Any] | None = self._request_messages[-1]
+        if request_message is not None:
+            request_message["content"] += content
+        else:
+            self._request_messages[-1] = self.__to_request_message(self.history[-1])
+        rendered_message: gr.MessageDict | None = self._rendered_messages[-1]
+        if rendered_message is not None:
+            rendered_message["content"] = self.history[-1].content  # type: ignore
+
+    # The request messages and the token count of each, or None where it isn't counted yet on `base_url`.
+    # With `system_prompt`, they are as set_system_prompt would make them, but the conversation is left as it is.
+    def get_request_messages_with_token_counts(self, base_url: str | None, system_prompt: str | None = None) -> tuple[list[dict[str, Any]], list[int | None]]:
+        request_messages: list[dict[str, Any] | None] = self._request_messages
+        token_counts: list[int | None] = self._token_counts if base_url == self._token_count_base_url else [None] * len(self._token_counts)
+        if system_prompt is not None and (len(self.history) == 0 or self.history[0].content != system_prompt):
+            # The first message is always the system prompt (if there are any messages yet).
+            request_messages = [self.__to_request_message(gr.ChatMessage(system_prompt, "system"))] + request_messages[1:]
+            token_counts = [None] + token_counts[1:]
+
+        messages: list[dict[str, Any]] = []
+        message_token_counts: list[int | None] = []
+        for request_message, token_count in zip(request_messages, token_counts):
+            message: dict[str, Any] | None = self.__resolve_request_message(request_message)
+            if message is not None:
+                messages.append(message)
+                message_token_counts.append(token_count)
+        return messages, message_token_counts
+
+    # Index of the first message the chatbot shows. Chatbot event indices are relative to it.
+    def get_render_start(self) -> int:
+        return max(0, len(self.history) - self.render_window)
+
+    def get_hidden_message_count(self) -> int:
+        return self.get_render_start()
+
+    def get_rendered_history(self) -> list[gr.MessageDict]:
+        rendered_history: list[gr.MessageDict] = []
+        for index in range(self.get_render_start(), len(self.history)):
+            rendered_message: gr.MessageDict | None = self._rendered_messages[index]
+            if rendered_message is None:
+                message: gr.ChatMessage = self.history[index]
+                rendered_message = {
+                    "role": message.role,
+                    "content": message.content,  # type: ignore
+                    "metadata": message.metadata,
+                    "options": message.options,
+                }
+                self._rendered_messages[index] = rendered_message
+            rendered_history.append(rendered_message)
+        return rendered_history
+
+    def load_older_messages(self) -> None:
+        self.render_window = min(self.render_window, len(self.history)) + get_render_window_step()
+
+    # (Index, what is counted, the message to count) of each request message without a count.
+    # Attachments are left as {"role", "attachment_path"}, which context_manager counts as they are.
+    def get_uncounted_request_messages(self, base_url: str) -> list[tuple[int, Any, dict[str, Any]]]:
+        if base_url != self._token_count_base_url:
+            for index in range(len(self._token_counts)):
+                self.__invalidate_token_count(index)
+            self._token_count_base_url = base_url
+
+        uncounted_messages: list[tuple[int, Any, dict[str, Any]]] = []
+        for index, request_message in enumerate(self._request_messages):
+            if request_message is not None and self._token_counts[index] is None:
+                uncounted_messages.append((index, self.__get_counted_value(request_message), request_message))
+        return uncounted_messages
+
+    # `counted_value` is what get_uncounted_request_messages said was counted. The count is dropped
+    # if that message has changed or gone away in the meantime (counting happens over the network).
+    def set_token_count(self, base_url: str, index: int, counted_value: Any, token_count: int) -> None:
+        if base_url != self._token_count_base_url or index >= len(self._request_messages):
+            return
+        request_message: dict[str, Any] | None = self._request_messages[index]
+        if request_message is None or self.__get_counted_value(request_message) is not counted_value:
+            return
+        self.__invalidate_token_count(index)
+        self._token_counts[index] = token_count
+        self.token_count += token_count
+
+    # Forgets the stored copy (e.g., because it was deleted), so the next save stores everything anew.
+    def detach(self) -> None:
+        self.id = None
+        self._first_unsaved_index = 0
+        self._saved_length = 0
+
+    # Writes only the messages that changed since the last save. A conversation is
+    # not stored until it has something besides the system prompt.
+    def save(self) -> None:
+        if self.id is None:
+            title: str | None = self.__get_title()
+            if title is None:
+                return
+            self.id = conversation_store.create_conversation(title)
+        elif self._first_unsaved_index == len(self.history) == self._saved_length:
+            return
+
+        rows: list[tuple[str, str, str | None]] = []
+        for position in range(self._first_unsaved_index, len(self.history)):
+            message: gr.ChatMessage = self.history[position]
+            if isinstance(message.content, gr.FileData):  # type: ignore
+                try:
+                    message.content.path = conversation_store.store_attachment(self.id, position, message.content.path)
+                except OSError:
+                    pass
+                # Same file content, so the token count still holds.
+                request_message: dict[str, Any] | None = self._request_messages[position]
+                if request_message is not None:
+                    request_message["attachment_path"] = message.content.path
+                rows.append((message.role, message.content.path, message.content.orig_name))
+            else:
+                rows.append((message.role, str(message.content), None))  # type: ignore
+        conversation_store.save_messages(self.id, self._first_unsaved_index, rows)
+        self.mark_saved()
+
+    # Tells the conversation its messages are in the conversation store as they are (e.g., just loaded from it).
+    def mark_saved(self) -> None:
+        self._first_unsaved_index = len(self.history)
+        self._saved_length = len(self.history)
+
+    def __get_title(self) -> str | None:
+        for message in self.history:
+            if message.role == "user" and isinstance(message.content, str) and message.content.strip() != "":  # type: ignore
+                title: str = " ".join(message.content.split())
+                return title if len(title) <= TITLE_LENGTH else f"{title[:TITLE_LENGTH - 1]}…"
+        for message in self.history:
+            if message.role == "user" and isinstance(message.content, gr.FileData):  # type: ignore
+                return message.content.orig_name or os.path.basename(message.content.path)
+        return None
+
+    def __mark_unsaved(self, index: int) -> None:
+        self._first_unsaved_index = min(self._first_unsaved_index, index)
+
+    def __invalidate_token_count(self, index: int) -> None:
+        token_count: int | None = self._token_counts[index]
+        if token_count is not None:
+            self.token_count -= token_count
+            self._token_counts[index] = None
+
+    @staticmethod
+    def __to_request_message(message: gr.ChatMessage) -> dict[str, Any] | None:
+        if isinstance(message.content, str):  # type: ignore
+            if message.role == "system" and message.content.rstrip() == "":
+                return None
+            return {
+                "role": message.role,
+                "content": message.content,
+            }
+        elif isinstance(message.content, gr.FileData) and attachment_cache.is_supported(message.content.path):  # type: ignore
+            return {
+                "role": message.role,
+                "attachment_path": message.content.path,
+            }
+        return None
+
+    # None if it's an attachment that can't be read (anymore).
+    @staticmethod
+    def __resolve_request_message(request_message: dict[str, Any] | None) -> dict[str, Any] | None:
+        if request_message is None or "attachment_path" not in request_message:
+            return request_message
+        content: str | list[dict[str, Any]] | None = attachment_cache.get_message_content(request_message["attachment_path"])
+        if content is None:
+            return None
+        return {
+            "role": request_message["role"],
+            "content": content,
+        }
+
+    @staticmethod
+    def __get_counted_value(request_message: dict[str, Any]) -> Any:
+        return request_message["attachment_path"] if "attachment_path" in request_message else request_message["content"]
+
+
+def get_render_window_step() -> int:
+    return settings.get_key("chat/render_window", constants.DEFAULT_SETTINGS["chat"]["render_window"])
+
+
+def load(conversation_id: int) -> Conversation:
+    loaded_conversation: Conversation = Conversation(conversation_id)
+    for role, content, file_name in conversation_store.load_messages(conversation_id):
+        if file_name is not None:
+            loaded_conversation.append(gr.ChatMessage(gr.FileData(path=content, orig_name=file_name), role))  # type: ignore
+        else:
+            loaded_conversation.append(gr.ChatMessage(content, role))  # type: ignore
+    loaded_conversation.mark_saved()
+    return loaded_conversation
@@ -0,0 +1,107 @@
+from typing import Any
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from modules.core import constants
+
+
+__connection: sqlite3.Connection | None = None
+# Sync handlers run on Gradio's worker threads, async ones on the event loop.
+__lock: threading.Lock = threading.Lock()
+
+
+def get_connection() -> sqlite3.Connection:
+    global __connection
+
+    if __connection is None:
+        os.makedirs(constants.DATA_DIR_PATH, exist_ok=True)
+        __connection = sqlite3.connect(f"{constants.DATA_DIR_PATH}{constants.CONVERSATIONS_FILENAME}", check_same_thread=False)
+        __connection.execute("PRAGMA journal_mode=WAL")
+        __connection.execute("PRAGMA synchronous=NORMAL")
+        __connection.execute("PRAGMA foreign_keys=ON")
+        __connection.executescript("""
+            CREATE TABLE IF NOT EXISTS conversations (
+                id INTEGER PRIMARY KEY,
+                title TEXT NOT NULL,
+                updated_time REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS conversations_by_updated_time ON conversations (updated_time);
+            CREATE TABLE IF NOT EXISTS messages (
+                conversation_id INTEGER NOT NULL REFERENCES conversations (id) ON DELETE CASCADE,
+                position INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                file_name TEXT,
+                PRIMARY KEY (conversation_id, position)
+            ) WITHOUT ROWID;
+        """)
+    return __connection
+
+
+def close() -> None:
+    global __connection
+
+    with __lock:
+        if __connection is not None:
+            __connection.close()
+            __connection = None
+
+
+def create_conversation(title: str) -> int:
+    with __lock:
+        connection: sqlite3.Connection = get_connection()
+        with connection:
+            cursor: sqlite3.Cursor = connection.execute("INSERT INTO conversations (title, updated_time) VALUES (?, ?)", (title, time.time()))
+        return cursor.lastrowid  # type: ignore
+
+
+def list_conversations(limit: int) -> list[tuple[int, str]]:
+    with __lock:
+        rows: list[Any] = get_connection().execute("SELECT id, title FROM conversations ORDER BY updated_time DESC LIMIT ?", (limit,)).fetchall()
+    return [(row[0], row[1]) for row in rows]
+
+
+# Rows are (role, content, file name), where `content` is the file path for attachments.
+def load_messages(conversation_id: int) -> list[tuple[str, str, str | None]]:
+    with __lock:
+        rows: list[Any] = get_connection().execute("SELECT role, content, file_name FROM messages WHERE conversation_id = ? ORDER BY position", (conversation_id,)).fetchall()
+    return [(row[0], row[1], row[2]) for row in rows]
+
+
+# Replaces every message from `first_position` on, leaving the ones before it untouched.
+def save_messages(conversation_id: int, first_position: int, messages: list[tuple[str, str, str | None]]) -> None:
+    with __lock:
+        connection: sqlite3.Connection = get_connection()
+        with connection:
+            connection.execute("DELETE FROM messages WHERE conversation_id = ? AND position >= ?", (conversation_id, first_position))
+            connection.executemany(
+                "INSERT INTO messages (conversation_id, position, role, content, file_name) VALUES (?, ?, ?, ?, ?)",
+                [(conversation_id, first_position + offset, *message) for offset, message in enumerate(messages)],
+            )
+            connection.execute("UPDATE conversations SET updated_time = ? WHERE id = ?", (time.time(), conversation_id))
+
+
+def delete_conversation(conversation_id: int) -> None:
+    with __lock:
+        connection: sqlite3.Connection = get_connection()
+        with connection:
+            connection.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+    shutil.rmtree(get_attachment_dir_path(conversation_id), ignore_errors=True)
+
+
+def get_attachment_dir_path(conversation_id: int) -> str:
+    return f"{constants.DATA_DIR_PATH}{constants.ATTACHMENTS_DIRNAME}{conversation_id}/"
+
+
+# Uploads live in Gradio's temporary directory, so they are copied next to the
+# conversation to survive restarts. Returns the path of the copy.
+def store_attachment(conversation_id: int, position: int, path: str) -> str:
+    attachment_dir_path: str = get_attachment_dir_path(conversation_id)
+    stored_path: str = f"{attachment_dir_path}{position}_{os.path.basename(path)}"
+    if os.path.abspath(path) != os.path.abspath(stored_path):
+        os.makedirs(attachment_dir_path, exist_ok=True)
+        shutil.copyfile(path, stored_path)
+    return stored_path
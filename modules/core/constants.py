@@ -4,8 +4,12 @@ from typing import Any
 VERSION: str = "1.0.0"
 DEFAULT_SETTINGS: dict[str, Any] = {
     "language_model": {
+        "host": "http://localhost",
         "port": 8080,
+        "extra_backends": "",
         "stream_responses": True,
+        "stream_flush_interval_ms": 50,
+        "stream_flush_tokens": 8,
         "temperature": 0.8,
         "top_k": 40,
         "top_p": 0.95,
@@ -27,13 +31,36 @@ DEFAULT_SETTINGS: dict[str, Any] = {
     },
     "chat": {
         "system_prompt": "",
+        "attachment_cache_megabytes": 256,
+        "context_trim_policy": "Drop Oldest",
+        "context_keep_turns": 2,
+        "context_reserve_tokens": 512,
+        "conversation_list_size": 100,
+        "render_window": 50,
+        "candidate_count": 1,
+        "prefill_while_typing": True,
+        "prefill_debounce_ms": 500,
     },
     "writer": {
         "max_tokens": 128,
     },
+    "app": {
+        "concurrency_limit": 4,
+        "session_idle_minutes": 60,
+        "profile_handlers": False,
+    },
+    "network": {
+        "max_connections": 16,
+        "max_keepalive_connections": 8,
+        "keepalive_expiry": 60.0,
+        "health_check_ttl": 10.0,
+    },
 }
 DATA_DIR_PATH: str = "data/"
 SETTINGS_FILENAME: str = "settings.json"
+CONVERSATIONS_FILENAME: str = "conversations.sqlite3"
+ATTACHMENTS_DIRNAME: str = "attachments/"
+PROFILES_DIRNAME: str = "profiles/"
 GENERIC_FILE_EXTENSIONS: list[str] = [
     # Text File
     ".text",
@@ -277,6 +304,7 @@ SERVER_ERROR_IMAGE_INPUT_UNSUPPORTED: str = "image input is not supported - hint
 SERVER_ERROR_AUDIO_INPUT_UNSUPPORTED: str = "audio input is not supported - hint: if this is unexpected, you may need to provide the mmproj"
 WARNING_NO_CONTEXT_SHIFT_CUTOFF: str = "The model's message was cut off because Context Shift is disabled."
 WARNING_NO_CONTEXT_SHIFT: str = "Your message could not be sent because Context Shift is disabled."
+WARNING_CONTEXT_FULL: str = "Your message could not be sent because the conversation no longer fits in the model's context. Try a different trim policy or fewer kept turns."
 WARNING_INVALID_IMAGE_OR_AUDIO: str = "The image or audio file(s) you sent are unviewable."
 WARNING_IMAGE_INPUT_UNSUPPORTED: str = "The currently running model cannot see images. You may need to refresh the model info or reload llama.cpp with the multimodal projector."
 WARNING_AUDIO_INPUT_UNSUPPORTED: str = "The currently running model cannot hear audio. You may need to refresh the model info or reload llama.cpp with the multimodal projector."
@@ -9,6 +9,3 @@ model_modalities: dict[str, bool] = {
     "vision": False,
     "audio": False,
 }
-chat_history: list[gr.ChatMessage] = []
-writer_text: str = ""
-assistant_task: Any = None
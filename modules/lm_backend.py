@@ -1,88 +1,410 @@
 from typing import Any
+from collections.abc import AsyncIterator
+from collections import OrderedDict
+from collections import deque
+import contextlib
+import time
 
 import gradio as gr
+import asyncio
 import httpx
 
-from modules.core import shared
+from modules.core import constants
+from modules import settings
+from modules import sessions
 
 
-def mark_assistant_as_idle():
+class Backend:
+    def __init__(self) -> None:
+        self.is_healthy: bool = False
+        self.last_checked: float = 0.0
+        self.total_slots: int | None = None
+        # Per slot, which is what a single request can use.
+        self.context_size: int | None = None
+        self.busy_slots: set[int] = set()
+        self.slot_last_used: dict[int, float] = {}
+
+
+class QueuedGeneration:
+    def __init__(self, base_urls: list[str], preferred_slot: tuple[str, int] | None) -> None:
+        self.base_urls: list[str] = base_urls
+        self.preferred_slot: tuple[str, int] | None = preferred_slot
+        self.future: asyncio.Future[tuple[str, int]] = asyncio.get_running_loop().create_future()
+
+
+class SamplerSettings:
+    def __init__(self) -> None:
+        # The settings version the fragment was built from.
+        self.version: int = -1
+        self.payload_fragment: dict[str, Any] = {}
+
+    def get_payload_fragment(self) -> dict[str, Any]:
+        version: int = settings.get_version()
+        if version != self.version:
+            self.payload_fragment = self.__build_payload_fragment()
+            self.version = version
+        return self.payload_fragment
+
+    @staticmethod
+    def __build_payload_fragment() -> dict[str, Any]:
+        def get_setting(key: str) -> Any:
+            return settings.get_key(f"language_model/{key}", constants.DEFAULT_SETTINGS["language_model"][key])
+
+        def mirostat_mode_to_int(mirostat_mode: str) -> int:
+            match mirostat_mode:
+                case "Off":
+                    return 0
+                case "Version 1.0":
+                    return 1
+                case "Version 2.0":
+                    return 2
+                case _:
+                    raise ValueError
+
+        return {
+            "stream": get_setting("stream_responses"),
+            "temperature": get_setting("temperature"),
+            "top_k": get_setting("top_k"),
+            "top_p": get_setting("top_p"),
+            "min_p": get_setting("min_p"),
+            "typical_p": get_setting("typical_p"),
+            "repeat_penalty": get_setting("repetition_penalty"),
+            "repeat_last_n": get_setting("repetition_penalty_range"),
+            "presence_penalty": get_setting("presence_penalty"),
+            "frequency_penalty": get_setting("frequency_penalty"),
+            "mirostat": mirostat_mode_to_int(get_setting("mirostat_mode")),
+            "mirostat_tau": get_setting("mirostat_tau"),
+            "mirostat_eta": get_setting("mirostat_eta"),
+            "dry_base": get_setting("dry_base"),
+            "dry_multiplier": get_setting("dry_multiplier"),
+            "dry_allowed_length": get_setting("dry_allowed_length"),
+            "dry_penalty_last_n": get_setting("dry_penalty_range"),
+            "xtc_threshold": get_setting("xtc_threshold"),
+            "xtc_probability": get_setting("xtc_probability"),
+        }
+
+
+sampler_settings: SamplerSettings = SamplerSettings()
+__client: httpx.AsyncClient | None = None
+__backends: dict[str, Backend] = {}
+# Session hash -> generations of that session waiting for a free slot, in arrival order.
+# Sessions are served round-robin so one busy user can't starve the others.
+__waiting_generations: OrderedDict[str, deque[QueuedGeneration]] = OrderedDict()
+__health_prober_task: asyncio.Task[None] | None = None
+
+
+def get_base_url(port: int) -> str:
+    host: str = settings.get_key("language_model/host", constants.DEFAULT_SETTINGS["language_model"]["host"])
+    return f"{host.strip().rstrip("/")}:{port}"
+
+
+def get_backend_urls(port: int) -> list[str]:
+    base_urls: list[str] = [get_base_url(port)]
+    extra_backends: str = settings.get_key("language_model/extra_backends", constants.DEFAULT_SETTINGS["language_model"]["extra_backends"])
+    for line in extra_backends.splitlines():
+        base_url: str = line.strip().rstrip("/")
+        if base_url != "" and base_url not in base_urls:
+            base_urls.append(base_url)
+    return base_urls
+
+
+def get_client() -> httpx.AsyncClient:
+    global __client
+
+    if __client is None or __client.is_closed:
+        __client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.get_key("network/max_connections", constants.DEFAULT_SETTINGS["network"]["max_connections"]),
+                max_keepalive_connections=settings.get_key("network/max_keepalive_connections", constants.DEFAULT_SETTINGS["network"]["max_keepalive_connections"]),
+                keepalive_expiry=settings.get_key("network/keepalive_expiry", constants.DEFAULT_SETTINGS["network"]["keepalive_expiry"]),
+            ),
+        )
+    return __client
+
+
+async def open_client() -> None:
+    # Opens the first connections ahead of time so the first message doesn't pay for them.
+    await asyncio.gather(*(probe_backend(base_url) for base_url in get_backend_urls(get_configured_port())))
+
+
+async def close_client() -> None:
+    global __client
+
+    if __client is not None:
+        await __client.aclose()
+        __client = None
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: Any) -> AsyncIterator[None]:
+    global __health_prober_task
+
+    await open_client()
+    __health_prober_task = asyncio.create_task(__run_health_prober())
+    try:
+        yield
+    finally:
+        __health_prober_task.cancel()
+        __health_prober_task = None
+        await close_client()
+
+
+def get_configured_port() -> int:
+    return settings.get_key("language_model/port", constants.DEFAULT_SETTINGS["language_model"]["port"])
+
+
+def get_health_check_ttl() -> float:
+    return settings.get_key("network/health_check_ttl", constants.DEFAULT_SETTINGS["network"]["health_check_ttl"])
+
+
+async def probe_backend(base_url: str) -> bool:
+    backend: Backend = __backends.setdefault(base_url, Backend())
+    try:
+        response: httpx.Response = await get_client().request("GET", f"{base_url}/health")
+        backend.is_healthy = response.status_code == 200
+        if backend.is_healthy and backend.total_slots is None:
+            response = await get_client().request("GET", f"{base_url}/props")
+            props: dict[str, Any] = response.json()
+            backend.total_slots = max(1, int(props.get("total_slots", 1)))
+            n_ctx: Any = props.get("default_generation_settings", {}).get("n_ctx")
+            backend.context_size = int(n_ctx) if n_ctx else None
+    except (httpx.HTTPError, httpx.InvalidURL, ValueError):
+        backend.is_healthy = False
+    if not backend.is_healthy:
+        # The server may come back with a different slot count or context size.
+        backend.total_slots = None
+        backend.context_size = None
+    backend.last_checked = time.monotonic()
+    __dispatch_waiting_generations()
+    return backend.is_healthy
+
+
+def get_backend_statuses(port: int) -> list[tuple[str, bool | None, int]]:
+    statuses: list[tuple[str, bool | None, int]] = []
+    for base_url in get_backend_urls(port):
+        backend: Backend | None = __backends.get(base_url)
+        if backend is None:
+            statuses.append((base_url, None, 0))
+        else:
+            statuses.append((base_url, backend.is_healthy, len(backend.busy_slots)))
+    return statuses
+
+
+def get_context_size(base_url: str) -> int | None:
+    backend: Backend | None = __backends.get(base_url)
+    return None if backend is None else backend.context_size
+
+
+def get_queue_position(session_hash: str | None) -> int | None:
+    for position, waiting_session_hash in enumerate(__waiting_generations, 1):
+        if waiting_session_hash == session_hash:
+            return position
+    return None
+
+
+def mark_backend_unhealthy(base_url: str) -> None:
+    backend: Backend = __backends.setdefault(base_url, Backend())
+    backend.is_healthy = False
+    backend.last_checked = time.monotonic()
+
+
+async def pick_backend(port: int) -> str | None:
+    base_urls: list[str] = await __get_healthy_backend_urls(port)
+    if len(base_urls) == 0:
+        return None
+
+    # Least outstanding requests, ties going to the earliest configured member.
+    return min(base_urls, key=lambda base_url: len(__backends[base_url].busy_slots))
+
+
+# `preferred_slot` is the (base URL, slot ID) that last served this conversation. It is
+# handed out again if free, so llama.cpp can reuse the prompt cache it left there.
+async def queue_generation(port: int, session_hash: str, preferred_slot: tuple[str, int] | None = None) -> asyncio.Future[tuple[str, int]] | None:
+    base_urls: list[str] = await __get_healthy_backend_urls(port)
+    if len(base_urls) == 0:
+        return None
+
+    queued_generation: QueuedGeneration = QueuedGeneration(base_urls, preferred_slot)
+    __waiting_generations.setdefault(session_hash, deque()).append(queued_generation)
+    __dispatch_waiting_generations()
+    return queued_generation.future
+
+
+# Returns the (base URL, slot ID) a queued generation was given, or None if `future` was cancelled
+# while waiting (e.g., by the Stop button). If the caller itself is cancelled, that is raised as usual.
+async def wait_for_slot(future: asyncio.Future[tuple[str, int]], session_hash: str) -> tuple[str, int] | None:
+    try:
+        return await future
+    except asyncio.CancelledError:
+        waiting_generations: deque[QueuedGeneration] | None = __waiting_generations.get(session_hash)
+        if waiting_generations is not None:
+            for queued_generation in waiting_generations:
+                if queued_generation.future is future:
+                    waiting_generations.remove(queued_generation)
+                    break
+            if len(waiting_generations) == 0:
+                del __waiting_generations[session_hash]
+        if future.done() and not future.cancelled():
+            release_slot(future.result())
+        current_task: asyncio.Task[Any] | None = asyncio.current_task()
+        if current_task is not None and current_task.cancelling() > 0:
+            raise
+        return None
+
+
+# Takes a slot that is free right now without queueing, preferring `preferred_slot` like
+# queued generations do. Returns None if there is none, or if any generation is waiting
+# for a slot, since that needs it more.
+def take_idle_slot(base_urls: list[str], preferred_slot: tuple[str, int] | None = None) -> tuple[str, int] | None:
+    if len(__waiting_generations) > 0:
+        return None
+    slot: tuple[str, int] | None = __find_free_slot(base_urls, preferred_slot)
+    if slot is not None:
+        __backends[slot[0]].busy_slots.add(slot[1])
+    return slot
+
+
+def release_slot(slot: tuple[str, int]) -> None:
+    backend: Backend | None = __backends.get(slot[0])
+    if backend is not None:
+        backend.busy_slots.discard(slot[1])
+        backend.slot_last_used[slot[1]] = time.monotonic()
+    __dispatch_waiting_generations()
+
+
+async def __get_healthy_backend_urls(port: int) -> list[str]:
+    base_urls: list[str] = get_backend_urls(port)
+    current_time: float = time.monotonic()
+    health_check_ttl: float = get_health_check_ttl()
+
+    # Fresh healthy members are trusted as-is. If there are none, everything is
+    # probed again (including members marked unhealthy by a failed request).
+    healthy_base_urls: list[str] = []
+    for base_url in base_urls:
+        backend: Backend | None = __backends.get(base_url)
+        if backend is not None and backend.is_healthy and current_time - backend.last_checked <= health_check_ttl:
+            healthy_base_urls.append(base_url)
+    if len(healthy_base_urls) == 0:
+        results: list[bool] = await asyncio.gather(*(probe_backend(base_url) for base_url in base_urls))
+        healthy_base_urls = [base_url for base_url, is_healthy in zip(base_urls, results) if is_healthy]
+    if len(healthy_base_urls) == 0:
+        issue_connection_warning(base_urls[0] if len(base_urls) == 1 else None)
+    return healthy_base_urls
+
+
+def __find_free_slot(base_urls: list[str], preferred_slot: tuple[str, int] | None) -> tuple[str, int] | None:
+    free_base_urls: list[str] = []
+    for base_url in base_urls:
+        backend: Backend | None = __backends.get(base_url)
+        if backend is not None and backend.is_healthy and len(backend.busy_slots) < (backend.total_slots or 1):
+            free_base_urls.append(base_url)
+    if len(free_base_urls) == 0:
+        return None
+
+    if preferred_slot is not None and preferred_slot[0] in free_base_urls:
+        preferred_backend: Backend = __backends[preferred_slot[0]]
+        if preferred_slot[1] < (preferred_backend.total_slots or 1) and preferred_slot[1] not in preferred_backend.busy_slots:
+            return preferred_slot
+
+    # Otherwise the least loaded backend, and its slot that has gone unused the longest
+    # (the most recently used ones probably hold some other conversation's cache).
+    base_url: str = min(free_base_urls, key=lambda candidate: len(__backends[candidate].busy_slots) / (__backends[candidate].total_slots or 1))
+    backend = __backends[base_url]
+    free_slot_ids: list[int] = [slot_id for slot_id in range(backend.total_slots or 1) if slot_id not in backend.busy_slots]
+    return (base_url, min(free_slot_ids, key=lambda slot_id: backend.slot_last_used.get(slot_id, 0.0)))
+
+
+def __dispatch_waiting_generations() -> None:
+    while len(__waiting_generations) > 0:
+        session_hash: str | None = None
+        slot: tuple[str, int] | None = None
+
+        # The first session (in round-robin order) whose next generation fits on a free slot.
+        for waiting_session_hash, waiting_generations in __waiting_generations.items():
+            slot = __find_free_slot(waiting_generations[0].base_urls, waiting_generations[0].preferred_slot)
+            if slot is not None:
+                session_hash = waiting_session_hash
+                break
+        if session_hash is None or slot is None:
+            return
+
+        waiting_generations = __waiting_generations.pop(session_hash)
+        queued_generation: QueuedGeneration = waiting_generations.popleft()
+        if len(waiting_generations) > 0:
+            __waiting_generations[session_hash] = waiting_generations  # Back of the line.
+        if not queued_generation.future.done():
+            __backends[slot[0]].busy_slots.add(slot[1])
+            queued_generation.future.set_result(slot)
+
+
+def mark_chat_as_idle():
     return (
-        gr.update(interactive=True),
-        gr.update(interactive=True),
         gr.update(stop_btn=False),
-        gr.update(value="Generate", variant="primary"),
         False,
     )
 
 
-def mark_assistant_as_busy():
+def mark_chat_as_busy():
     return (
-        gr.update(interactive=False),
-        gr.update(interactive=False),
         gr.update(stop_btn=True),
+        True,
+    )
+
+
+def mark_writer_as_idle():
+    return (
+        gr.update(value="Generate", variant="primary"),
+        False,
+    )
+
+
+def mark_writer_as_busy():
+    return (
         gr.update(value="Stop", variant="stop"),
         True,
     )
 
 
-def stop_assistant_task(is_assistant_busy: bool):
-    if is_assistant_busy and shared.assistant_task is not None:
-        if not isinstance(shared.assistant_task, int):
-            shared.assistant_task.cancel()
-        shared.assistant_task = None
+def stop_chat_task(is_chat_busy: bool, request: gr.Request):
+    session: sessions.Session = sessions.get(request)
+    if is_chat_busy and session.chat_task is not None:
+        if not isinstance(session.chat_task, int):
+            session.chat_task.cancel()
+        session.chat_task = None
+        return False
+    return is_chat_busy
+
+
+def stop_writer_task(is_writer_busy: bool, request: gr.Request):
+    session: sessions.Session = sessions.get(request)
+    if is_writer_busy and session.writer_task is not None:
+        if not isinstance(session.writer_task, int):
+            session.writer_task.cancel()
+        session.writer_task = None
         return False
-    return is_assistant_busy
-
-
-def create_payload(payload: dict[str, Any], stream_responses: bool, temperature: float, top_k: int, top_p: float, min_p: float, typical_p: float, repetition_penalty: float, repetition_penalty_range: int, presence_penalty: float, frequency_penalty: float, mirostat_mode: str, mirostat_tau: float, mirostat_eta: float, dry_base: float, dry_multiplier: float, dry_allowed_length: int, dry_penalty_range: int, xtc_threshold: float, xtc_probability: float) -> dict[str, Any]:
-    def mirostat_mode_to_int(mirostat_mode: str) -> int:
-        match mirostat_mode:
-            case "Off":
-                return 0
-            case "Version 1.0":
-                return 1
-            case "Version 2.0":
-                return 2
-            case _:
-                raise ValueError
-
-    payload.update({
-        "stream": stream_responses,
-        "temperature": temperature,
-        "top_k": top_k,
-        "top_p": top_p,
-        "min_p": min_p,
-        "typical_p": typical_p,
-        "repeat_penalty": repetition_penalty,
-        "repeat_last_n": repetition_penalty_range,
-        "presence_penalty": presence_penalty,
-        "frequency_penalty": frequency_penalty,
-        "mirostat": mirostat_mode_to_int(mirostat_mode),
-        "mirostat_tau": mirostat_tau,
-        "mirostat_eta": mirostat_eta,
-        "dry_base": dry_base,
-        "dry_multiplier": dry_multiplier,
-        "dry_allowed_length": dry_allowed_length,
-        "dry_penalty_last_n": dry_penalty_range,
-        "xtc_threshold": xtc_threshold,
-        "xtc_probability": xtc_probability,
-    })
+    return is_writer_busy
+
+
+def create_payload(payload: dict[str, Any]) -> dict[str, Any]:
+    payload.update(sampler_settings.get_payload_fragment())
     return payload
 
 
-async def check_server_health(port: int) -> bool:
-    async with httpx.AsyncClient() as client:
-        try:
-            response: httpx.Response = await client.request("GET", f"http://localhost:{port}/health")
-            if response.status_code != 200:
-                issue_connection_warning(port)
-                return False
-        except httpx.ConnectError:
-            issue_connection_warning(port)
-            return False
-    return True
+def issue_connection_warning(base_url: str | None) -> None:
+    if base_url is None:
+        gr.Warning("Could not connect to any language model server.")
+    else:
+        gr.Warning(f"Could not connect to language model server at {base_url}.")
+
+
+async def __run_health_prober() -> None:
+    while True:
+        base_urls: list[str] = get_backend_urls(get_configured_port())
 
+        # Forget addresses that are no longer configured (e.g., typed half-way into the host box),
+        # unless a request is still using them.
+        for stale_base_url in [key for key, backend in __backends.items() if key not in base_urls and len(backend.busy_slots) == 0]:
+            del __backends[stale_base_url]
+        await asyncio.gather(*(probe_backend(base_url) for base_url in base_urls))
 
-def issue_connection_warning(port: int) -> None:
-    gr.Warning(f"Could not connect to language model server at port {port}.")
+        await asyncio.sleep(get_health_check_ttl() / 2.0)
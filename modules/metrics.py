@@ -0,0 +1,183 @@
+from typing import Any
+import bisect
+import math
+import time
+
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+
+
+SECONDS_BUCKETS: tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKENS_PER_SECOND_BUCKETS: tuple[float, ...] = (1.0, 2.0, 5.0, 10.0, 20.0, 35.0, 50.0, 75.0, 100.0, 150.0, 250.0, 500.0, 1000.0, 2500.0, 5000.0)
+TOKEN_COUNT_BUCKETS: tuple[float, ...] = (16.0, 64.0, 256.0, 1024.0, 4096.0, 16384.0, 65536.0, 131072.0)
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, buckets: tuple[float, ...]) -> None:
+        self.name: str = name
+        self.description: str = description
+        self.buckets: tuple[float, ...] = buckets
+        # Per label value ("chat" or "writer"). Bucket counts aren't cumulative until rendered.
+        self.bucket_counts: dict[str, list[int]] = {}
+        self.sums: dict[str, float] = {}
+        self.counts: dict[str, int] = {}
+
+    def observe(self, mode: str, value: float) -> None:
+        if math.isnan(value):
+            return
+        bucket_counts: list[int] | None = self.bucket_counts.get(mode)
+        if bucket_counts is None:
+            bucket_counts = [0] * (len(self.buckets) + 1)
+            self.bucket_counts[mode] = bucket_counts
+        bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[mode] = self.sums.get(mode, 0.0) + value
+        self.counts[mode] = self.counts.get(mode, 0) + 1
+
+    def get_mean(self, mode: str | None = None) -> float | None:
+        modes: list[str] = list(self.counts) if mode is None else [mode]
+        count: int = sum(self.counts.get(mode, 0) for mode in modes)
+        if count == 0:
+            return None
+        return sum(self.sums.get(mode, 0.0) for mode in modes) / count
+
+    def render(self) -> list[str]:
+        lines: list[str] = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for mode, bucket_counts in self.bucket_counts.items():
+            cumulative_count: int = 0
+            for bucket, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative_count += bucket_count
+                lines.append(f"{self.name}_bucket{{mode=\"{mode}\",le=\"{bucket:g}\"}} {cumulative_count}")
+            lines.append(f"{self.name}_bucket{{mode=\"{mode}\",le=\"+Inf\"}} {self.counts[mode]}")
+            lines.append(f"{self.name}_sum{{mode=\"{mode}\"}} {self.sums[mode]:g}")
+            lines.append(f"{self.name}_count{{mode=\"{mode}\"}} {self.counts[mode]}")
+        return lines
+
+
+queue_wait_seconds: Histogram = Histogram("blas_chat_queue_wait_seconds", "Time spent waiting for a free server slot.", SECONDS_BUCKETS)
+health_check_seconds: Histogram = Histogram("blas_chat_health_check_seconds", "Time spent checking server health before queueing.", SECONDS_BUCKETS)
+time_to_first_token_seconds: Histogram = Histogram("blas_chat_time_to_first_token_seconds", "Time from sending the request to receiving the first text.", SECONDS_BUCKETS)
+stream_tokens_per_second: Histogram = Histogram("blas_chat_stream_tokens_per_second", "Streamed chunks per second after the first one, as received.", TOKENS_PER_SECOND_BUCKETS)
+server_prompt_tokens: Histogram = Histogram("blas_chat_server_prompt_tokens", "Prompt tokens processed by llama.cpp (timings.prompt_n).", TOKEN_COUNT_BUCKETS)
+server_cached_tokens: Histogram = Histogram("blas_chat_server_cached_tokens", "Prompt tokens reused from the slot's cache (timings.cache_n).", TOKEN_COUNT_BUCKETS)
+server_prompt_seconds: Histogram = Histogram("blas_chat_server_prompt_seconds", "Prompt processing time reported by llama.cpp (timings.prompt_ms).", SECONDS_BUCKETS)
+server_prompt_tokens_per_second: Histogram = Histogram("blas_chat_server_prompt_tokens_per_second", "Prompt processing speed reported by llama.cpp.", TOKENS_PER_SECOND_BUCKETS)
+server_predicted_tokens: Histogram = Histogram("blas_chat_server_predicted_tokens", "Tokens generated by llama.cpp (timings.predicted_n).", TOKEN_COUNT_BUCKETS)
+server_predicted_seconds: Histogram = Histogram("blas_chat_server_predicted_seconds", "Generation time reported by llama.cpp (timings.predicted_ms).", SECONDS_BUCKETS)
+server_predicted_tokens_per_second: Histogram = Histogram("blas_chat_server_predicted_tokens_per_second", "Generation speed reported by llama.cpp.", TOKENS_PER_SECOND_BUCKETS)
+usage_prompt_tokens: Histogram = Histogram("blas_chat_usage_prompt_tokens", "Prompt tokens reported in usage, including cached ones.", TOKEN_COUNT_BUCKETS)
+usage_completion_tokens: Histogram = Histogram("blas_chat_usage_completion_tokens", "Completion tokens reported in usage.", TOKEN_COUNT_BUCKETS)
+__histograms: list[Histogram] = [
+    queue_wait_seconds,
+    health_check_seconds,
+    time_to_first_token_seconds,
+    stream_tokens_per_second,
+    server_prompt_tokens,
+    server_cached_tokens,
+    server_prompt_seconds,
+    server_prompt_tokens_per_second,
+    server_predicted_tokens,
+    server_predicted_seconds,
+    server_predicted_tokens_per_second,
+    usage_prompt_tokens,
+    usage_completion_tokens,
+]
+
+
+# Collects the measurements of one generation and records them all when it finishes.
+class Generation:
+    def __init__(self, mode: str) -> None:
+        self.mode: str = mode
+        self._start_time: float = time.perf_counter()
+        self._queued_time: float | None = None
+        self._request_time: float | None = None
+        self._first_token_time: float | None = None
+        self._last_token_time: float | None = None
+        self._token_count: int = 0
+        # llama.cpp's `timings` and `usage` fields, as received.
+        self.timings: dict[str, Any] | None = None
+        self.usage: dict[str, Any] | None = None
+
+    # Queueing a generation is where the health checks happen, if any are due.
+    def mark_queued(self) -> None:
+        self._queued_time = time.perf_counter()
+        health_check_seconds.observe(self.mode, self._queued_time - self._start_time)
+
+    def mark_slot_acquired(self) -> None:
+        if self._queued_time is not None:
+            queue_wait_seconds.observe(self.mode, time.perf_counter() - self._queued_time)
+
+    def mark_request_sent(self) -> None:
+        self._request_time = time.perf_counter()
+
+    # Called for each piece of received text (the whole response when not streaming).
+    def add_text(self, text: str) -> None:
+        if text == "":
+            return
+        current_time: float = time.perf_counter()
+        if self._first_token_time is None:
+            self._first_token_time = current_time
+        self._last_token_time = current_time
+        self._token_count += 1
+
+    def finish(self) -> None:
+        if self._request_time is not None and self._first_token_time is not None:
+            time_to_first_token_seconds.observe(self.mode, self._first_token_time - self._request_time)
+        if self._token_count > 1 and self._first_token_time is not None and self._last_token_time is not None and self._last_token_time > self._first_token_time:
+            stream_tokens_per_second.observe(self.mode, (self._token_count - 1) / (self._last_token_time - self._first_token_time))
+
+        if self.timings is not None:
+            for histogram, key, scale in (
+                (server_prompt_tokens, "prompt_n", 1.0),
+                (server_cached_tokens, "cache_n", 1.0),
+                (server_prompt_seconds, "prompt_ms", 0.001),
+                (server_prompt_tokens_per_second, "prompt_per_second", 1.0),
+                (server_predicted_tokens, "predicted_n", 1.0),
+                (server_predicted_seconds, "predicted_ms", 0.001),
+                (server_predicted_tokens_per_second, "predicted_per_second", 1.0),
+            ):
+                self.__observe_field(histogram, self.mode, self.timings, key, scale)
+        if self.usage is not None:
+            self.__observe_field(usage_prompt_tokens, self.mode, self.usage, "prompt_tokens", 1.0)
+            self.__observe_field(usage_completion_tokens, self.mode, self.usage, "completion_tokens", 1.0)
+
+    @staticmethod
+    def __observe_field(histogram: Histogram, mode: str, fields: dict[str, Any], key: str, scale: float) -> None:
+        value: Any = fields.get(key)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            histogram.observe(mode, value * scale)
+
+
+def render() -> str:
+    lines: list[str] = []
+    for histogram in __histograms:
+        lines += histogram.render()
+    return "\n".join(lines) + "\n"
+
+
+def get_summary() -> str:
+    generation_count: int = sum(time_to_first_token_seconds.counts.values())
+    if generation_count == 0:
+        return "**Generations:** None"
+
+    summary: str = f"**Generations:** {generation_count}"
+    time_to_first_token: float | None = time_to_first_token_seconds.get_mean()
+    if time_to_first_token is not None:
+        summary += f", {time_to_first_token * 1000.0:.0f} ms to first token"
+    tokens_per_second: float | None = stream_tokens_per_second.get_mean()
+    if tokens_per_second is not None:
+        summary += f", {tokens_per_second:.1f} tokens/s"
+    queue_wait: float | None = queue_wait_seconds.get_mean()
+    if queue_wait is not None:
+        summary += f", {queue_wait * 1000.0:.0f} ms queued"
+    return f"{summary} (averages)"
+
+
+# Serves the histograms in Prometheus' text format at /metrics on the Gradio app.
+def mount(app: FastAPI) -> None:
+    async def get_metrics() -> PlainTextResponse:
+        return PlainTextResponse(render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+    app.add_api_route("/metrics", get_metrics, methods=["GET"], include_in_schema=False)
@@ -0,0 +1,264 @@
+from typing import Any
+from collections.abc import Callable
+from collections import Counter
+from types import CodeType
+from types import FrameType
+import atexit
+import functools
+import inspect
+import os
+import re
+import sys
+import threading
+import time
+
+import gradio as gr
+
+from modules.core import constants
+from modules import settings
+
+
+# Profiling is on if this is set to anything but "0" (or "app/profile_handlers" is true in settings.json).
+ENVIRONMENT_VARIABLE: str = "BLAS_CHAT_PROFILE"
+SAMPLE_INTERVAL: float = 0.005
+REPORT_INTERVAL: float = 30.0
+TOP_FUNCTION_COUNT: int = 30
+# Without per-thread CPU clocks (e.g., on Windows), threads waiting in one of these are
+# assumed to be idle (the event loop, Gradio's workers, etc).
+IDLE_FUNCTIONS: set[tuple[str, str]] = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+}
+
+
+class HandlerStats:
+    def __init__(self, name: str) -> None:
+        self.name: str = name
+        self.call_count: int = 0
+        self.total_time: float = 0.0
+        self.max_time: float = 0.0
+        self.cpu_time: float = 0.0
+        # Function -> CPU time sampled while it was running (self) or anywhere on the stack (total).
+        self.self_times: Counter[str] = Counter()
+        self.total_times: Counter[str] = Counter()
+
+    def add_call(self, duration: float) -> None:
+        self.call_count += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+
+
+# Handler code object -> its stats. Shared by every event the handler is registered for.
+__handler_stats: dict[CodeType, HandlerStats] = {}
+__lock: threading.Lock = threading.Lock()
+__cpu_time: float = 0.0
+__self_times: Counter[str] = Counter()
+__total_times: Counter[str] = Counter()
+__outside_handler_cpu_time: float = 0.0
+
+
+def is_enabled() -> bool:
+    environment_value: str | None = os.environ.get(ENVIRONMENT_VARIABLE)
+    if environment_value is not None:
+        return environment_value.strip() not in ("", "0")
+    return settings.get_key("app/profile_handlers", constants.DEFAULT_SETTINGS["app"]["profile_handlers"])
+
+
+# Wraps every event handler of `demo` and starts sampling. Does nothing at all when
+# profiling is off, so the handlers Gradio calls are the original functions.
+def install(demo: gr.Blocks) -> None:
+    if not is_enabled():
+        return
+
+    for block_function in demo.fns.values():
+        if block_function.fn is None:
+            continue
+        handler_code: CodeType | None = __get_code(block_function.fn)
+        if handler_code is None:
+            continue
+        stats: HandlerStats | None = __handler_stats.get(handler_code)
+        if stats is None:
+            unwrapped_fn: Any = inspect.unwrap(block_function.fn)
+            stats = HandlerStats(f"{unwrapped_fn.__module__}.{unwrapped_fn.__qualname__}")
+            __handler_stats[handler_code] = stats
+        block_function.fn = __wrap(block_function.fn, stats)
+
+    threading.Thread(target=__run_sampler, name="profiler", daemon=True).start()
+    atexit.register(write_reports)
+    print(f"Profiling {len(__handler_stats)} handlers, reports go to {constants.DATA_DIR_PATH}{constants.PROFILES_DIRNAME}")
+
+
+def write_reports() -> None:
+    profiles_dir_path: str = f"{constants.DATA_DIR_PATH}{constants.PROFILES_DIRNAME}"
+    os.makedirs(profiles_dir_path, exist_ok=True)
+
+    with __lock:
+        summary_lines: list[str] = [
+            f"CPU time sampled: {__cpu_time * 1000.0:.0f} ms (every {SAMPLE_INTERVAL * 1000.0:g} ms)",
+            f"Outside of handlers (Gradio's processing and diffing, uvicorn, etc): {__outside_handler_cpu_time * 1000.0:.0f} ms",
+            "",
+            "Handlers (wall time includes waiting on llama.cpp and the queue, CPU time doesn't):",
+        ]
+        for stats in sorted(__handler_stats.values(), key=lambda stats: stats.total_time, reverse=True):
+            if stats.call_count == 0:
+                continue
+            summary_lines.append(f"    {stats.name}: {__format_handler_times(stats)}")
+            __write_report(f"{profiles_dir_path}{re.sub(r"[^\w.-]", "_", stats.name)}.txt", [
+                stats.name,
+                __format_handler_times(stats),
+                "",
+                *__format_top_functions(stats.self_times, stats.total_times, stats.cpu_time),
+            ])
+        summary_lines.append("")
+        summary_lines += __format_top_functions(__self_times, __total_times, __cpu_time)
+    __write_report(f"{profiles_dir_path}summary.txt", summary_lines)
+
+
+def __wrap(fn: Callable[..., Any], stats: HandlerStats) -> Callable[..., Any]:
+    # Gradio decides how to call a handler from its kind and signature, so both are kept.
+    if inspect.isasyncgenfunction(fn):
+        @functools.wraps(fn)
+        async def async_generator_wrapper(*args: Any, **kwargs: Any) -> Any:
+            start_time: float = time.perf_counter()
+            generator: Any = fn(*args, **kwargs)
+            try:
+                async for output in generator:
+                    yield output
+            finally:
+                await generator.aclose()
+                stats.add_call(time.perf_counter() - start_time)
+        return async_generator_wrapper
+
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def coroutine_wrapper(*args: Any, **kwargs: Any) -> Any:
+            start_time: float = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                stats.add_call(time.perf_counter() - start_time)
+        return coroutine_wrapper
+
+    if inspect.isgeneratorfunction(fn):
+        @functools.wraps(fn)
+        def generator_wrapper(*args: Any, **kwargs: Any) -> Any:
+            start_time: float = time.perf_counter()
+            try:
+                return (yield from fn(*args, **kwargs))
+            finally:
+                stats.add_call(time.perf_counter() - start_time)
+        return generator_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        start_time: float = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            stats.add_call(time.perf_counter() - start_time)
+    return wrapper
+
+
+# Samples every thread's stack instead of using cProfile, which can only follow one
+# thread at a time and can't tell apart async handlers interleaving on the event loop.
+# Each sample is weighted by the CPU time its thread used since the last one.
+def __run_sampler() -> None:
+    global __cpu_time, __outside_handler_cpu_time
+
+    sampler_thread_id: int = threading.get_ident()
+    last_thread_cpu_times: dict[int, float] = {}
+    last_report_time: float = time.monotonic()
+    while True:
+        time.sleep(SAMPLE_INTERVAL)
+        thread_cpu_times: dict[int, float] = {}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == sampler_thread_id:
+                continue
+            sample_time: float
+            thread_cpu_time: float | None = __get_thread_cpu_time(thread_id)
+            if thread_cpu_time is not None:
+                thread_cpu_times[thread_id] = thread_cpu_time
+                sample_time = thread_cpu_time - last_thread_cpu_times.get(thread_id, thread_cpu_time)
+                if sample_time <= 0.0:
+                    continue
+            elif (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FUNCTIONS:
+                continue
+            else:
+                sample_time = SAMPLE_INTERVAL
+
+            # Innermost first, up to the handler that's running (if any).
+            stack_names: list[str] = []
+            stats: HandlerStats | None = None
+            current_frame: FrameType | None = frame
+            while current_frame is not None:
+                stack_names.append(__get_code_name(current_frame.f_code))
+                stats = __handler_stats.get(current_frame.f_code)
+                if stats is not None:
+                    break
+                current_frame = current_frame.f_back
+
+            with __lock:
+                __cpu_time += sample_time
+                __self_times[stack_names[0]] += sample_time
+                for name in set(stack_names):
+                    __total_times[name] += sample_time
+                if stats is None:
+                    __outside_handler_cpu_time += sample_time
+                else:
+                    stats.cpu_time += sample_time
+                    stats.self_times[stack_names[0]] += sample_time
+                    for name in set(stack_names):
+                        stats.total_times[name] += sample_time
+        last_thread_cpu_times = thread_cpu_times
+
+        if time.monotonic() - last_report_time >= REPORT_INTERVAL:
+            write_reports()
+            last_report_time = time.monotonic()
+
+
+def __get_thread_cpu_time(thread_id: int) -> float | None:
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(thread_id))
+    except (AttributeError, OSError):
+        return None
+
+
+def __get_code(fn: Callable[..., Any]) -> CodeType | None:
+    fn = inspect.unwrap(fn)
+    if inspect.ismethod(fn):
+        fn = fn.__func__
+    return getattr(fn, "__code__", None)
+
+
+def __get_code_name(code: CodeType) -> str:
+    module_path: str = code.co_filename
+    if module_path.startswith(os.getcwd()):
+        module_path = os.path.relpath(module_path)
+    return f"{code.co_qualname} ({module_path}:{code.co_firstlineno})"
+
+
+def __format_handler_times(stats: HandlerStats) -> str:
+    mean_time: float = stats.total_time / stats.call_count if stats.call_count > 0 else 0.0
+    return (
+        f"{stats.call_count} calls, {stats.total_time * 1000.0:.1f} ms wall "
+        f"(mean {mean_time * 1000.0:.1f} ms, max {stats.max_time * 1000.0:.1f} ms), "
+        f"~{stats.cpu_time * 1000.0:.0f} ms CPU"
+    )
+
+
+def __format_top_functions(self_times: Counter[str], total_times: Counter[str], cpu_time: float) -> list[str]:
+    lines: list[str] = [f"Top {TOP_FUNCTION_COUNT} by self CPU time:"]
+    for name, function_time in self_times.most_common(TOP_FUNCTION_COUNT):
+        lines.append(f"    {function_time * 1000.0:10.1f} ms {function_time * 100.0 / max(cpu_time, 1e-9):6.1f}%  {name}")
+    lines.append("")
+    lines.append(f"Top {TOP_FUNCTION_COUNT} by total CPU time (including callees):")
+    for name, function_time in total_times.most_common(TOP_FUNCTION_COUNT):
+        lines.append(f"    {function_time * 1000.0:10.1f} ms {function_time * 100.0 / max(cpu_time, 1e-9):6.1f}%  {name}")
+    return lines
+
+
+def __write_report(path: str, lines: list[str]) -> None:
+    with open(path, "wt", encoding="utf-8") as file:
+        file.write("\n".join(lines) + "\n")
@@ -0,0 +1,75 @@
+from typing import Any
+import time
+
+import gradio as gr
+import asyncio
+
+from modules.core import constants
+from modules import settings
+from modules import conversation
+from modules import tokenized_document
+
+
+class Session:
+    def __init__(self, session_hash: str) -> None:
+        self.session_hash: str = session_hash
+        self.chat_conversation: conversation.Conversation = conversation.Conversation()
+        self.writer_text: str = ""
+        self.writer_document: tokenized_document.TokenizedDocument = tokenized_document.TokenizedDocument()
+        self.chat_task: Any = None
+        self.chat_prefill_task: asyncio.Task[None] | None = None
+        # The prefill starts once the user has stopped typing until then.
+        self.chat_prefill_deadline: float = 0.0
+        self.writer_task: Any = None
+        self.writer_slot: tuple[str, int] | None = None
+        self.last_timings: dict[str, Any] | None = None
+        # What the status panel was last sent, or empty before the first update.
+        self.sent_status_texts: tuple[str, ...] = ()
+        self.last_active_time: float = time.monotonic()
+
+
+__sessions: dict[str, Session] = {}
+__last_eviction_time: float = 0.0
+
+
+def get(request: gr.Request | None) -> Session:
+    session_hash: str = "" if request is None or request.session_hash is None else request.session_hash
+
+    __evict_idle_sessions()
+
+    session: Session | None = __sessions.get(session_hash)
+    if session is None:
+        session = Session(session_hash)
+        __sessions[session_hash] = session
+    session.last_active_time = time.monotonic()
+    return session
+
+
+def get_all() -> list[Session]:
+    return list(__sessions.values())
+
+
+def remove(request: gr.Request) -> None:
+    if request.session_hash is not None:
+        session: Session | None = __sessions.pop(request.session_hash, None)
+        if session is not None:
+            for task in (session.chat_task, session.writer_task, session.chat_prefill_task):
+                if task is not None and not isinstance(task, int):
+                    task.cancel()
+            # Also stops streaming loops, which poll these.
+            session.chat_task = None
+            session.writer_task = None
+
+
+def __evict_idle_sessions() -> None:
+    global __last_eviction_time
+
+    current_time: float = time.monotonic()
+    if current_time - __last_eviction_time < 60.0:
+        return
+    __last_eviction_time = current_time
+
+    idle_timeout: float = settings.get_key("app/session_idle_minutes", constants.DEFAULT_SETTINGS["app"]["session_idle_minutes"]) * 60.0
+    for session_hash, session in list(__sessions.items()):
+        if session.chat_task is None and session.writer_task is None and current_time - session.last_active_time > idle_timeout:
+            del __sessions[session_hash]
@@ -2,41 +2,82 @@ from typing import Any
 import os
 import json
 import copy
+import atexit
+import threading
 
 from modules.core import constants
 
 
+# Changes are written at most this often, so dragging a slider doesn't rewrite the file per step.
+SAVE_DELAY: float = 1.0
+
 __data: dict[str, Any] = {}
+# Bumped on every change, so values derived from the settings know when to rebuild.
+__version: int = 0
+__lock: threading.RLock = threading.RLock()
+__file_lock: threading.Lock = threading.Lock()
+__save_timer: threading.Timer | None = None
 
 
 def load() -> None:
-    global __data
+    global __data, __version
 
     settings_path: str = f"{constants.DATA_DIR_PATH}{constants.SETTINGS_FILENAME}"
 
     if os.path.exists(settings_path):
         try:
             with open(settings_path, "rt") as file:
-                __data = __validate_and_fix_types(json.load(file), constants.DEFAULT_SETTINGS)
+                loaded_data: Any = json.load(file)
+            __data = __validate_and_fix_types(loaded_data, constants.DEFAULT_SETTINGS)
+            # Only rewrite the file if it was missing keys or had wrong types.
+            if __data != loaded_data:
+                save()
         except (json.JSONDecodeError, IOError) as exception:
             __data = copy.deepcopy(constants.DEFAULT_SETTINGS)
             print(f"Error loading settings from '{settings_path}': {exception}")
             print("Using default settings.")
+            save()
     else:
         __data = copy.deepcopy(constants.DEFAULT_SETTINGS)
         print(f"Settings file '{settings_path}' not found. Using default settings.")
+        save()
+    __version += 1
 
 
 def save() -> None:
     settings_path: str = f"{constants.DATA_DIR_PATH}{constants.SETTINGS_FILENAME}"
+    temporary_path: str = f"{settings_path}.tmp"
 
     os.makedirs(constants.DATA_DIR_PATH, exist_ok=True)
 
-    try:
-        with open(settings_path, "wt") as file:
-            json.dump(__data, file, indent=4)
-    except IOError as exception:
-        print(f"Error saving settings to '{settings_path}': {exception}")
+    with __lock:
+        serialized_data: str = json.dumps(__data, indent=4)
+    # Written to a temporary file first so a crash mid-write can't leave a truncated file behind.
+    with __file_lock:
+        try:
+            with open(temporary_path, "wt") as file:
+                file.write(serialized_data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary_path, settings_path)
+        except IOError as exception:
+            print(f"Error saving settings to '{settings_path}': {exception}")
+
+
+# Writes pending changes right away instead of waiting for the save timer.
+def flush() -> None:
+    global __save_timer
+
+    with __lock:
+        if __save_timer is None:
+            return
+        __save_timer.cancel()
+        __save_timer = None
+    save()
+
+
+def get_version() -> int:
+    return __version
 
 
 def get_key(path: str, default_value: Any = None) -> Any:
@@ -53,6 +94,8 @@ def get_key(path: str, default_value: Any = None) -> Any:
 
 
 def set_key(path: str, value: Any) -> None:
+    global __version
+
     keys: list[str] = path.split("/")
     current: dict[str, Any] = __data
 
@@ -65,14 +108,25 @@ def set_key(path: str, value: Any) -> None:
             current = current[key]
 
         final_key = keys[-1]
-        current[final_key] = value
-
-        save()
+        with __lock:
+            current[final_key] = value
+            __version += 1
+        __schedule_save()
     except (KeyError, TypeError, IndexError):
         print(f"Failed to set setting '{path}'.")
         pass
 
 
+def __schedule_save() -> None:
+    global __save_timer
+
+    with __lock:
+        if __save_timer is None:
+            __save_timer = threading.Timer(SAVE_DELAY, flush)
+            __save_timer.daemon = True
+            __save_timer.start()
+
+
 def __validate_and_fix_types(loaded_data: dict[str, Any], default_data: dict[str, Any]) -> dict[str, Any]:
     result: dict[str, Any] = {}
 
@@ -96,3 +150,6 @@ def __validate_and_fix_types(loaded_data: dict[str, Any], default_data: dict[str
             result[key] = default_value
 
     return result
+
+
+atexit.register(flush)
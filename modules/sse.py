@@ -0,0 +1,133 @@
+from typing import Any
+from collections.abc import AsyncIterator
+import json
+
+import httpx
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data: bytes | str) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class Event:
+    def __init__(self, event: str, data: bytes) -> None:
+        self.event: str = event
+        self.data: bytes = data
+
+    def is_done(self) -> bool:
+        return self.data == b"[DONE]"
+
+    def json(self) -> Any:
+        return loads(self.data)
+
+    def get_error_message(self) -> str:
+        # Errors come either as the body of a failed request ({"error": {"message": ...}})
+        # or as an "error:" line in the middle of a stream ({"message": ...}).
+        try:
+            error_data: Any = self.json()
+            if isinstance(error_data, dict) and "error" in error_data:
+                error_data = error_data["error"]
+            if isinstance(error_data, dict):
+                return str(error_data.get("message", ""))  # type: ignore
+        except ValueError:
+            pass
+        return self.data.decode(errors="replace")
+
+
+class Decoder:
+    def __init__(self) -> None:
+        self._buffer: bytes = b""
+        self._event_type: str = "message"
+        self._data_lines: list[bytes] = []
+
+    def feed(self, chunk: bytes) -> list[Event]:
+        events: list[Event] = []
+
+        lines: list[bytes] = (self._buffer + chunk).split(b"\n") if len(self._buffer) > 0 else chunk.split(b"\n")
+        self._buffer = lines.pop()
+        for line in lines:
+            if line[-1:] == b"\r":
+                line = line[:-1]
+
+            # Fast path for the only line type llama.cpp sends per token.
+            if line[:6] == b"data: ":
+                self._data_lines.append(line[6:])
+                continue
+
+            event: Event | None = self.__process_line(line)
+            if event is not None:
+                events.append(event)
+
+        return events
+
+    def flush(self) -> list[Event]:
+        events: list[Event] = []
+
+        for line in (self._buffer.rstrip(b"\r"), b""):
+            event: Event | None = self.__process_line(line)
+            if event is not None:
+                events.append(event)
+        self._buffer = b""
+
+        return events
+
+    def __process_line(self, line: bytes) -> Event | None:
+        if len(line) == 0:
+            return self.__dispatch()
+        if line[0] == 0x3A:  # Comment (":").
+            return None
+
+        field: bytes
+        value: bytes
+        separator_index: int = line.find(b":")
+        if separator_index == -1:
+            field, value = line, b""
+        else:
+            field, value = line[:separator_index], line[separator_index + 1:]
+            if value[:1] == b" ":
+                value = value[1:]
+
+        match field:
+            case b"data":
+                self._data_lines.append(value)
+            case b"event":
+                self._event_type = value.decode()
+            case b"error":
+                # Not part of the SSE spec, but llama.cpp reports errors mid-stream this way.
+                self._event_type = "error"
+                self._data_lines.append(value)
+            case _:
+                pass
+        return None
+
+    def __dispatch(self) -> Event | None:
+        if len(self._data_lines) == 0:
+            self._event_type = "message"
+            return None
+
+        data: bytes = self._data_lines[0] if len(self._data_lines) == 1 else b"\n".join(self._data_lines)
+        event: Event = Event(self._event_type, data)
+        self._event_type = "message"
+        self._data_lines = []
+        return event
+
+
+async def aiter_events(response: httpx.Response) -> AsyncIterator[Event]:
+    # A request rejected before streaming starts is answered with a plain JSON body.
+    if response.status_code != 200 or not response.headers.get("content-type", "").startswith("text/event-stream"):
+        yield Event("error", await response.aread())
+        return
+
+    decoder: Decoder = Decoder()
+    async for chunk in response.aiter_bytes():
+        for event in decoder.feed(chunk):
+            yield event
+    for event in decoder.flush():
+        yield event
@@ -0,0 +1,29 @@
+import time
+
+
+# Imported by main.py right after Gradio. Anything before that (starting Python and
+# importing Gradio) happened before there was a clock to compare with, so it's only
+# known as the CPU time the process had used by then, which is most of it.
+__start_process_time: float = time.process_time()
+__last_time: float = time.perf_counter()
+__phases: list[tuple[str, float]] = []
+
+
+# Ends the current phase, which is named after what it was doing.
+def mark(phase: str) -> None:
+    global __last_time
+
+    current_time: float = time.perf_counter()
+    __phases.append((phase, current_time - __last_time))
+    __last_time = current_time
+
+
+def print_report() -> None:
+    lines: list[str] = [
+        f"Started in {(__start_process_time + sum(duration for _, duration in __phases)):.2f} s:",
+        f"    {"Starting Python and importing Gradio (CPU time)":<48} {__start_process_time * 1000.0:8.0f} ms",
+    ]
+    for phase, duration in __phases:
+        lines.append(f"    {phase:<48} {duration * 1000.0:8.0f} ms")
+    lines.append("For a breakdown of the imports, run with \"python -X importtime\".")
+    print("\n".join(lines))
@@ -0,0 +1,29 @@
+import time
+
+from modules.core import constants
+from modules import settings
+
+
+frames_saved: int = 0
+
+
+class StreamCoalescer:
+    def __init__(self) -> None:
+        self._flush_interval: float = settings.get_key("language_model/stream_flush_interval_ms", constants.DEFAULT_SETTINGS["language_model"]["stream_flush_interval_ms"]) / 1000.0
+        self._flush_tokens: int = settings.get_key("language_model/stream_flush_tokens", constants.DEFAULT_SETTINGS["language_model"]["stream_flush_tokens"])
+        self._pending_tokens: int = 0
+        self._last_flush_time: float = time.monotonic()
+
+    # Returns whether the caller should push an update to the UI for this delta.
+    def add(self) -> bool:
+        global frames_saved
+
+        self._pending_tokens += 1
+        current_time: float = time.monotonic()
+        if self._pending_tokens >= self._flush_tokens or current_time - self._last_flush_time >= self._flush_interval:
+            self._pending_tokens = 0
+            self._last_flush_time = current_time
+            return True
+
+        frames_saved += 1
+        return False
@@ -0,0 +1,160 @@
+from typing import Any
+import bisect
+
+import httpx
+
+from modules import lm_backend
+
+
+# Unchanged tokens redone before an edit, to check that tokenizing from there gives the same tokens.
+OVERLAP_TOKEN_COUNT: int = 4
+
+
+class TokenizedDocument:
+    def __init__(self) -> None:
+        # The tokenizer the tokens came from. The whole document is redone if it changes.
+        self.base_url: str | None = None
+        # The text itself is kept by the caller, which passes it back to `update` to compare with.
+        self._byte_length: int = 0
+        # The BOS token (if the model uses one), which llama.cpp doesn't add to token array prompts.
+        self._prefix_tokens: list[int] | None = None
+        self.tokens: list[int] = []
+        # UTF-8 byte offset of the end of each token's text. Only ever cut at one of these.
+        self._token_ends: list[int] = []
+        # Tokens generated with no text yet (e.g., half of a multi-byte character).
+        self._pending_tokens: list[int] = []
+
+    def clear(self) -> None:
+        self.base_url = None
+        self._byte_length = 0
+        self._prefix_tokens = None
+        self.tokens.clear()
+        self._token_ends.clear()
+        self._pending_tokens.clear()
+
+    # Returns the prompt for `text` as token IDs, tokenizing only what changed since
+    # `previous_text` (the text of the last call plus everything appended since), or None
+    # if the server can't report token pieces (older llama.cpp).
+    async def update(self, base_url: str, previous_text: str, text: str) -> list[int] | None:
+        if base_url != self.base_url:
+            self.clear()
+            self.base_url = base_url
+        if self._prefix_tokens is None:
+            prefix_tokens: list[Any] = await self.__tokenize("", True)
+            if not all(isinstance(token, dict) for token in prefix_tokens):
+                return None
+            self._prefix_tokens = [token["id"] for token in prefix_tokens]
+
+        # Everything from the first changed character on is redone, including the token
+        # before it, since the change may merge with it (e.g., "hel" + "lo").
+        text_bytes: bytes = text.encode()
+        common_length: int = len(text[:get_common_prefix_length(previous_text, text)].encode())
+        unchanged_token_count: int = bisect.bisect_right(self._token_ends, common_length)
+        kept_token_count: int
+        start_offset: int
+        kept_token_count, start_offset = self.__get_previous_boundary(self._token_ends[unchanged_token_count - 1] if unchanged_token_count > 0 else 0, text_bytes)
+        # A few unchanged tokens before that are redone too, to check that the tokenizer
+        # splits the text the same way when it starts there.
+        start_token_count: int = kept_token_count
+        for _ in range(OVERLAP_TOKEN_COUNT):
+            if start_offset == 0:
+                break
+            start_token_count, start_offset = self.__get_previous_boundary(start_offset, text_bytes)
+
+        new_tokens: list[int] = []
+        new_token_ends: list[int] = []
+        if start_offset < len(text_bytes):
+            new_token_data: list[Any] = await self.__tokenize(text_bytes[start_offset:].decode(), False)
+            if not all(isinstance(token, dict) for token in new_token_data):
+                self.clear()
+                return None
+            new_tokens, new_token_ends = self.__get_token_ends(new_token_data, start_offset)
+
+        # The cached tokens are kept up to where the redone ones first differ. If even the first
+        # one does, the tokenizer isn't prefix-stable there (e.g., SentencePiece adds a space to
+        # the start of the text), so the whole document is tokenized instead.
+        matching_count: int = 0
+        while (
+            start_token_count + matching_count < kept_token_count and matching_count < len(new_tokens)
+            and new_tokens[matching_count] == self.tokens[start_token_count + matching_count]
+            and new_token_ends[matching_count] == self._token_ends[start_token_count + matching_count]
+        ):
+            matching_count += 1
+        if matching_count == 0 and start_token_count < kept_token_count:
+            start_token_count = 0
+            new_token_data = await self.__tokenize(text, False)
+            if not all(isinstance(token, dict) for token in new_token_data):
+                self.clear()
+                return None
+            new_tokens, new_token_ends = self.__get_token_ends(new_token_data, 0)
+
+        del self.tokens[start_token_count + matching_count:]
+        del self._token_ends[start_token_count + matching_count:]
+        self._pending_tokens.clear()
+        self.tokens += new_tokens[matching_count:]
+        self._token_ends += new_token_ends[matching_count:]
+
+        self._byte_length = len(text_bytes)
+        return self._prefix_tokens + self.tokens
+
+    # Adds generated text along with the token IDs the server reports for it (None if it doesn't).
+    def append(self, text: str, tokens: list[int] | None) -> None:
+        is_fully_tokenized: bool = (self._token_ends[-1] if len(self._token_ends) > 0 else 0) == self._byte_length
+        self._byte_length += len(text.encode())
+
+        # Once some text is missing its tokens, the rest is left for the next `update` to tokenize.
+        if tokens is None or not is_fully_tokenized:
+            self._pending_tokens.clear()
+            return
+        self._pending_tokens += tokens
+        if len(text) > 0:
+            self.tokens += self._pending_tokens
+            self._token_ends += [self._byte_length] * len(self._pending_tokens)
+            self._pending_tokens.clear()
+
+    # The token count and byte offset of the last token boundary before `byte_offset`. Several generated
+    # tokens can share one end offset, so whole groups are dropped at a time, and never half a character.
+    def __get_previous_boundary(self, byte_offset: int, text_bytes: bytes) -> tuple[int, int]:
+        while True:
+            token_count: int = bisect.bisect_left(self._token_ends, byte_offset)
+            byte_offset = self._token_ends[token_count - 1] if token_count > 0 else 0
+            if byte_offset == 0 or byte_offset >= len(text_bytes) or text_bytes[byte_offset] & 0xC0 != 0x80:
+                return token_count, byte_offset
+
+    # The IDs and end offsets of tokens from /tokenize, for text that starts at `start_offset`.
+    @staticmethod
+    def __get_token_ends(token_data: list[dict[str, Any]], start_offset: int) -> tuple[list[int], list[int]]:
+        tokens: list[int] = []
+        token_ends: list[int] = []
+        token_end: int = start_offset
+        for token in token_data:
+            piece: str | list[int] = token["piece"]
+            token_end += len(piece.encode()) if isinstance(piece, str) else len(piece)
+            tokens.append(token["id"])
+            token_ends.append(token_end)
+        return tokens, token_ends
+
+    async def __tokenize(self, text: str, add_special: bool) -> list[Any]:
+        response: httpx.Response = await lm_backend.get_client().request(
+            "POST",
+            f"{self.base_url}/tokenize",
+            json={
+                "content": text,
+                "add_special": add_special,
+                "with_pieces": True,
+            },
+        )
+        return response.json()["tokens"]
+
+
+# Found by comparing halves at C speed instead of character by character.
+def get_common_prefix_length(text_1: str, text_2: str) -> int:
+    low: int = 0
+    high: int = min(len(text_1), len(text_2))
+    while low < high:
+        middle: int = (low + high + 1) // 2
+        if text_1[low:middle] == text_2[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
@@ -9,30 +9,37 @@ from modules import settings
 class SettingComponent:
     __used_ids: set[int] = set({})
 
-    def __init__(self, key: str, default_value: Any = None, **kwargs: Any) -> None:
+    # Components built inside `gr.render` are created per page (with the current settings) and
+    # must pass `register=False`, as they can't be outputs of events defined outside of it.
+    def __init__(self, key: str, default_value: Any = None, register: bool = True, **kwargs: Any) -> None:
         self.instance: gr.Component | None = None
         self.event: Any = None
-        self._unique_id: int = 0
-
-        while self._unique_id in self.__used_ids:
-            self._unique_id += 1
-        self.__used_ids.add(self._unique_id)
+        self._unique_id: int = -1
+        self._register: bool = register
 
     def _add_to_shared(self) -> None:
         if self.instance is None:
             raise ReferenceError
+        if not self._register:
+            return
+
+        self._unique_id = 0
+        while self._unique_id in self.__used_ids:
+            self._unique_id += 1
+        self.__used_ids.add(self._unique_id)
         shared.setting_components.append(self.instance)
         shared.setting_component_values[self._unique_id] = self.instance.value
 
     @staticmethod
     def _on_change(unique_id: int, key: str, value: Any) -> None:
-        shared.setting_component_values[unique_id] = value
+        if unique_id in shared.setting_component_values:
+            shared.setting_component_values[unique_id] = value
         settings.set_key(key, value)
 
 
 class Checkbox(SettingComponent):
-    def __init__(self, key: str, default_value: Any = None, **kwargs: Any) -> None:
-        super().__init__(key, default_value, **kwargs)
+    def __init__(self, key: str, default_value: Any = None, register: bool = True, **kwargs: Any) -> None:
+        super().__init__(key, default_value, register, **kwargs)
         kwargs["value"] = settings.get_key(key, default_value)
 
         self.instance = gr.Checkbox(**kwargs)
@@ -45,8 +52,8 @@ class Checkbox(SettingComponent):
 
 
 class Dropdown(SettingComponent):
-    def __init__(self, key: str, default_value: Any = None, **kwargs: Any) -> None:
-        super().__init__(key, default_value, **kwargs)
+    def __init__(self, key: str, default_value: Any = None, register: bool = True, **kwargs: Any) -> None:
+        super().__init__(key, default_value, register, **kwargs)
         kwargs["value"] = settings.get_key(key, default_value)
 
         self.instance = gr.Dropdown(**kwargs)
@@ -59,8 +66,8 @@ class Dropdown(SettingComponent):
 
 
 class Number(SettingComponent):
-    def __init__(self, key: str, default_value: Any = None, **kwargs: Any) -> None:
-        super().__init__(key, default_value, **kwargs)
+    def __init__(self, key: str, default_value: Any = None, register: bool = True, **kwargs: Any) -> None:
+        super().__init__(key, default_value, register, **kwargs)
         kwargs["value"] = settings.get_key(key, default_value)
 
         self.instance = gr.Number(**kwargs)
@@ -73,8 +80,8 @@ class Number(SettingComponent):
 
 
 class Slider(SettingComponent):
-    def __init__(self, key: str, default_value: Any = None, **kwargs: Any) -> None:
-        super().__init__(key, default_value, **kwargs)
+    def __init__(self, key: str, default_value: Any = None, register: bool = True, **kwargs: Any) -> None:
+        super().__init__(key, default_value, register, **kwargs)
         kwargs["value"] = settings.get_key(key, default_value)
         kwargs["show_reset_button"] = False
 
@@ -87,9 +94,23 @@ class Slider(SettingComponent):
         self._add_to_shared()
 
 
+class Textbox(SettingComponent):
+    def __init__(self, key: str, default_value: Any = None, register: bool = True, **kwargs: Any) -> None:
+        super().__init__(key, default_value, register, **kwargs)
+        kwargs["value"] = settings.get_key(key, default_value)
+
+        self.instance = gr.Textbox(**kwargs)
+        self.event = self.instance.change(
+            fn=lambda value: self._on_change(self._unique_id, key, value),  # type: ignore
+            inputs=self.instance,
+        )
+
+        self._add_to_shared()
+
+
 class TextArea(SettingComponent):
-    def __init__(self, key: str, default_value: Any = None, **kwargs: Any) -> None:
-        super().__init__(key, default_value, **kwargs)
+    def __init__(self, key: str, default_value: Any = None, register: bool = True, **kwargs: Any) -> None:
+        super().__init__(key, default_value, register, **kwargs)
         kwargs["value"] = settings.get_key(key, default_value)
 
         self.instance = gr.TextArea(**kwargs)
@@ -1,12 +1,16 @@
 from typing import Any
 
 import gradio as gr
-import asyncio
 import httpx
 
 from modules.core import constants
 from modules.core import shared
+from modules import settings
+from modules import sessions
+from modules import conversation_store
 from modules import lm_backend
+from modules import stream_coalescer
+from modules import metrics
 from modules.ui import setting_components
 
 
@@ -18,7 +22,32 @@ class Element:
                 BLAS-CHAT
             </h1>
             """)
+            with gr.Accordion("Conversations"):
+                self.new_chat_button: gr.Button = gr.Button(
+                    value="New Chat",
+                    variant="primary",
+                    interactive=True,
+                )
+                self.conversation_dropdown: gr.Dropdown = gr.Dropdown(
+                    choices=[],
+                    value=None,
+                    label="Open Conversation",
+                    interactive=True,
+                )
+                self.delete_conversation_button: gr.Button = gr.Button(
+                    value="Delete Conversation",
+                    variant="stop",
+                    size="sm",
+                    interactive=True,
+                )
             with gr.Accordion("Server"):
+                self.host_textbox: setting_components.Textbox = setting_components.Textbox(
+                    key="language_model/host",
+                    default_value=constants.DEFAULT_SETTINGS["language_model"]["host"],
+                    label="Host",
+                    placeholder="http://localhost",
+                    interactive=True,
+                )
                 self.port_number: setting_components.Number = setting_components.Number(
                     key="language_model/port",
                     default_value=constants.DEFAULT_SETTINGS["language_model"]["port"],
@@ -29,6 +58,18 @@ class Element:
                     minimum=0.0,
                     maximum=65535.0,
                 )
+                self.extra_backends_text_area: setting_components.TextArea = setting_components.TextArea(
+                    key="language_model/extra_backends",
+                    default_value=constants.DEFAULT_SETTINGS["language_model"]["extra_backends"],
+                    lines=2,
+                    max_lines=5,
+                    placeholder="http://localhost:8081",
+                    label="Additional Servers (One Per Line)",
+                    interactive=True,
+                )
+                self.server_status: gr.Markdown = gr.Markdown("**Servers:** Unknown")
+                # Server health only changes as often as the prober checks it.
+                self.server_status_timer: gr.Timer = gr.Timer(value=min(max(lm_backend.get_health_check_ttl() / 2.0, 2.0), 5.0))
                 gr.Markdown("---")
                 self.vision_status: gr.Markdown = gr.Markdown("**Vision:** False")
                 self.audio_status: gr.Markdown = gr.Markdown("**Audio:** False")
@@ -44,6 +85,72 @@ class Element:
                     label="Streaming",
                     interactive=True,
                 )
+                self.stream_flush_interval_slider: setting_components.Slider = setting_components.Slider(
+                    key="language_model/stream_flush_interval_ms",
+                    default_value=constants.DEFAULT_SETTINGS["language_model"]["stream_flush_interval_ms"],
+                    minimum=0.0,
+                    maximum=500.0,
+                    step=10.0,
+                    label="Update Interval (ms)",
+                    interactive=True,
+                )
+                self.stream_flush_tokens_slider: setting_components.Slider = setting_components.Slider(
+                    key="language_model/stream_flush_tokens",
+                    default_value=constants.DEFAULT_SETTINGS["language_model"]["stream_flush_tokens"],
+                    minimum=1.0,
+                    maximum=64.0,
+                    step=1.0,
+                    label="Tokens Per Update",
+                    interactive=True,
+                )
+                self.frames_saved_status: gr.Markdown = gr.Markdown("**UI Updates Saved:** 0")
+                self.queue_status: gr.Markdown = gr.Markdown("**Queue Position:** Not Queued")
+                self.prompt_status: gr.Markdown = gr.Markdown("**Last Prompt:** None")
+                self.generation_status: gr.Markdown = gr.Markdown("**Generations:** None")
+
+    @staticmethod
+    def update_conversation_dropdown(request: gr.Request):
+        list_size: int = settings.get_key("chat/conversation_list_size", constants.DEFAULT_SETTINGS["chat"]["conversation_list_size"])
+        return gr.update(
+            choices=[(title, conversation_id) for conversation_id, title in conversation_store.list_conversations(list_size)],
+            value=sessions.get(request).chat_conversation.id,
+        )
+
+    @staticmethod
+    def on_server_status_timer_tick(port: int, request: gr.Request):
+        server_status: str = "**Servers:**"
+        for base_url, is_healthy, in_flight in lm_backend.get_backend_statuses(port):
+            health_status: str
+            match is_healthy:
+                case True:
+                    health_status = "Online"
+                case False:
+                    health_status = "Offline"
+                case _:
+                    health_status = "Unknown"
+            server_status += f"\n- `{base_url}`: {health_status}, {in_flight} in flight"
+        queue_position: int | None = lm_backend.get_queue_position(request.session_hash)
+        session: sessions.Session = sessions.get(request)
+
+        # llama.cpp only counts the tokens it had to process; the rest came from the slot's cache.
+        prompt_status: str = "**Last Prompt:** None"
+        timings: dict[str, Any] | None = session.last_timings
+        if timings is not None and "prompt_n" in timings:
+            prompt_status = f"**Last Prompt:** {timings["prompt_n"]} tokens processed in {timings.get("prompt_ms", 0.0):.0f} ms"
+            if "cache_n" in timings:
+                prompt_status += f", {timings["cache_n"]} reused from cache"
+        status_texts: tuple[str, ...] = (
+            server_status,
+            f"**UI Updates Saved:** {stream_coalescer.frames_saved}",
+            f"**Queue Position:** {queue_position if queue_position is not None else "Not Queued"}",
+            prompt_status,
+            metrics.get_summary(),
+        )
+
+        # Only what changed since the last tick is sent to the page.
+        sent_status_texts: tuple[str, ...] = session.sent_status_texts or (None,) * len(status_texts)  # type: ignore
+        session.sent_status_texts = status_texts
+        return tuple(gr.skip() if status_text == sent_status_text else status_text for status_text, sent_status_text in zip(status_texts, sent_status_texts))
 
     async def on_refresh_model_info_button_click(self, port: int):
         left_buttons: list[str] = [
@@ -57,10 +164,10 @@ class Element:
             gr.update(value="Refreshing...", interactive=False),
             gr.update(),
         )
-        async with httpx.AsyncClient() as client:
+        base_url: str | None = await lm_backend.pick_backend(port)
+        if base_url is not None:
             try:
-                task = asyncio.create_task(client.request("GET", f"http://localhost:{port}/props"))
-                response: httpx.Response = await task
+                response: httpx.Response = await lm_backend.get_client().request("GET", f"{base_url}/props")
                 response_data: dict[str, Any] = response.json()
 
                 shared.model_modalities["vision"] = response_data["modalities"]["vision"]
@@ -71,8 +178,9 @@ class Element:
                 if shared.model_modalities["audio"]:
                     left_buttons.append("microphone")
                     file_extensions += constants.AUDIO_FILE_EXTENSIONS.copy()
-            except httpx.ConnectError:
-                lm_backend.issue_connection_warning(port)
+            except httpx.TransportError:
+                lm_backend.mark_backend_unhealthy(base_url)
+                lm_backend.issue_connection_warning(base_url)
         yield (
             f"**Vision:** {shared.model_modalities["vision"]}",
             f"**Audio:** {shared.model_modalities["audio"]}",
@@ -1,9 +1,23 @@
 import gradio as gr
 
 from modules.core import constants
+from modules import settings
 from modules.ui import setting_components
 
 
+LAZY_SETTING_KEYS: tuple[str, ...] = (
+    "mirostat_mode",
+    "mirostat_tau",
+    "mirostat_eta",
+    "dry_base",
+    "dry_multiplier",
+    "dry_allowed_length",
+    "dry_penalty_range",
+    "xtc_threshold",
+    "xtc_probability",
+)
+
+
 class Element:
     def __init__(self) -> None:
         with gr.Sidebar(position="right"):
@@ -97,133 +111,24 @@ class Element:
                     label="Frequency Penalty",
                     interactive=True,
                 )
-            with gr.Accordion("Mirostat"):
-                self.mirostat_mode_dropdown: setting_components.Dropdown = setting_components.Dropdown(
-                    key="language_model/mirostat_mode",
-                    default_value=constants.DEFAULT_SETTINGS["language_model"]["mirostat_mode"],
-                    choices=(
-                        "Off",
-                        "Version 1.0",
-                        "Version 2.0",
-                    ),
-                    label="Mode",
-                    interactive=True,
-                )
-                self.mirostat_tau_slider: setting_components.Slider = setting_components.Slider(
-                    key="language_model/mirostat_tau",
-                    default_value=constants.DEFAULT_SETTINGS["language_model"]["mirostat_tau"],
-                    minimum=0.0,
-                    maximum=30.0,
-                    step=0.01,
-                    label="Tau",
-                    interactive=True,
-                    visible=False,
-                )
-                self.mirostat_eta_slider: setting_components.Slider = setting_components.Slider(
-                    key="language_model/mirostat_eta",
-                    default_value=constants.DEFAULT_SETTINGS["language_model"]["mirostat_eta"],
-                    minimum=0.0,
-                    maximum=10.0,
-                    step=0.01,
-                    label="Eta",
-                    interactive=True,
-                    visible=False,
-                )
-            with gr.Accordion("Don't Repeat Yourself (DRY)"):
-                self.dry_base_slider: setting_components.Slider = setting_components.Slider(
-                    key="language_model/dry_base",
-                    default_value=constants.DEFAULT_SETTINGS["language_model"]["dry_base"],
-                    minimum=0.0,
-                    maximum=8.0,
-                    step=0.01,
-                    label="Base",
-                    interactive=True,
-                )
-                self.dry_multiplier_slider: setting_components.Slider = setting_components.Slider(
-                    key="language_model/dry_multiplier",
-                    default_value=constants.DEFAULT_SETTINGS["language_model"]["dry_multiplier"],
-                    minimum=0.0,
-                    maximum=100.0,
-                    step=0.01,
-                    label="Multiplier",
-                    interactive=True,
-                )
-                self.dry_allowed_length_slider: setting_components.Slider = setting_components.Slider(
-                    key="language_model/dry_allowed_length",
-                    default_value=constants.DEFAULT_SETTINGS["language_model"]["dry_allowed_length"],
-                    minimum=0.0,
-                    maximum=100.0,
-                    step=1.0,
-                    precision=0,
-                    label="Allowed Length",
-                    interactive=True,
-                )
-                self.dry_penalty_range_slider: setting_components.Slider = setting_components.Slider(
-                    key="language_model/dry_penalty_range",
-                    default_value=constants.DEFAULT_SETTINGS["language_model"]["dry_penalty_range"],
-                    minimum=-1.0,
-                    maximum=256.0,
-                    step=1.0,
-                    precision=0,
-                    label="Penalty Range",
-                    info="`-1` = context size",
-                    interactive=True,
-                )
-            with gr.Accordion("Exclude Top Choices (XTC)"):
-                self.xtc_threshold_slider: setting_components.Slider = setting_components.Slider(
-                    key="language_model/xtc_threshold",
-                    default_value=constants.DEFAULT_SETTINGS["language_model"]["xtc_threshold"],
-                    minimum=0.0,
-                    maximum=1.0,
-                    step=0.01,
-                    label="Threshold",
-                    interactive=True,
-                )
-                self.xtc_probability_slider: setting_components.Slider = setting_components.Slider(
-                    key="language_model/xtc_probability",
-                    value=constants.DEFAULT_SETTINGS["language_model"]["xtc_probability"],
-                    minimum=0.0,
-                    maximum=1.0,
-                    step=0.01,
-                    label="Probability",
-                    interactive=True,
-                )
+            # Rarely used, so these are only built (per page) once opened, which keeps them out
+            # of the initial page and of the setting values sent on every page load.
+            self.reset_count: gr.State = gr.State(0)
+            with gr.Accordion("Mirostat", open=False) as self.mirostat_accordion:
+                gr.render(triggers=[self.mirostat_accordion.expand, self.reset_count.change])(self.__build_mirostat_panel)
+            with gr.Accordion("Don't Repeat Yourself (DRY)", open=False) as self.dry_accordion:
+                gr.render(triggers=[self.dry_accordion.expand, self.reset_count.change])(self.__build_dry_panel)
+            with gr.Accordion("Exclude Top Choices (XTC)", open=False) as self.xtc_accordion:
+                gr.render(triggers=[self.xtc_accordion.expand, self.reset_count.change])(self.__build_xtc_panel)
             self.reset_button: gr.Button = gr.Button(
                 value="Reset to Defaults",
                 variant="stop",
                 interactive=True,
             )
 
-            self.mirostat_mode_dropdown.event.then(
-                fn=lambda value: (gr.update(visible=value != "Off"), gr.update(visible=value != "Off")),  # type: ignore
-                inputs=self.mirostat_mode_dropdown.instance,
-                outputs=(
-                    self.mirostat_tau_slider.instance,
-                    self.mirostat_eta_slider.instance,
-                ),
-                show_progress="hidden",
-            )
             self.reset_button.click(
-                fn=lambda: (
-                    constants.DEFAULT_SETTINGS["language_model"]["temperature"],
-                    constants.DEFAULT_SETTINGS["language_model"]["top_k"],
-                    constants.DEFAULT_SETTINGS["language_model"]["top_p"],
-                    constants.DEFAULT_SETTINGS["language_model"]["min_p"],
-                    constants.DEFAULT_SETTINGS["language_model"]["typical_p"],
-                    constants.DEFAULT_SETTINGS["language_model"]["repetition_penalty"],
-                    constants.DEFAULT_SETTINGS["language_model"]["repetition_penalty_range"],
-                    constants.DEFAULT_SETTINGS["language_model"]["presence_penalty"],
-                    constants.DEFAULT_SETTINGS["language_model"]["frequency_penalty"],
-                    constants.DEFAULT_SETTINGS["language_model"]["mirostat_mode"],
-                    constants.DEFAULT_SETTINGS["language_model"]["mirostat_tau"],
-                    constants.DEFAULT_SETTINGS["language_model"]["mirostat_eta"],
-                    constants.DEFAULT_SETTINGS["language_model"]["dry_base"],
-                    constants.DEFAULT_SETTINGS["language_model"]["dry_multiplier"],
-                    constants.DEFAULT_SETTINGS["language_model"]["dry_allowed_length"],
-                    constants.DEFAULT_SETTINGS["language_model"]["dry_penalty_range"],
-                    constants.DEFAULT_SETTINGS["language_model"]["xtc_threshold"],
-                    constants.DEFAULT_SETTINGS["language_model"]["xtc_probability"],
-                ),
+                fn=self.on_reset_button_click,
+                inputs=self.reset_count,
                 outputs=(  # type: ignore
                     self.temperature_slider.instance,
                     self.top_k_slider.instance,
@@ -234,15 +139,141 @@ class Element:
                     self.repetition_penalty_range_slider.instance,
                     self.presence_penalty_slider.instance,
                     self.frequency_penalty_slider.instance,
-                    self.mirostat_mode_dropdown.instance,
-                    self.mirostat_tau_slider.instance,
-                    self.mirostat_eta_slider.instance,
-                    self.dry_base_slider.instance,
-                    self.dry_multiplier_slider.instance,
-                    self.dry_allowed_length_slider.instance,
-                    self.dry_penalty_range_slider.instance,
-                    self.xtc_threshold_slider.instance,
-                    self.xtc_probability_slider.instance,
+                    self.reset_count,
                 ),
                 show_progress="hidden",
             )
+
+    @staticmethod
+    def on_reset_button_click(reset_count: int):
+        # The lazily built panels aren't outputs here, so their settings are reset directly
+        # and the panels rebuilt from them by the reset count changing.
+        for key in LAZY_SETTING_KEYS:
+            settings.set_key(f"language_model/{key}", constants.DEFAULT_SETTINGS["language_model"][key])
+        return (
+            constants.DEFAULT_SETTINGS["language_model"]["temperature"],
+            constants.DEFAULT_SETTINGS["language_model"]["top_k"],
+            constants.DEFAULT_SETTINGS["language_model"]["top_p"],
+            constants.DEFAULT_SETTINGS["language_model"]["min_p"],
+            constants.DEFAULT_SETTINGS["language_model"]["typical_p"],
+            constants.DEFAULT_SETTINGS["language_model"]["repetition_penalty"],
+            constants.DEFAULT_SETTINGS["language_model"]["repetition_penalty_range"],
+            constants.DEFAULT_SETTINGS["language_model"]["presence_penalty"],
+            constants.DEFAULT_SETTINGS["language_model"]["frequency_penalty"],
+            reset_count + 1,
+        )
+
+    @staticmethod
+    def __build_mirostat_panel():
+        mirostat_mode_dropdown: setting_components.Dropdown = setting_components.Dropdown(
+            key="language_model/mirostat_mode",
+            default_value=constants.DEFAULT_SETTINGS["language_model"]["mirostat_mode"],
+            register=False,
+            choices=(
+                "Off",
+                "Version 1.0",
+                "Version 2.0",
+            ),
+            label="Mode",
+            interactive=True,
+        )
+        mirostat_tau_slider: setting_components.Slider = setting_components.Slider(
+            key="language_model/mirostat_tau",
+            default_value=constants.DEFAULT_SETTINGS["language_model"]["mirostat_tau"],
+            register=False,
+            minimum=0.0,
+            maximum=30.0,
+            step=0.01,
+            label="Tau",
+            interactive=True,
+            visible=mirostat_mode_dropdown.instance.value != "Off",
+        )
+        mirostat_eta_slider: setting_components.Slider = setting_components.Slider(
+            key="language_model/mirostat_eta",
+            default_value=constants.DEFAULT_SETTINGS["language_model"]["mirostat_eta"],
+            register=False,
+            minimum=0.0,
+            maximum=10.0,
+            step=0.01,
+            label="Eta",
+            interactive=True,
+            visible=mirostat_mode_dropdown.instance.value != "Off",
+        )
+        mirostat_mode_dropdown.event.then(
+            fn=lambda value: (gr.update(visible=value != "Off"), gr.update(visible=value != "Off")),  # type: ignore
+            inputs=mirostat_mode_dropdown.instance,
+            outputs=(
+                mirostat_tau_slider.instance,
+                mirostat_eta_slider.instance,
+            ),
+            show_progress="hidden",
+        )
+
+    @staticmethod
+    def __build_dry_panel():
+        setting_components.Slider(
+            key="language_model/dry_base",
+            default_value=constants.DEFAULT_SETTINGS["language_model"]["dry_base"],
+            register=False,
+            minimum=0.0,
+            maximum=8.0,
+            step=0.01,
+            label="Base",
+            interactive=True,
+        )
+        setting_components.Slider(
+            key="language_model/dry_multiplier",
+            default_value=constants.DEFAULT_SETTINGS["language_model"]["dry_multiplier"],
+            register=False,
+            minimum=0.0,
+            maximum=100.0,
+            step=0.01,
+            label="Multiplier",
+            interactive=True,
+        )
+        setting_components.Slider(
+            key="language_model/dry_allowed_length",
+            default_value=constants.DEFAULT_SETTINGS["language_model"]["dry_allowed_length"],
+            register=False,
+            minimum=0.0,
+            maximum=100.0,
+            step=1.0,
+            precision=0,
+            label="Allowed Length",
+            interactive=True,
+        )
+        setting_components.Slider(
+            key="language_model/dry_penalty_range",
+            default_value=constants.DEFAULT_SETTINGS["language_model"]["dry_penalty_range"],
+            register=False,
+            minimum=-1.0,
+            maximum=256.0,
+            step=1.0,
+            precision=0,
+            label="Penalty Range",
+            info="`-1` = context size",
+            interactive=True,
+        )
+
+    @staticmethod
+    def __build_xtc_panel():
+        setting_components.Slider(
+            key="language_model/xtc_threshold",
+            default_value=constants.DEFAULT_SETTINGS["language_model"]["xtc_threshold"],
+            register=False,
+            minimum=0.0,
+            maximum=1.0,
+            step=0.01,
+            label="Threshold",
+            interactive=True,
+        )
+        setting_components.Slider(
+            key="language_model/xtc_probability",
+            default_value=constants.DEFAULT_SETTINGS["language_model"]["xtc_probability"],
+            register=False,
+            minimum=0.0,
+            maximum=1.0,
+            step=0.01,
+            label="Probability",
+            interactive=True,
+        )
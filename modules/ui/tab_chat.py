@@ -1,54 +1,119 @@
 from typing import Any
 import os
-import json
-import base64
+import random
+import time
 
 import gradio as gr
 import asyncio
 import httpx
 
 from modules.core import constants
-from modules.core import shared
+from modules import settings
+from modules import sessions
+from modules import conversation
+from modules import conversation_store
 from modules import lm_backend
+from modules import stream_coalescer
+from modules import context_manager
+from modules import metrics
+from modules import sse
 
 
-def set_chatbot():
-    rendered_history: list[gr.MessageDict] = []
-    for message in shared.chat_history:
-        rendered_history.append({
-            "role": message.role,
-            "content": message.content,  # type: ignore
-            "metadata": message.metadata,
-            "options": message.options,
-        })
-    return rendered_history
+# How much of the end of each extra candidate is shown while they are generated.
+CANDIDATE_PREVIEW_LENGTH: int = 80
 
 
-def on_chatbot_retry():
-    shared.chat_history.pop()
-    return shared.chat_history
+def set_chatbot(request: gr.Request | None = None):
+    return sessions.get(request).chat_conversation.get_rendered_history()
 
 
-def on_chatbot_undo(undo_data: gr.UndoData):
-    __delete_last_exchange()
+def on_chatbot_retry(request: gr.Request):
+    session: sessions.Session = sessions.get(request)
+    session.chat_conversation.pop()
+    session.chat_conversation.save()
+    return session.chat_conversation.get_rendered_history()
+
+
+def on_chatbot_undo(undo_data: gr.UndoData, request: gr.Request):
+    session: sessions.Session = sessions.get(request)
+    __delete_last_exchange(session)
+    session.chat_conversation.save()
     return (
-        shared.chat_history,
+        session.chat_conversation.get_rendered_history(),
         undo_data.value,
     )
 
 
+def on_chatbot_edit(edit_data: gr.EditData, request: gr.Request):
+    session: sessions.Session = sessions.get(request)
+    index: int = session.chat_conversation.get_render_start() + edit_data.index  # type: ignore
+    if isinstance(edit_data.value, str) and index < len(session.chat_conversation):
+        session.chat_conversation.set_content(index, edit_data.value)
+        session.chat_conversation.save()
+    return session.chat_conversation.get_rendered_history()
+
+
+# Shows the candidate the user picked. All candidates stay in the options, so it can be undone.
+def on_chatbot_option_select(select_data: gr.SelectData, is_chat_busy: bool, request: gr.Request):
+    session: sessions.Session = sessions.get(request)
+    index: int = len(session.chat_conversation) - 1
+    if not is_chat_busy and index >= 0 and session.chat_conversation.history[index].role == "assistant":
+        candidate_texts: list[str] = [option["value"] for option in session.chat_conversation.history[index].options]
+        if isinstance(select_data.index, int) and select_data.index < len(candidate_texts):
+            session.chat_conversation.set_content(index, candidate_texts[select_data.index])
+            session.chat_conversation.set_options(index, __get_candidate_options(candidate_texts, select_data.index))
+            session.chat_conversation.save()
+    return session.chat_conversation.get_rendered_history()
+
+
+def on_load_older_button_click(request: gr.Request):
+    session: sessions.Session = sessions.get(request)
+    session.chat_conversation.load_older_messages()
+    return session.chat_conversation.get_rendered_history()
+
+
 def on_chatbot_example_select(select_data: gr.SelectData):
     return select_data.value
 
 
-def on_chatbot_clear(is_assistant_busy: bool):
-    if not is_assistant_busy:
-        shared.chat_history.clear()
-    return shared.chat_history
+# Like "New Chat": the stored conversation stays in the list. Deleting it is a separate button.
+def on_chatbot_clear(is_chat_busy: bool, request: gr.Request):
+    session: sessions.Session = sessions.get(request)
+    if not is_chat_busy:
+        session.chat_conversation = conversation.Conversation()
+    return session.chat_conversation.get_rendered_history()
+
+
+# `conversation_id` is None if the user didn't confirm.
+def on_delete_conversation_button_click(conversation_id: int | None, is_chat_busy: bool, request: gr.Request):
+    session: sessions.Session = sessions.get(request)
+    if not is_chat_busy and conversation_id is not None:
+        conversation_store.delete_conversation(conversation_id)
+        if session.chat_conversation.id == conversation_id:
+            session.chat_conversation = conversation.Conversation()
+        # Other tabs that have it open keep their copy, which is stored again as a new conversation.
+        for other_session in sessions.get_all():
+            if other_session.chat_conversation.id == conversation_id:
+                other_session.chat_conversation.detach()
+    return session.chat_conversation.get_rendered_history()
+
+
+def on_new_chat_button_click(is_chat_busy: bool, request: gr.Request):
+    session: sessions.Session = sessions.get(request)
+    if not is_chat_busy:
+        session.chat_conversation = conversation.Conversation()
+    return session.chat_conversation.get_rendered_history()
+
+
+def on_conversation_dropdown_input(conversation_id: int | None, is_chat_busy: bool, request: gr.Request):
+    session: sessions.Session = sessions.get(request)
+    if not is_chat_busy and conversation_id is not None and conversation_id != session.chat_conversation.id:
+        session.chat_conversation = conversation.load(conversation_id)
+    return session.chat_conversation.get_rendered_history()
 
 
-def create_user_message(prompt: dict[str, Any], system_prompt: str, is_assistant_busy: bool):
-    if is_assistant_busy:
+def create_user_message(prompt: dict[str, Any], system_prompt: str, is_chat_busy: bool, request: gr.Request):
+    if is_chat_busy:
         raise gr.Error(visible=False, print_exception=False)
 
     if prompt["text"].rstrip() == "" and len(prompt["files"]) == 0:
@@ -57,155 +122,374 @@ def create_user_message(prompt: dict[str, Any], system_prompt: str, is_assistant
     if len(prompt["files"]) > 3:
         raise gr.Error("You cannot send more than 3 files.", print_exception=False)
 
-    if len(shared.chat_history) == 0:
-        shared.chat_history.append(gr.ChatMessage(system_prompt, "system"))
-    else:
-        shared.chat_history[0].content = system_prompt
+    session: sessions.Session = sessions.get(request)
+    session.chat_conversation.set_system_prompt(system_prompt)
 
     for file_path in prompt["files"]:
-        shared.chat_history.append(gr.ChatMessage(gr.FileData(path=file_path, orig_name=os.path.basename(file_path)), "user"))
-    shared.chat_history.append(gr.ChatMessage(prompt["text"], "user"))
+        session.chat_conversation.append(gr.ChatMessage(gr.FileData(path=file_path, orig_name=os.path.basename(file_path)), "user"))
+    session.chat_conversation.append(gr.ChatMessage(prompt["text"], "user"))
+    session.chat_conversation.save()
 
     return (
-        shared.chat_history,
+        session.chat_conversation.get_rendered_history(),
         "",
         True,
     )
 
 
-async def create_assistant_message(port: int, stream_responses: bool, temperature: float, top_k: int, top_p: float, min_p: float, typical_p: float, repetition_penalty: float, repetition_penalty_range: int, presence_penalty: float, frequency_penalty: float, mirostat_mode: str, mirostat_tau: float, mirostat_eta: float, dry_base: float, dry_multiplier: float, dry_allowed_length: int, dry_penalty_range: int, xtc_threshold: float, xtc_probability: float):
-    shared.chat_history.append(gr.ChatMessage("", "assistant"))
-    yield shared.chat_history
+async def update_chat_status(port: int, request: gr.Request):
+    chat_conversation: conversation.Conversation = sessions.get(request).chat_conversation
+    load_older_button_update: dict[str, Any] = gr.update(visible=chat_conversation.get_hidden_message_count() > 0)
 
-    if not await lm_backend.check_server_health(port):
-        __delete_last_exchange()
-        yield shared.chat_history
+    base_url: str = lm_backend.get_base_url(port) if chat_conversation.slot is None else chat_conversation.slot[0]
+    try:
+        token_count: int = await context_manager.count_conversation_tokens(base_url, chat_conversation)
+    except (httpx.HTTPError, httpx.InvalidURL, ValueError, KeyError):
+        return "**Context:** Unknown", load_older_button_update
+
+    context_size: int | None = lm_backend.get_context_size(base_url)
+    if context_size is None:
+        return f"**Context:** {token_count} tokens", load_older_button_update
+    return f"**Context:** {token_count} / {context_size} tokens", load_older_button_update
+
+
+# Prefills the slot's prompt cache with the conversation so far once the user stops typing,
+# so that only their new message is left to process when they send it.
+async def on_chat_textbox_input(request: gr.Request) -> None:
+    if not settings.get_key("chat/prefill_while_typing", constants.DEFAULT_SETTINGS["chat"]["prefill_while_typing"]):
         return
 
-    messages: list[dict[str, Any]] = []
-    for message in shared.chat_history:
-        if isinstance(message.content, str):  # type: ignore
-            if message.role == "system" and message.content.rstrip() == "":
-                continue
-
-            messages.append({
-                "role": message.role,
-                "content": message.content,
-            })
-        elif isinstance(message.content, gr.FileData):  # type: ignore
-            file_extension: str = os.path.splitext(message.content.path)[1]
-            if file_extension in constants.GENERIC_FILE_EXTENSIONS:
-                with open(message.content.path, "rt", encoding="utf-8") as file:
-                    messages.append({
-                        "role": message.role,
-                        "content": f"`{os.path.basename(message.content.path)}`:\n\n```\n{file.read()}\n```"
-                    })
-            elif file_extension in constants.IMAGE_FILE_EXTENSIONS:
-                with open(message.content.path, "rb") as file:
-                    messages.append({
-                        "role": message.role,
-                        "content": [
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/{file_extension[1:]};base64,{base64.b64encode(file.read()).decode()}"
-                                },
-                            },
-                        ],
-                    })
-            elif file_extension in constants.AUDIO_FILE_EXTENSIONS:
-                with open(message.content.path, "rb") as file:
-                    messages.append({
-                        "role": message.role,
-                        "content": [
-                            {
-                                "type": "input_audio",
-                                "input_audio": {
-                                    "data": base64.b64encode(file.read()).decode(),
-                                    "format": file_extension[1:],
-                                }
-                            },
-                        ],
-                    })
-
-    payload: dict[str, Any] = {
-        "messages": messages,
-    }
-    payload = lm_backend.create_payload(payload, stream_responses, temperature, top_k, top_p, min_p, typical_p, repetition_penalty, repetition_penalty_range, presence_penalty, frequency_penalty, mirostat_mode, mirostat_tau, mirostat_eta, dry_base, dry_multiplier, dry_allowed_length, dry_penalty_range, xtc_threshold, xtc_probability)
-
-    async with httpx.AsyncClient() as client:
-        # Since this is the face of our app, we want server-specific error messages
-        # (e.g., no Context Shift, invalid image or audio file, etc).
-        try:
-            if not payload["stream"]:
-                shared.assistant_task = asyncio.create_task(client.request("POST", f"http://localhost:{port}/v1/chat/completions", json=payload, timeout=None))
-                response: httpx.Response = await shared.assistant_task
-                response_data: dict[str, Any] = response.json()
-                if "error" not in response_data:
-                    chunk: dict[str, Any] = response_data["choices"][0]
-
-                    shared.chat_history[-1].content = chunk["message"]["content"]
-                    if chunk["finish_reason"] == "length":
-                        gr.Warning(constants.WARNING_NO_CONTEXT_SHIFT_CUTOFF)
-                else:
-                    __delete_last_exchange()
-                    match response_data["error"]["message"]:
-                        case constants.SERVER_ERROR_NO_CONTEXT_SHIFT:
-                            gr.Warning(constants.WARNING_NO_CONTEXT_SHIFT)
-                        case constants.SERVER_ERROR_INVALID_IMAGE_OR_AUDIO:
-                            gr.Warning(constants.WARNING_INVALID_IMAGE_OR_AUDIO)
-                        case constants.SERVER_ERROR_IMAGE_INPUT_UNSUPPORTED:
-                            gr.Warning(constants.WARNING_IMAGE_INPUT_UNSUPPORTED)
-                        case constants.SERVER_ERROR_AUDIO_INPUT_UNSUPPORTED:
-                            gr.Warning(constants.WARNING_AUDIO_INPUT_UNSUPPORTED)
-                        case _:
-                            gr.Warning(constants.WARNING_GENERIC)
+    session: sessions.Session = sessions.get(request)
+    session.chat_prefill_deadline = time.monotonic() + settings.get_key("chat/prefill_debounce_ms", constants.DEFAULT_SETTINGS["chat"]["prefill_debounce_ms"]) / 1000.0
+    if session.chat_prefill_task is None or session.chat_prefill_task.done():
+        session.chat_prefill_task = asyncio.create_task(__prefill_conversation(session))
+
+
+async def create_assistant_message(request: gr.Request):
+    session: sessions.Session = sessions.get(request)
+    # The generation is about to do the same work, on the same slot.
+    if session.chat_prefill_task is not None:
+        session.chat_prefill_task.cancel()
+        session.chat_prefill_task = None
+    session.chat_conversation.append(gr.ChatMessage("", "assistant"))
+    assistant_index: int = len(session.chat_conversation) - 1
+    yield session.chat_conversation.get_rendered_history()
+
+    # The messages are added once they are fitted to the slot's server.
+    payload: dict[str, Any] = lm_backend.create_payload({})
+
+    generation_metrics: metrics.Generation = metrics.Generation("chat")
+    slot_waiter: asyncio.Future[tuple[str, int]] | None = await lm_backend.queue_generation(lm_backend.get_configured_port(), session.session_hash, session.chat_conversation.slot)
+    generation_metrics.mark_queued()
+    if slot_waiter is None:
+        __delete_last_exchange(session)
+        session.chat_conversation.save()
+        yield session.chat_conversation.get_rendered_history()
+        return
+    session.chat_task = slot_waiter
+    slot: tuple[str, int] | None = None
+    try:
+        slot = await lm_backend.wait_for_slot(slot_waiter, session.session_hash)
+    finally:
+        # Stopped while queued, or the whole event was cancelled (which goes on up).
+        if slot is None:
+            __delete_last_exchange(session)
+            session.chat_conversation.save()
+            session.chat_task = None
+    if slot is None:
+        yield session.chat_conversation.get_rendered_history()
+        return
+    generation_metrics.mark_slot_acquired()
+    session.chat_conversation.slot = slot
+    base_url: str = slot[0]
+    payload["id_slot"] = slot[1]
+    payload["cache_prompt"] = True
+    client: httpx.AsyncClient = lm_backend.get_client()
+    # Text of the extra candidates generated on idle slots next to this one, if any.
+    candidate_texts: list[str] = []
+    candidate_tasks: list[asyncio.Task[bool]] = []
+
+    # Since this is the face of our app, we want server-specific error messages
+    # (e.g., no Context Shift, invalid image or audio file, etc).
+    try:
+        request_messages: list[dict[str, Any]]
+        token_counts: list[int | None]
+        request_messages, token_counts = session.chat_conversation.get_request_messages_with_token_counts(base_url)
+        fitted_messages: list[dict[str, Any]] | None = await context_manager.fit_messages(base_url, request_messages, token_counts=token_counts)
+        if fitted_messages is None:
+            __delete_last_exchange(session)
+            gr.Warning(constants.WARNING_CONTEXT_FULL)
+        elif not payload["stream"]:
+            payload["messages"] = fitted_messages
+            candidate_tasks = __start_extra_candidates(payload, base_url, candidate_texts)
+            generation_metrics.mark_request_sent()
+            session.chat_task = asyncio.create_task(client.request("POST", f"{base_url}/v1/chat/completions", json=payload, timeout=None))
+            response: httpx.Response = await session.chat_task
+            response_data: dict[str, Any] = response.json()
+            if "error" not in response_data:
+                chunk: dict[str, Any] = response_data["choices"][0]
+
+                session.chat_conversation.set_last_content(chunk["message"]["content"])
+                session.last_timings = response_data.get("timings")
+                generation_metrics.add_text(chunk["message"]["content"] or "")
+                generation_metrics.timings = session.last_timings
+                generation_metrics.usage = response_data.get("usage")
+                if chunk["finish_reason"] == "length":
+                    gr.Warning(constants.WARNING_NO_CONTEXT_SHIFT_CUTOFF)
             else:
-                shared.assistant_task = 0
-                async with client.stream("POST", f"http://localhost:{port}/v1/chat/completions", json=payload, timeout=None) as response:
-                    async for line in response.aiter_lines():
-                        if shared.assistant_task is None:  # type: ignore
-                            break
-
-                        if line.startswith("data: ") and not line.endswith("[DONE]"):
-                            chunk: dict[str, Any] = json.loads(line[6:])["choices"][0]
-                            chunk_text: str | None = chunk["delta"].get("content", "")
-
-                            if chunk_text is not None:
-                                shared.chat_history[-1].content += chunk_text  # type: ignore
-                                yield shared.chat_history
-
-                            if chunk["finish_reason"] == "length":
-                                gr.Warning(constants.WARNING_NO_CONTEXT_SHIFT_CUTOFF)
-                        elif line.startswith("error: ") and constants.SERVER_ERROR_NO_CONTEXT_SHIFT in line:
-                            __delete_last_exchange()
-                            gr.Warning(constants.WARNING_NO_CONTEXT_SHIFT)
-                        elif line.startswith("{\"error\":"):
-                            __delete_last_exchange()
-                            match json.loads(line)["error"]["message"]:
-                                case constants.SERVER_ERROR_INVALID_IMAGE_OR_AUDIO:
-                                    gr.Warning(constants.WARNING_INVALID_IMAGE_OR_AUDIO)
-                                case constants.SERVER_ERROR_IMAGE_INPUT_UNSUPPORTED:
-                                    gr.Warning(constants.WARNING_IMAGE_INPUT_UNSUPPORTED)
-                                case constants.SERVER_ERROR_AUDIO_INPUT_UNSUPPORTED:
-                                    gr.Warning(constants.WARNING_AUDIO_INPUT_UNSUPPORTED)
-                                case _:
-                                    gr.Warning(constants.WARNING_GENERIC)
-        except httpx.ConnectError:
-            __delete_last_exchange()
-            lm_backend.issue_connection_warning(port)
-        except asyncio.CancelledError:
-            pass
-        except:
-            __delete_last_exchange()
-            gr.Warning(constants.WARNING_GENERIC)
-    yield shared.chat_history
+                __delete_last_exchange(session)
+                __issue_server_error_warning(response_data["error"]["message"])
+        else:
+            payload["messages"] = fitted_messages
+            candidate_tasks = __start_extra_candidates(payload, base_url, candidate_texts)
+            session.chat_task = 0
+            coalescer: stream_coalescer.StreamCoalescer = stream_coalescer.StreamCoalescer()
+            generation_metrics.mark_request_sent()
+            async with client.stream("POST", f"{base_url}/v1/chat/completions", json=payload, timeout=None) as response:
+                async for event in sse.aiter_events(response):
+                    if session.chat_task is None:  # type: ignore
+                        break
+
+                    if event.event == "error":
+                        __delete_last_exchange(session)
+                        __issue_server_error_warning(event.get_error_message())
+                        break
+                    if event.is_done():
+                        break
+
+                    event_data: dict[str, Any] = event.json()
+                    if "timings" in event_data:
+                        session.last_timings = event_data["timings"]
+                        generation_metrics.timings = event_data["timings"]
+                    if "usage" in event_data:
+                        generation_metrics.usage = event_data["usage"]
+
+                    choices: list[dict[str, Any]] = event_data.get("choices", [])
+                    if len(choices) == 0:
+                        continue
+                    chunk: dict[str, Any] = choices[0]
+                    chunk_text: str | None = chunk["delta"].get("content", "")
+
+                    if chunk_text is not None:
+                        session.chat_conversation.extend_last_content(chunk_text)
+                        generation_metrics.add_text(chunk_text)
+                        if coalescer.add():
+                            if len(candidate_tasks) > 0:
+                                session.chat_conversation.set_options(assistant_index, __get_candidate_progress_options(candidate_texts))
+                            yield session.chat_conversation.get_rendered_history()
 
+                    if chunk["finish_reason"] == "length":
+                        gr.Warning(constants.WARNING_NO_CONTEXT_SHIFT_CUTOFF)
+    except httpx.TransportError:
+        __delete_last_exchange(session)
+        lm_backend.mark_backend_unhealthy(base_url)
+        lm_backend.issue_connection_warning(base_url)
+    except asyncio.CancelledError:
+        pass
+    except:
+        __delete_last_exchange(session)
+        gr.Warning(constants.WARNING_GENERIC)
+    finally:
+        lm_backend.release_slot(slot)
+    if len(candidate_tasks) > 0:
+        async for rendered_history in __finish_extra_candidates(session, assistant_index, candidate_texts, candidate_tasks):
+            yield rendered_history
+    generation_metrics.finish()
+    session.chat_conversation.save()
+    session.chat_task = None
+    yield session.chat_conversation.get_rendered_history()
+
+
+async def __prefill_conversation(session: sessions.Session) -> None:
+    while (delay := session.chat_prefill_deadline - time.monotonic()) > 0.0:
+        await asyncio.sleep(delay)
+
+    chat_conversation: conversation.Conversation = session.chat_conversation
+    if session.chat_task is not None:
+        return
+    # create_user_message sets it anyway, so the system prompt is part of the prefill.
+    system_prompt: str = settings.get_key("chat/system_prompt", constants.DEFAULT_SETTINGS["chat"]["system_prompt"])
+    prefill_state: tuple[int, str] = (chat_conversation.version, system_prompt)
+    if chat_conversation.prefilled_state == prefill_state:
+        return
 
-def __delete_last_exchange() -> None:
-    if len(shared.chat_history) > 0:
-        shared.chat_history.pop()
+    # Never waits: prefilling is only worth it on a slot nobody else wants.
+    slot: tuple[str, int] | None = lm_backend.take_idle_slot(lm_backend.get_backend_urls(lm_backend.get_configured_port()), chat_conversation.slot)
+    if slot is None:
+        return
+    base_url: str = slot[0]
+    try:
+        messages: list[dict[str, Any]]
+        token_counts: list[int | None]
+        messages, token_counts = chat_conversation.get_request_messages_with_token_counts(base_url, system_prompt)
+        if len(messages) == 0:
+            return
+        fitted_messages: list[dict[str, Any]] | None = await context_manager.fit_messages(base_url, messages, token_counts=token_counts)
+        if fitted_messages is None:
+            return
+        # One token is the least that can be asked for; the point is the prompt processing.
+        payload: dict[str, Any] = {
+            "messages": fitted_messages,
+            "max_tokens": 1,
+            "id_slot": slot[1],
+            "cache_prompt": True,
+            "stream": False,
+        }
+        response: httpx.Response = await lm_backend.get_client().request("POST", f"{base_url}/v1/chat/completions", json=payload, timeout=None)
+        if response.status_code == 200:
+            chat_conversation.slot = slot
+            chat_conversation.prefilled_state = prefill_state
+    except httpx.TransportError:
+        lm_backend.mark_backend_unhealthy(base_url)
+    except (httpx.HTTPError, httpx.InvalidURL, ValueError, KeyError):
+        pass
+    finally:
+        lm_backend.release_slot(slot)
+
+
+# Sends the same request to as many idle slots of the server as there are extra candidates
+# wanted, each with its own seed. Slots that are busy or wanted by queued generations are
+# left alone, so this only uses spare capacity and may start fewer (or no) candidates.
+def __start_extra_candidates(payload: dict[str, Any], base_url: str, candidate_texts: list[str]) -> list[asyncio.Task[bool]]:
+    candidate_count: int = settings.get_key("chat/candidate_count", constants.DEFAULT_SETTINGS["chat"]["candidate_count"])
+    if candidate_count <= 1:
+        return []
+
+    payload["seed"] = __get_random_seed()
+    candidate_tasks: list[asyncio.Task[bool]] = []
+    for _ in range(candidate_count - 1):
+        slot: tuple[str, int] | None = lm_backend.take_idle_slot([base_url])
+        if slot is None:
+            break
+        candidate_texts.append("")
+        candidate_payload: dict[str, Any] = dict(payload, id_slot=slot[1], seed=__get_random_seed())
+        candidate_tasks.append(asyncio.create_task(__generate_candidate(candidate_payload, slot, candidate_texts, len(candidate_texts) - 1)))
+    return candidate_tasks
+
+
+# Returns whether the candidate can be offered (it may have been stopped part-way).
+async def __generate_candidate(payload: dict[str, Any], slot: tuple[str, int], candidate_texts: list[str], index: int) -> bool:
+    base_url: str = slot[0]
+    client: httpx.AsyncClient = lm_backend.get_client()
+    generation_metrics: metrics.Generation = metrics.Generation("chat")
+    try:
+        generation_metrics.mark_request_sent()
+        if not payload["stream"]:
+            response: httpx.Response = await client.request("POST", f"{base_url}/v1/chat/completions", json=payload, timeout=None)
+            response_data: dict[str, Any] = response.json()
+            if "error" in response_data:
+                return False
+            candidate_texts[index] = response_data["choices"][0]["message"]["content"] or ""
+            generation_metrics.add_text(candidate_texts[index])
+            generation_metrics.timings = response_data.get("timings")
+            generation_metrics.usage = response_data.get("usage")
+        else:
+            async with client.stream("POST", f"{base_url}/v1/chat/completions", json=payload, timeout=None) as response:
+                async for event in sse.aiter_events(response):
+                    if event.event == "error":
+                        return False
+                    if event.is_done():
+                        break
+
+                    event_data: dict[str, Any] = event.json()
+                    if "timings" in event_data:
+                        generation_metrics.timings = event_data["timings"]
+                    if "usage" in event_data:
+                        generation_metrics.usage = event_data["usage"]
+
+                    choices: list[dict[str, Any]] = event_data.get("choices", [])
+                    if len(choices) == 0:
+                        continue
+                    chunk_text: str | None = choices[0]["delta"].get("content", "")
+                    if chunk_text is not None:
+                        candidate_texts[index] += chunk_text
+                        generation_metrics.add_text(chunk_text)
+        generation_metrics.finish()
+        return True
+    except httpx.TransportError:
+        lm_backend.mark_backend_unhealthy(base_url)
+        return False
+    except Exception as exception:
+        # The other candidates and the chat go on without this one.
+        print(f"Candidate {index + 2} failed: {exception!r}")
+        return False
+    finally:
+        lm_backend.release_slot(slot)
+
+
+# Waits for the extra candidates still running once the first one is done, then offers
+# all of them as options under the assistant message.
+async def __finish_extra_candidates(session: sessions.Session, assistant_index: int, candidate_texts: list[str], candidate_tasks: list[asyncio.Task[bool]]):
+    try:
+        # The first candidate failed and took the exchange with it.
+        if len(session.chat_conversation) <= assistant_index:
+            for candidate_task in candidate_tasks:
+                candidate_task.cancel()
+            await asyncio.wait(candidate_tasks)
+            return
+
+        # Stopping the chat stops the remaining candidates, which keep what they have (like the first one).
+        if session.chat_task is None:
+            for candidate_task in candidate_tasks:
+                candidate_task.cancel()
+        else:
+            session.chat_task = asyncio.gather(*candidate_tasks)
+        flush_interval: float = settings.get_key("language_model/stream_flush_interval_ms", constants.DEFAULT_SETTINGS["language_model"]["stream_flush_interval_ms"]) / 1000.0
+        while not all(candidate_task.done() for candidate_task in candidate_tasks):
+            await asyncio.wait(candidate_tasks, timeout=flush_interval)
+            if session.chat_task is not None:
+                session.chat_conversation.set_options(assistant_index, __get_candidate_progress_options(candidate_texts))
+                yield session.chat_conversation.get_rendered_history()
+
+        offered_texts: list[str] = [session.chat_conversation.history[assistant_index].content]  # type: ignore
+        for candidate_text, candidate_task in zip(candidate_texts, candidate_tasks):
+            if candidate_text != "" and (candidate_task.cancelled() or candidate_task.result()):
+                offered_texts.append(candidate_text)
+        session.chat_conversation.set_options(assistant_index, __get_candidate_options(offered_texts, 0) if len(offered_texts) > 1 else [])
+    finally:
+        for candidate_task in candidate_tasks:
+            candidate_task.cancel()
+
+
+# Shows the latest text of each candidate next to the first one's, which streams into the message itself.
+def __get_candidate_progress_options(candidate_texts: list[str]) -> list[dict[str, str]]:
+    progress_options: list[dict[str, str]] = []
+    for index, candidate_text in enumerate(candidate_texts, 2):
+        preview: str = " ".join(candidate_text[-CANDIDATE_PREVIEW_LENGTH:].split())
+        progress_options.append({"value": "", "label": f"Candidate {index}: …{preview}" if len(candidate_text) > CANDIDATE_PREVIEW_LENGTH else f"Candidate {index}: {preview}…"})
+    return progress_options
+
+
+def __get_candidate_options(candidate_texts: list[str], shown_index: int) -> list[dict[str, str]]:
+    return [
+        {"value": candidate_text, "label": f"Candidate {index + 1} (shown)" if index == shown_index else f"Candidate {index + 1}"}
+        for index, candidate_text in enumerate(candidate_texts)
+    ]
+
+
+def __get_random_seed() -> int:
+    # llama.cpp takes 0xFFFFFFFF to mean a random seed.
+    return random.randrange(0xFFFFFFFF)
+
+
+def __delete_last_exchange(session: sessions.Session) -> None:
+    if len(session.chat_conversation) > 0:
+        session.chat_conversation.pop()
         while True:
-            if len(shared.chat_history) == 0 or shared.chat_history[-1].role == "assistant":
+            if len(session.chat_conversation) == 0 or session.chat_conversation.history[-1].role == "assistant":
                 break
-            shared.chat_history.pop()
+            session.chat_conversation.pop()
+
+
+def __issue_server_error_warning(error_message: str) -> None:
+    match error_message:
+        case constants.SERVER_ERROR_NO_CONTEXT_SHIFT:
+            gr.Warning(constants.WARNING_NO_CONTEXT_SHIFT)
+        case constants.SERVER_ERROR_INVALID_IMAGE_OR_AUDIO:
+            gr.Warning(constants.WARNING_INVALID_IMAGE_OR_AUDIO)
+        case constants.SERVER_ERROR_IMAGE_INPUT_UNSUPPORTED:
+            gr.Warning(constants.WARNING_IMAGE_INPUT_UNSUPPORTED)
+        case constants.SERVER_ERROR_AUDIO_INPUT_UNSUPPORTED:
+            gr.Warning(constants.WARNING_AUDIO_INPUT_UNSUPPORTED)
+        case _:
+            gr.Warning(constants.WARNING_GENERIC)
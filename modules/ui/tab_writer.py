@@ -1,62 +1,128 @@
 from typing import Any
-import json
 
 import gradio as gr
 import asyncio
 import httpx
 
 from modules.core import constants
-from modules.core import shared
+from modules import settings
+from modules import sessions
 from modules import lm_backend
+from modules import stream_coalescer
+from modules import metrics
+from modules import sse
 
 
-async def generate_text(prompt: str, port: int, stream_responses: bool, temperature: float, top_k: int, top_p: float, min_p: float, typical_p: float, repetition_penalty: float, repetition_penalty_range: int, presence_penalty: float, frequency_penalty: float, mirostat_mode: str, mirostat_tau: float, mirostat_eta: float, dry_base: float, dry_multiplier: float, dry_allowed_length: int, dry_penalty_range: int, xtc_threshold: float, xtc_probability: float, max_tokens: int):
-    if not await lm_backend.check_server_health(port):
-        return
+async def generate_text(prompt: str, request: gr.Request):
+    session: sessions.Session = sessions.get(request)
 
     payload: dict[str, Any] = {
         "prompt": prompt,
-        "n_predict": max_tokens,
+        "n_predict": settings.get_key("writer/max_tokens", constants.DEFAULT_SETTINGS["writer"]["max_tokens"]),
     }
-    payload = lm_backend.create_payload(payload, stream_responses, temperature, top_k, top_p, min_p, typical_p, repetition_penalty, repetition_penalty_range, presence_penalty, frequency_penalty, mirostat_mode, mirostat_tau, mirostat_eta, dry_base, dry_multiplier, dry_allowed_length, dry_penalty_range, xtc_threshold, xtc_probability)
-
-    shared.writer_text = prompt
-    async with httpx.AsyncClient() as client:
-        # Server-specific error messages aren't really needed here as this is intended
-        # to enable users to write stories or mess around.
-        try:
-            if not payload["stream"]:
-                shared.assistant_task = asyncio.create_task(client.request("POST", f"http://localhost:{port}/completion", json=payload, timeout=None))
-                response: httpx.Response = await shared.assistant_task
-                response_data: dict[str, Any] = response.json()
-                if "error" not in response_data:
-                    shared.writer_text += response_data["content"]
-            else:
-                shared.assistant_task = 0
-                async with client.stream("POST", f"http://localhost:{port}/completion", json=payload, timeout=None) as response:
-                    async for line in response.aiter_lines():
-                        if shared.assistant_task is None:  # type: ignore
-                            break
-
-                        if line.startswith("data: "):
-                            chunk_text: str = json.loads(line[6:])["content"]
-                            shared.writer_text += chunk_text
-                            yield shared.writer_text
-        except httpx.ConnectError:
-            lm_backend.issue_connection_warning(port)
-        except asyncio.CancelledError:
-            pass
-        except:
-            gr.Warning(constants.WARNING_GENERIC)
-    yield shared.writer_text
-
-
-def on_generate_button_click(is_assistant_busy: bool):
-    if is_assistant_busy:
+    payload = lm_backend.create_payload(payload)
+
+    generation_metrics: metrics.Generation = metrics.Generation("writer")
+    slot_waiter: asyncio.Future[tuple[str, int]] | None = await lm_backend.queue_generation(lm_backend.get_configured_port(), session.session_hash, session.writer_slot)
+    generation_metrics.mark_queued()
+    if slot_waiter is None:
+        return
+    session.writer_task = slot_waiter
+    slot: tuple[str, int] | None = None
+    try:
+        slot = await lm_backend.wait_for_slot(slot_waiter, session.session_hash)
+    finally:
+        # Stopped while queued, or the whole event was cancelled (which goes on up).
+        if slot is None:
+            session.writer_task = None
+    if slot is None:
+        return
+    generation_metrics.mark_slot_acquired()
+    session.writer_slot = slot
+    base_url: str = slot[0]
+    payload["id_slot"] = slot[1]
+    payload["cache_prompt"] = True
+    payload["return_tokens"] = True
+
+    # The document's tokens are of the last generated text, so only the user's edits since are tokenized.
+    previous_text: str = session.writer_text
+    session.writer_text = prompt
+    # Streamed text is only joined onto the document when the UI is updated, so each token
+    # costs an append instead of a copy of the whole document.
+    pending_chunks: list[str] = []
+    client: httpx.AsyncClient = lm_backend.get_client()
+
+    # Server-specific error messages aren't really needed here as this is intended
+    # to enable users to write stories or mess around.
+    try:
+        # Sent as token IDs so llama.cpp doesn't re-tokenize the whole document every time.
+        prompt_tokens: list[int] | None = await session.writer_document.update(base_url, previous_text, prompt)
+        if prompt_tokens is not None:
+            payload["prompt"] = prompt_tokens
+
+        generation_metrics.mark_request_sent()
+        if not payload["stream"]:
+            session.writer_task = asyncio.create_task(client.request("POST", f"{base_url}/completion", json=payload, timeout=None))
+            response: httpx.Response = await session.writer_task
+            response_data: dict[str, Any] = response.json()
+            if "error" not in response_data:
+                session.writer_text += response_data["content"]
+                session.writer_document.append(response_data["content"], response_data.get("tokens"))
+                session.last_timings = response_data.get("timings")
+                generation_metrics.add_text(response_data["content"])
+                generation_metrics.timings = session.last_timings
+        else:
+            session.writer_task = 0
+            coalescer: stream_coalescer.StreamCoalescer = stream_coalescer.StreamCoalescer()
+            async with client.stream("POST", f"{base_url}/completion", json=payload, timeout=None) as response:
+                async for event in sse.aiter_events(response):
+                    if session.writer_task is None:  # type: ignore
+                        break
+
+                    if event.event == "error":
+                        gr.Warning(constants.WARNING_GENERIC)
+                        break
+                    if event.is_done():
+                        break
+
+                    event_data: dict[str, Any] = event.json()
+                    if "timings" in event_data:
+                        session.last_timings = event_data["timings"]
+                        generation_metrics.timings = event_data["timings"]
+
+                    pending_chunks.append(event_data["content"])
+                    generation_metrics.add_text(event_data["content"])
+                    session.writer_document.append(event_data["content"], event_data.get("tokens"))
+                    if coalescer.add():
+                        session.writer_text += "".join(pending_chunks)
+                        pending_chunks.clear()
+                        yield session.writer_text
+    except httpx.TransportError:
+        lm_backend.mark_backend_unhealthy(base_url)
+        lm_backend.issue_connection_warning(base_url)
+    except asyncio.CancelledError:
+        pass
+    except:
+        gr.Warning(constants.WARNING_GENERIC)
+    finally:
+        lm_backend.release_slot(slot)
+    generation_metrics.finish()
+    session.writer_text += "".join(pending_chunks)
+    session.writer_task = None
+    yield session.writer_text
+
+
+def set_text_area(request: gr.Request | None = None):
+    return sessions.get(request).writer_text
+
+
+def on_generate_button_click(is_writer_busy: bool):
+    if is_writer_busy:
         raise gr.Error(visible=False, print_exception=False)
 
 
-def on_clear_button_click(is_assistant_busy: bool):
-    if not is_assistant_busy:
-        shared.writer_text = ""
-    return shared.writer_text
+def on_clear_button_click(is_writer_busy: bool, request: gr.Request):
+    session: sessions.Session = sessions.get(request)
+    if not is_writer_busy:
+        session.writer_text = ""
+    return session.writer_text